@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+"""
+End-to-end crawl benchmark against a synthetic local site.
+
+Generates a site (a tree of pages with lazy images, attachments, fragment
+and onclick links, and some tall pages), serves it from a local HTTP
+server and runs crawler.py against it, in its own process with a headless
+browser (--headless).  Reports the pages/min, the per stage secs (from timings.jsonl)
+and the peak RSS of the crawler and its browsers.
+
+The site is served as http://site.example.com/ through the local server
+acting as the HTTP proxy of the crawl (http_proxy), since the crawler only
+crawls domains with a public suffix.
+
+Usage: python e2e_crawl.py [options] [-- <CRAWLER_OPTIONS>...]
+
+Options:
+  --crawler-dir=<DIR>   Directory of the crawler.py to benchmark, eg: a
+                        checkout of an older revision to compare against
+                        (default: ../src).
+  --pages=<N>           Number of pages (default: 200).
+  --fanout=<N>          Child pages linked from each page (default: 5).
+  --depth=<N>           Levels crawled, the crawler's --levels (default: 3).
+  --words=<N>           Words of text per page (default: 800).
+  --images=<N>          Lazy loaded images per page (default: 4).
+  --image-delay=<SECS>  Secs the server takes to send an image (default: 0.05).
+  --attachments=<N>     Attachments linked from each page, half are PDFs,
+                        half are served as attachments without extension
+                        (default: 1).
+  --fragments=<N>       Fragment links (#section-<n>) per page (default: 1).
+  --onclick=<N>         Onclick links per page (default: 1).
+  --tall-every=<N>      Every N-th page is tall, 0 for none (default: 10).
+  --tall-height=<PX>    Height of the tall pages (default: 20000).
+  --output-dir=<DIR>    Crawl output directory (default: a temporary one,
+                        removed after the run).
+  --no-headless         Shows the browser.
+  --baseline=<FILE>     Results to compare against, if it exists
+                        (default: baselines/e2e_crawl.json).
+  --save-baseline       Saves the results to the --baseline file.
+  --json                Prints the results as JSON.
+
+Options after -- are passed to crawler.py, eg: -- --workers=2 --chrome
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import getopt
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import zlib
+
+SITE_HOST = 'site.example.com'
+
+STAGES = ('navigate', 'wait', 'onclick', 'links', 'scope', 'tiles', 'stitch',
+          'encode', 'write', 'download_wait', 'checkpoint', 'total')
+
+
+def png(width, height, rgb):
+    """Builds a PNG of a single color."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    row = '\x00' + struct.pack('BBB', *rgb) * width
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(row * height)) +
+            chunk('IEND', ''))
+
+
+class Site(object):
+
+    """A synthetic site, a tree of pages.
+
+    Page 0 is the start page, page i links to pages fanout*i+1 to
+    fanout*i+fanout.
+
+    """
+
+    def __init__(self, pages=200, fanout=5, words=800, images=4, image_delay=0.05,
+                 attachments=1, fragments=1, onclick=1, tall_every=10,
+                 tall_height=20000):
+        self.pages = pages
+        self.fanout = fanout
+        self.words = words
+        self.images = images
+        self.image_delay = image_delay
+        self.attachments = attachments
+        self.fragments = fragments
+        self.onclick = onclick
+        self.tall_every = tall_every
+        self.tall_height = tall_height
+        rng = random.Random(0)
+        self.vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                                   for _ in range(rng.randint(2, 10)))
+                           for _ in range(2000)]
+        # Requests served, by kind.
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def params(self):
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if isinstance(v, (int, float)))
+
+    def children(self, i):
+        return [x for x in range(self.fanout * i + 1, self.fanout * i + self.fanout + 1)
+                if x < self.pages]
+
+    def page(self, i):
+        """Returns the HTML of page i."""
+        rng = random.Random(i)
+        parent = (i - 1) // self.fanout if i else 0
+        parts = ['<!DOCTYPE html><html><head><meta charset="utf-8">',
+                 '<title>Page %s</title>' % i,
+                 '<style>nav { position: fixed; top: 0; width: 100%; background: #ddd; }'
+                 ' body { margin-top: 40px; font-family: sans-serif; }</style>',
+                 '</head><body>',
+                 '<nav id="nav"><a href="/page/0">Home</a> <a href="/page/%s">Up</a></nav>' % parent,
+                 '<h1>Page %s</h1>' % i]
+        words = [rng.choice(self.vocabulary) for _ in range(self.words)]
+        for n in range(0, len(words), 100):
+            parts.append('<p id="section-%s">%s</p>' % (n // 100, ' '.join(words[n:n + 100])))
+        children = self.children(i)
+        parts.append('<ul>')
+        for child in children:
+            parts.append('<li><a href="/page/%s">Page %s</a></li>' % (child, child))
+        parts.append('</ul>')
+        for n in range(self.fragments):
+            target = children[n % len(children)] if children else i
+            parts.append('<a href="/page/%s#section-%s">Section %s</a>' % (target, n + 1, n + 1))
+        for n in range(self.onclick):
+            parts.append('<a href="#" onclick="showTab(%s); return false;">'
+                         '<span id="tab-%s-%s">Tab %s</span></a>' % (n, i, n, n))
+        parts.append('<div id="tab-panel"></div>')
+        for n in range(self.attachments):
+            if n % 2:
+                parts.append('<a href="/download/%s-%s">Report %s</a>' % (i, n, n))
+            else:
+                parts.append('<a href="/files/%s-%s.pdf">File %s</a>' % (i, n, n))
+        for n in range(self.images):
+            parts.append('<p><img loading="lazy" width="400" height="300" '
+                         'src="/img/%s/%s.png"></p>' % (i, n))
+        if self.tall_every and i % self.tall_every == self.tall_every - 1:
+            parts.append('<div style="height: %spx; background: linear-gradient('
+                         'red, blue)"></div>' % self.tall_height)
+        parts.append('<script>function showTab(n) {'
+                     ' document.getElementById("tab-panel").textContent = "Tab " + n + " %s";'
+                     ' }</script>' % ' '.join(words[:50]))
+        parts.append('</body></html>')
+        return '\n'.join(parts)
+
+    def get(self, path):
+        """Returns the (kind, status, headers, body, delay) of a path."""
+        parts = path.strip('/').split('/')
+        try:
+            if parts[0] == 'page' and int(parts[1]) < self.pages:
+                return 'page', 200, {'Content-Type': 'text/html; charset=utf-8'}, \
+                    self.page(int(parts[1])), 0
+            if parts[0] == 'img':
+                n = int(parts[1]) * 7 + int(parts[2].split('.')[0])
+                return 'image', 200, {'Content-Type': 'image/png'}, \
+                    png(400, 300, (n % 256, n * 3 % 256, 128)), self.image_delay
+            if parts[0] == 'files':
+                return 'attachment', 200, {'Content-Type': 'application/pdf'}, \
+                    '%PDF-1.4\n' + 'x' * 50000 + '\n%%EOF\n', 0
+            if parts[0] == 'download':
+                return 'attachment', 200, {
+                    'Content-Type': 'application/vnd.ms-excel',
+                    'Content-Disposition': 'attachment; filename="report-%s.xls"' % parts[1]}, \
+                    'y' * 20000, 0
+        except (IndexError, ValueError):
+            pass
+        return 'not_found', 404, {'Content-Type': 'text/html'}, '<h1>Not Found</h1>', 0
+
+
+class SiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serves the site, as a web server or an HTTP proxy."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self, body=True):
+        site = self.server.site
+        # Proxy requests have the absolute URL.
+        path = urlparse.urlsplit(self.path).path
+        kind, status, headers, data, delay = site.get(path)
+        with site.lock:
+            site.requests[kind] = site.requests.get(kind, 0) + 1
+        if delay:
+            time.sleep(delay)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SiteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, site):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), SiteHandler)
+        self.site = site
+
+
+def tree_rss(pid):
+    """Returns the RSS in bytes of a process and its descendants (Linux)."""
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The command name (2nd field) may have spaces.
+        parents[int(name)] = int(stat.rpartition(')')[2].split()[1])
+    pids = set([pid])
+    added = True
+    while added:
+        added = False
+        for child, parent in parents.items():
+            if parent in pids and child not in pids:
+                pids.add(child)
+                added = True
+    rss = 0
+    page_size = resource.getpagesize()
+    for x in pids:
+        try:
+            with open('/proc/%s/statm' % x) as f:
+                rss += int(f.read().split()[1]) * page_size
+        except IOError:
+            pass
+    return rss
+
+
+def percentile(sorted_values, q):
+    """Returns the q (0-1) percentile of sorted values (nearest rank)."""
+    return sorted_values[max(int(math.ceil(q * len(sorted_values))) - 1, 0)]
+
+
+def stage_stats(timings_file):
+    """Summarizes the crawler's timings.jsonl.
+
+    @return: (pages, {stage: {count, p50, p95, max, total}})
+
+    """
+    samples = {}
+    pages = 0
+    if not os.path.exists(timings_file):
+        return pages, {}
+    with open(timings_file) as f:
+        for line in f:
+            row = json.loads(line)
+            for stage in STAGES:
+                if stage == 'total' and row['phase'] != 'capture':
+                    continue
+                if stage in row:
+                    samples.setdefault(stage, []).append(row[stage])
+            if row['phase'] == 'capture':
+                pages += 1
+    stats = {}
+    for stage, values in samples.items():
+        values.sort()
+        stats[stage] = {'count': len(values), 'p50': percentile(values, 0.5),
+                        'p95': percentile(values, 0.95), 'max': values[-1],
+                        'total': sum(values)}
+    return pages, stats
+
+
+def run(crawler_dir, site, depth, output_dir, crawler_args, headless=True):
+    """Crawls the site with crawler.py.
+
+    @return: The results.
+
+    """
+    server = SiteServer(site)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    proxy = 'http://127.0.0.1:%s' % server.server_address[1]
+    env = dict(os.environ, http_proxy=proxy, HTTP_PROXY=proxy, no_proxy='', NO_PROXY='')
+    crawler_path = os.path.join(crawler_dir, 'crawler.py')
+    command = [sys.executable, crawler_path,
+               '-s', 'http://%s/page/0' % SITE_HOST, '-a', 'example.com',
+               '-o', output_dir, '-l', str(depth), '--login-wait=0'] + crawler_args
+    if headless:
+        with open(crawler_path) as f:
+            if "'headless'" in f.read():
+                command.append('--headless')
+            else:
+                # Older revisions, Firefox only.
+                env['MOZ_HEADLESS'] = '1'
+    peak_rss = [0]
+    start = time.time()
+    output_file = os.path.join(output_dir, 'crawler.out')
+    with open(output_file, 'w') as output:
+        process = subprocess.Popen(command, env=env, stdout=output, stderr=subprocess.STDOUT)
+        while process.poll() is None:
+            if sys.platform.startswith('linux'):
+                peak_rss[0] = max(peak_rss[0], tree_rss(process.pid))
+            time.sleep(0.25)
+    secs = time.time() - start
+    server.shutdown()
+    if process.returncode:
+        with open(output_file) as f:
+            print >>sys.stderr, 'ERROR: crawler.py failed (exit code %s):\n%s' % (
+                process.returncode, ''.join(f.readlines()[-20:]))
+    # The largest process, where /proc is not available.
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    max_rss *= 1 if sys.platform == 'darwin' else 1024
+    pages, stages = stage_stats(os.path.join(output_dir, 'timings.jsonl'))
+    return {'site': site.params(), 'depth': depth, 'crawler_args': crawler_args,
+            'exit_code': process.returncode, 'secs': secs, 'pages': pages,
+            'pages_per_min': pages * 60.0 / secs if secs else 0,
+            'peak_rss_mb': max(peak_rss[0], max_rss) / 1048576.0,
+            'requests': site.requests, 'stages': stages}
+
+
+def print_results(results, baseline=None):
+    def change(key, value, fmt='%10.2f'):
+        line = fmt % value
+        if baseline is not None and key(baseline) is not None:
+            old = key(baseline)
+            line += ' ' + fmt % old
+            if old:
+                line += ' %+7.1f%%' % ((value - old) * 100.0 / old)
+        return line
+
+    def get(*keys):
+        def key(results):
+            for k in keys:
+                results = results.get(k) if isinstance(results, dict) else None
+            return results
+        return key
+
+    print 'exit code: %s, requests: %s' % (results['exit_code'], results['requests'])
+    print '%-24s %10s%s' % ('', 'current', ' %10s %8s' % ('baseline', 'change')
+                            if baseline else '')
+    print '%-24s %s' % ('pages', change(get('pages'), results['pages'], '%10d'))
+    print '%-24s %s' % ('secs', change(get('secs'), results['secs']))
+    print '%-24s %s' % ('pages/min', change(get('pages_per_min'), results['pages_per_min']))
+    print '%-24s %s' % ('peak RSS MB', change(get('peak_rss_mb'), results['peak_rss_mb']))
+    for stage in STAGES:
+        stats = results['stages'].get(stage)
+        if stats is None:
+            continue
+        for stat in ('p50', 'p95', 'total'):
+            print '%-24s %s' % ('%s %s secs' % (stage, stat),
+                                change(get('stages', stage, stat), stats[stat], '%10.3f'))
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], '', [
+        'crawler-dir=', 'pages=', 'fanout=', 'depth=', 'words=', 'images=',
+        'image-delay=', 'attachments=', 'fragments=', 'onclick=', 'tall-every=',
+        'tall-height=', 'output-dir=', 'no-headless', 'baseline=', 'save-baseline',
+        'json'])
+    opts = dict(opts)
+    here = os.path.dirname(os.path.abspath(__file__))
+    crawler_dir = os.path.abspath(opts.get('--crawler-dir') or os.path.join(
+        here, os.pardir, 'src'))
+    site = Site(pages=int(opts.get('--pages', 200)),
+                fanout=int(opts.get('--fanout', 5)),
+                words=int(opts.get('--words', 800)),
+                images=int(opts.get('--images', 4)),
+                image_delay=float(opts.get('--image-delay', 0.05)),
+                attachments=int(opts.get('--attachments', 1)),
+                fragments=int(opts.get('--fragments', 1)),
+                onclick=int(opts.get('--onclick', 1)),
+                tall_every=int(opts.get('--tall-every', 10)),
+                tall_height=int(opts.get('--tall-height', 20000)))
+    depth = int(opts.get('--depth', 3))
+    output_dir = opts.get('--output-dir') or tempfile.mkdtemp()
+    try:
+        results = run(crawler_dir, site, depth, output_dir, args,
+                      headless='--no-headless' not in opts)
+    finally:
+        if '--output-dir' not in opts:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    results['crawler_dir'] = crawler_dir
+    baseline_file = opts.get('--baseline') or os.path.join(here, 'baselines', 'e2e_crawl.json')
+    baseline = None
+    if os.path.exists(baseline_file) and '--save-baseline' not in opts:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if (baseline.get('site'), baseline.get('depth')) != (results['site'], depth):
+            print >>sys.stderr, 'WARNING: %s is for another site: %s, depth=%s' % (
+                baseline_file, baseline.get('site'), baseline.get('depth'))
+    if '--json' in opts:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print 'crawler: %s' % crawler_dir
+        print_results(results, baseline)
+    if '--save-baseline' in opts:
+        if not os.path.isdir(os.path.dirname(baseline_file)):
+            os.makedirs(os.path.dirname(baseline_file))
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Saved baseline: %s' % baseline_file
+    return 0 if results['exit_code'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
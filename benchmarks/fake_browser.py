@@ -0,0 +1,293 @@
+"""
+In-process fake webdriver, to benchmark and profile the crawler without a
+browser (see fake_crawl.py and micro.py).
+
+FakeSite is a synthetic site, FakeBrowser serves it and answers the
+scripts the crawler runs.  install() makes the crawler's new_webdriver()
+create FakeBrowsers.  The crawler module must be importable (on sys.path)
+before this module is imported.
+
+"""
+
+import re
+import time
+import urlparse
+from cStringIO import StringIO
+
+from PIL import Image
+
+import crawler
+
+
+class FakeSite(object):
+
+    """A synthetic site for the FakeBrowser, a tree of pages.
+
+    Pages are /page/<i> (the root is page 0) on any host.  Page i links
+    to pages fanout*i+1 to fanout*i+fanout, back to the root and its
+    parent, to a page of another domain, to a fragment of a child page
+    and to an onclick tab.
+
+    Like a dict of canned page sources, get(url) returns the source of a
+    page, None if it does not exist.  links(url) returns its links as
+    the browser finds them, without parsing the source.
+
+    """
+
+    def __init__(self, pages=1000, fanout=10, words=300):
+        """Constructs a Fake Site instance.
+
+        @keyword pages: The number of pages.
+        @keyword fanout: The number of child pages linked from each page.
+        @keyword words: The number of words of text of each page.
+
+        """
+        self.pages = pages
+        self.fanout = fanout
+        self.words = words
+
+    def _page(self, url):
+        # Returns the page number of a URL, None if it does not exist.
+        path = urlparse.urlsplit(url).path.strip('/')
+        if not path:
+            path = 'page/0'
+        m = re.match(r'page/(\d+)$', path)
+        if m is None or int(m.group(1)) >= self.pages:
+            return None
+        return int(m.group(1))
+
+    def _links(self, i):
+        # [(href, text, onclick, span_id), ...], in page order.
+        parent = (i - 1) // self.fanout if i else 0
+        children = range(self.fanout * i + 1, min(self.fanout * (i + 1) + 1, self.pages))
+        links = [('/page/0', 'Home', None, None),
+                 ('/page/%s' % parent, 'Up', None, None)]
+        for child in children:
+            links.append(('/page/%s' % child, 'Page %s' % child, None, None))
+        if children:
+            links.append(('/page/%s#section-1' % children[0], 'Section', None, None))
+        links.append(('http://other.example.org/%s' % i, 'Elsewhere', None, None))
+        links.append(('#', 'Tab', 'showTab(%s)' % i, 'tab-%s' % i))
+        return links
+
+    def get(self, url, default=None):
+        i = self._page(url)
+        if i is None:
+            return default
+        links = self._links(i)
+        children = [link for link in links[2:] if link[1].startswith('Page ')]
+        others = links[2 + len(children):]
+        # Words from the page number, so pages are not duplicate contents.
+        words = ' '.join('w%x' % ((i * 7919 + n * 104729) % 65521) for n in range(self.words))
+        parts = ['<html><head><title>Page %s</title></head><body>' % i,
+                 '<div id="nav">%s</div>' % ' '.join(self._anchor(link) for link in links[:2]),
+                 '<h1>Page %s</h1><p>%s</p><ul>' % (i, words)]
+        for link in children:
+            parts.append('<li>%s</li>' % self._anchor(link))
+        parts.append('</ul>')
+        for link in others:
+            parts.append(self._anchor(link))
+        parts.append('</body></html>')
+        return '\n'.join(parts)
+
+    @staticmethod
+    def _anchor(link):
+        href, text, onclick, span_id = link
+        if onclick:
+            return '<a href="%s" onclick="%s"><span id="%s">%s</span></a>' % (
+                href, onclick, span_id, text)
+        return '<a href="%s">%s</a>' % (href, text)
+
+    def links(self, url):
+        """Returns the links of a page as lists of crawler.Link fields,
+        like BrowserFetcher._LINKS_JS (hrefs resolved, except '#')."""
+        i = self._page(url)
+        if i is None:
+            return []
+        links = []
+        for href, text, onclick, span_id in self._links(i):
+            if href != '#':
+                href = urlparse.urljoin(url, href)
+            links.append([href, text, None, onclick, span_id])
+        return links
+
+
+class _FakeElement(object):
+
+    def __init__(self, browser):
+        self.browser = browser
+
+    def click(self):
+        if self.browser.latency:
+            time.sleep(self.browser.latency)
+
+
+class FakeBrowser(object):
+
+    """In-process fake webdriver.
+
+    Serves the page sources of a FakeSite (or a dict of canned page
+    sources by URL), answers the scripts the crawler runs (page
+    readiness, page dimensions, scrolling, --js-links) and returns
+    synthetic screenshot tiles, optionally simulating latency.
+    Downloads are not supported.
+
+    Scripts it does not know raise NotImplementedError, and are listed in
+    FakeBrowser.unknown_scripts, so a new or changed crawler script is
+    not silently benchmarked as a no-op.
+
+    """
+
+    # Served for unknown URLs.
+    BLANK_PAGE = '<html><head></head><body></body></html>'
+    # Scripts run for their side effects on the page, whitespace collapsed.
+    NOOP_SCRIPTS = [
+        # Hides the scrollbars.
+        'const s = document.createElement("style"); s.textContent = '
+        '"body::-webkit-scrollbar { display: none;} body { scrollbar-width: none; }"; '
+        'document.head.insertAdjacentElement("beforeend", s);',
+        "document.body.parentElement.style.scrollBehavior = 'auto';"]
+    # Unpins the --nav-elements.
+    _NAV_RE = re.compile(r'if \(document\.querySelector\("(.*)"\)\) \{ '
+                         r'document\.querySelector\("\1"\)\.setAttribute\('
+                         r'"style", "position: relative;"\); \}$')
+    _SCROLL_RE = re.compile(r"window\.scrollTo\(\{left: (\d+), top: (\d+), behavior: 'auto'\}\)$"
+                            r"|window\.scrollTo\((\d+), (\d+)\)$")
+    # The scripts not recognized, by all FakeBrowsers.
+    unknown_scripts = []
+
+    def __init__(self, pages=None, page_height=3000, latency=0,
+                 screenshot_latency=0, scale=1):
+        """Constructs a Fake Browser instance.
+
+        @keyword pages: The FakeSite, or the {url: page source} served
+                (default: FakeSite()).
+        @keyword page_height: The height in CSS pixels of every page.
+        @keyword latency: Secs to load a page or click.
+        @keyword screenshot_latency: Secs to take a screenshot.
+        @keyword scale: The device pixels per CSS pixel of the screenshots.
+
+        """
+        self.pages = FakeSite() if pages is None else pages
+        self.page_height = page_height
+        self.scale = scale
+        self.latency = latency
+        self.screenshot_latency = screenshot_latency
+        self.current_url = 'about:blank'
+        self.window_size = (1920, 1080)
+        self.scroll = (0, 0)
+        self.cookies = []
+        # Stats.
+        self.get_cnt = 0
+        self.screenshot_cnt = 0
+        # {(width, height, color): PNG data}
+        self._tiles = {}
+
+    def get(self, url):
+        if self.latency:
+            time.sleep(self.latency)
+        self.get_cnt += 1
+        self.current_url = url
+        self.scroll = (0, 0)
+
+    @property
+    def page_source(self):
+        url = urlparse.urldefrag(self.current_url)[0]
+        return self.pages.get(url) or self.pages.get(url.rstrip('/')) or self.BLANK_PAGE
+
+    @property
+    def title(self):
+        m = re.search(r'<title>(.*?)</title>', self.page_source)
+        return m.group(1) if m else ''
+
+    def execute_script(self, script, *args):
+        width, height = self.window_size
+        if script == crawler.PageWaiter._SIGNALS_JS:
+            return ['complete', 0, 0, 1e6, 1e6]
+        if script == crawler.BrowserFetcher._LINKS_JS:
+            if not hasattr(self.pages, 'links'):
+                raise NotImplementedError('FakeBrowser: canned pages have no links')
+            if args[0]:
+                # FakeSite pages have no search results.
+                return []
+            url = urlparse.urldefrag(self.current_url)[0]
+            return self.pages.links(url)
+        script = ' '.join(script.split())
+        values = {'return navigator.userAgent': 'Mozilla/5.0 (FakeBrowser)',
+                  'return document.body.offsetWidth': width,
+                  'return document.body.clientWidth': width,
+                  'return document.body.parentNode.scrollHeight': self.page_height,
+                  'return window.innerHeight': height}
+        if script in values:
+            return values[script]
+        if script in self.NOOP_SCRIPTS or self._NAV_RE.match(script):
+            return None
+        m = self._SCROLL_RE.match(script)
+        if m:
+            left, top = [int(x) for x in m.groups() if x is not None]
+            self.scroll = (left, top)
+            return None
+        self.unknown_scripts.append(script)
+        raise NotImplementedError('FakeBrowser does not know the script: %s' % script[:200])
+
+    def get_screenshot_as_png(self):
+        """Returns a viewport tile of the color of its scroll position."""
+        if self.screenshot_latency:
+            time.sleep(self.screenshot_latency)
+        self.screenshot_cnt += 1
+        width, height = self.window_size
+        height = min(height, self.page_height)
+        width, height = int(width * self.scale), int(height * self.scale)
+        color = ((self.scroll[1] // 7) % 256, 128, 64)
+        key = (width, height, color)
+        png = self._tiles.get(key)
+        if png is None:
+            f = StringIO()
+            Image.new('RGB', (width, height), color).save(f, 'PNG')
+            png = f.getvalue()
+            if len(self._tiles) < 256:
+                self._tiles[key] = png
+        return png
+
+    def get_screenshot_as_file(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.get_screenshot_as_png())
+        return True
+
+    def find_element_by_id(self, id_):
+        return _FakeElement(self)
+
+    def set_window_size(self, width, height):
+        self.window_size = (width, height)
+
+    def add_cookie(self, cookie):
+        self.cookies.append(cookie)
+
+    def get_cookies(self):
+        return list(self.cookies)
+
+    def delete_all_cookies(self):
+        self.cookies = []
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def install(**options):
+    """Makes crawler.new_webdriver() create FakeBrowsers.
+
+    The site only exists in the fake browsers, crawl with
+    --fetch-backend=browser, --downloader=browser and --no-probe.
+
+    @keyword options: FakeBrowser keyword arguments.  The scale defaults
+            to the crawler's --device-scale-factor.
+
+    """
+    def new_webdriver(browser_type, profile=None, download_dir=None):
+        kwargs = dict(options)
+        kwargs.setdefault('scale', crawler.device_scale_factor or 1)
+        return FakeBrowser(**kwargs)
+    crawler.new_webdriver = new_webdriver
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Browserless crawl benchmark.
+
+Runs the crawler's main() in this process with the fake browser of
+fake_browser.py, against a synthetic site of up to 100k pages, to benchmark and profile the crawler's
+own code paths (link extraction and filtering, duplicate checks,
+checkpointing, and with --screenshots, stitching and encoding) without a
+browser.  Reports the pages/min and the per stage secs.  Fails if the
+crawler ran scripts the fake browser does not know.
+
+The crawler's sleeps (eg: polls and retries, or the fixed sleeps of older
+crawler.py versions) are skipped, unless --keep-sleeps.
+
+Usage: python fake_crawl.py [options] [-- <CRAWLER_OPTIONS>...]
+
+Options:
+  --crawler-dir=<DIR>   Directory of the crawler.py to benchmark
+                        (default: ../src).
+  --pages=<N>           Pages of the synthetic site (default: 100000).
+  --levels=<N>          Levels crawled, 10 child pages per page
+                        (default: 5).
+  --screenshots         Takes screenshots, instead of a --dry-run crawl.
+  --page-height=<PX>    Height of the pages (default: 3000).
+  --latency=<SECS>      Secs the fake browser takes to load a page
+                        (default: 0).
+  --screenshot-latency=<SECS>
+                        Secs the fake browser takes per screenshot
+                        (default: 0).
+  --keep-sleeps         Keeps the crawler's sleeps.
+  --profile=<FILE>      Profiles the crawl (main thread) with cProfile,
+                        saves the stats to FILE and prints the top
+                        functions.
+  --output-dir=<DIR>    Crawl output directory (default: a temporary one,
+                        removed after the run).
+
+Options after -- are passed to crawler.py, eg: -- --workers=4
+
+"""
+
+import cProfile
+import getopt
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], '', [
+        'crawler-dir=', 'pages=', 'levels=', 'screenshots', 'page-height=',
+        'latency=', 'screenshot-latency=', 'keep-sleeps', 'profile=', 'output-dir='])
+    opts = dict(opts)
+    crawler_dir = os.path.abspath(opts.get('--crawler-dir') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+    sys.path.insert(0, crawler_dir)
+    import crawler
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import fake_browser
+
+    output_dir = opts.get('--output-dir') or tempfile.mkdtemp()
+    sys.argv = ['crawler.py', '-s', 'http://site.example.com/', '-a', 'example.com',
+                '-o', output_dir, '-l', opts.get('--levels', '5'),
+                # The site only exists in the fake browser.
+                '--fetch-backend=browser', '--downloader=browser', '--no-probe',
+                '--login-wait=0', '--console-level=WARNING'] + args
+    if '--screenshots' not in opts:
+        sys.argv.append('--dry-run')
+    fake_browser.install(
+        pages=fake_browser.FakeSite(pages=int(opts.get('--pages', 100000))),
+        page_height=int(opts.get('--page-height', 3000)),
+        latency=float(opts.get('--latency', 0)),
+        screenshot_latency=float(opts.get('--screenshot-latency', 0)))
+    if '--keep-sleeps' not in opts:
+        crawler.time.sleep = lambda secs: None
+    profiler = cProfile.Profile() if '--profile' in opts else None
+    start = time.time()
+    try:
+        if profiler is not None:
+            profiler.runcall(crawler.main)
+        else:
+            crawler.main()
+        secs = time.time() - start
+        timer = crawler.item_mgr.timer
+        stages, _ = timer.summary()
+        print 'crawler: %s' % crawler_dir
+        print 'pages: %s, secs: %.1f, pages/min: %.0f, urls seen: %s' % (
+            timer.pages, secs, timer.pages * 60.0 / secs,
+            crawler.item_mgr.cnt + crawler.item_mgr.dup_cnt)
+        print '%-14s %7s %8s %8s %8s %10s' % ('STAGE', 'COUNT', 'P50', 'P95', 'MAX', 'TOTAL')
+        for stage, cnt, p50, p95, max_secs, total in stages:
+            print '%-14s %7s %8.4f %8.4f %8.4f %10.2f' % (stage, cnt, p50, p95, max_secs, total)
+    finally:
+        if '--output-dir' not in opts:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    if profiler is not None:
+        profiler.dump_stats(opts['--profile'])
+        pstats.Stats(opts['--profile']).sort_stats('cumulative').print_stats(25)
+    if fake_browser.FakeBrowser.unknown_scripts:
+        print >>sys.stderr, 'ERROR: Scripts unknown to the fake browser:'
+        for script in sorted(set(fake_browser.FakeBrowser.unknown_scripts)):
+            print >>sys.stderr, '  %s' % script[:200]
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
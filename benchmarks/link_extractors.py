@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Link extractor parity check and benchmark.
+
+Extracts the links of each page with every --link-parser backend, checks
+the Link tuples against the bs4 ones and reports the per page parse time.
+
+Usage: python link_extractors.py [-n <REPEAT>] [HTML_FILE]...
+
+Without HTML files, synthetic pages (nav, search results, onclick spans,
+attachments, entities, scripts) are used.
+
+"""
+
+import getopt
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+import crawler
+
+
+def synthetic_page(num_links=500, seed=0):
+    """Builds a page like the wiki/search pages crawled."""
+    parts = [u'<!DOCTYPE html><html><head><title>Page %s</title>' % seed,
+             u'<script>var s = "<a href=\'/not-a-link\'>x</a>";</script>',
+             u'<style>a { color: red; }</style></head><body>',
+             u'<div id="nav"><ul>']
+    for i in range(num_links):
+        k = (seed + i) % 7
+        if k == 0:
+            parts.append(u'<li><a href="/wiki/Page_%s" class="nav">Page &amp; %s &#233;</a></li>' % (i, i))
+        elif k == 1:
+            parts.append(u'<a href="#" onclick="openTab(%s)"><span id="tab-%s">Tab <b>%s</b></span></a>' % (i, i, i))
+        elif k == 2:
+            parts.append(u"<a href=\"#\" onclick=\"goToSharedPage('/shared/%s')\">Shared %s</a>" % (i, i))
+        elif k == 3:
+            parts.append(u'<a href="/pages/viewpageattachments.action?preview=%%2F%s%%2Ffile%s.pdf" '
+                         u'data-type="attachment">file%s.pdf</a>' % (i, i, i))
+        elif k == 4:
+            parts.append(u'<div class="result"><a class="search-result-link visitable" '
+                         u'href="/search/%s?q=a&amp;b=%s">Result\n  %s</a></div>' % (i, i, i))
+        elif k == 5:
+            parts.append(u'<p>Text <a href="http://other.example.com/%s">external<!-- c --> %s</a> '
+                         u'<img src="/i/%s.png"></p>' % (i, i, i))
+        else:
+            parts.append(u'<a href="/p/%s#section-%s" onclick="track()"><span>No id</span></a>' % (i, i))
+    parts.append(u'</ul></div></body></html>')
+    return u'\n'.join(parts)
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:')
+    repeat = int(dict(opts).get('-n', 20))
+    if args:
+        pages = []
+        for path in args:
+            with open(path, 'rb') as f:
+                pages.append(f.read().decode('utf-8', 'replace'))
+    else:
+        pages = [synthetic_page(seed=i) for i in range(5)]
+    backends = ['bs4', 'stream']
+    if crawler.etree is not None:
+        backends.append('lxml')
+    extractors = dict((x, crawler.LINK_EXTRACTORS[x]()) for x in backends)
+
+    print 'Pages: %s, repeat: %s' % (len(pages), repeat)
+    # Parity against bs4.
+    failed = False
+    for search_results in (False, True):
+        expected = [extractors['bs4'].extract(x, search_results=search_results)
+                    for x in pages]
+        for backend in backends[1:]:
+            mismatches = 0
+            for page, links in zip(pages, expected):
+                got = extractors[backend].extract(page, search_results=search_results)
+                if got != links:
+                    mismatches += 1
+                    for a, b in zip(got, links):
+                        if a != b:
+                            print '  %s: %r != bs4 %r' % (backend, a, b)
+                            break
+                    else:
+                        print '  %s: %s links != bs4 %s links' % (backend, len(got), len(links))
+            failed = failed or bool(mismatches)
+            print 'parity %-6s search_results=%-5s: %s/%s pages match bs4' % (
+                backend, search_results, len(pages) - mismatches, len(pages))
+    # Timing.
+    for backend in backends:
+        extractor = extractors[backend]
+        best = None
+        for _ in range(3):
+            start = time.time()
+            for _ in range(repeat):
+                for page in pages:
+                    extractor.extract(page)
+            elapsed = (time.time() - start) / (repeat * len(pages))
+            best = elapsed if best is None else min(best, elapsed)
+        print '%-6s %8.2f ms/page' % (backend, best * 1000)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the crawler's hot paths.
+
+Times the individual hot functions on deterministic fixture data: link
+extraction (each --link-parser backend), scope checks, the duplicate URL
+and section checks, output filenames, ItemMgr save and load, log() and
+the screenshot stitching loop (with fake_browser.py).  Each benchmark is
+run --repeat times, the best and median are reported.
+
+The results are printed as a table (stderr) and written as JSON, to
+compare against later runs with --compare.
+
+Usage: python micro.py [options]
+
+Options:
+  --crawler-dir=<DIR>   Directory of the crawler.py to benchmark
+                        (default: ../src).
+  --filter=<REGEX>      Only runs the benchmarks with a matching name,
+                        eg: scope, itemmgr.load
+  --repeat=<N>          Runs per benchmark (default: 5).
+  --sizes=<N,...>       Items of the ItemMgr save/load benchmarks
+                        (default: 10000,100000, eg: 10000,100000,1000000).
+  --output=<FILE>       Writes the JSON results to FILE (default: stdout).
+  --compare=<FILE>      JSON results of a previous run, flags the
+                        benchmarks slower than --threshold.
+  --threshold=<PCT>     Slowdown reported as a regression (default: 10).
+
+"""
+
+import getopt
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# [(group, function)], see benchmark().
+BENCHMARKS = []
+# Items of the ItemMgr save/load benchmarks.
+SIZES = [10000, 100000]
+# Removed at exit.
+TEMP_DIRS = []
+
+
+def temp_dir():
+    TEMP_DIRS.append(tempfile.mkdtemp())
+    return TEMP_DIRS[-1]
+
+
+def benchmark(group):
+    """Registers the benchmarks of a group.
+
+    The function does the setup and returns [(name, ops, run)], the names
+    starting with "<group>.".  run() is timed and must be repeatable, it
+    may return the secs to report instead (eg: to leave out a teardown).
+
+    """
+    def register(function):
+        BENCHMARKS.append((group, function))
+        return function
+    return register
+
+
+def fixture_urls(n, seed=0):
+    """URLs like the ones found on crawled pages."""
+    rng = random.Random(seed)
+    hosts = (['www.example.com', 'wiki.example.com', 'corp.example.org', 'example.com'] +
+             ['host%s.other%s.net' % (i, i % 7) for i in range(50)])
+    urls = []
+    for i in range(n):
+        k = rng.random()
+        host = hosts[0 if k < 0.5 else rng.randrange(len(hosts))]
+        path = '/'.join('seg%s' % rng.randrange(100) for _ in range(rng.randint(1, 4)))
+        url = 'http://%s/%s' % (host, path)
+        if k < 0.1:
+            url += '?id=%s&page=%s' % (rng.randrange(1000), rng.randrange(10))
+        elif k < 0.15:
+            url += '/#section-%s' % rng.randrange(5)
+        elif k < 0.17:
+            url += '.png'
+        elif k < 0.18:
+            url = 'http://localhost-%s/x' % i
+        urls.append(url)
+    return urls
+
+
+@benchmark('links')
+def links(crawler):
+    sys.path.insert(0, here)
+    from link_extractors import synthetic_page
+    pages = [synthetic_page(seed=i) for i in range(5)]
+    backends = ['bs4', 'stream'] + (['lxml'] if crawler.etree is not None else [])
+    cases = []
+    for backend in backends:
+        extractor = crawler.LINK_EXTRACTORS[backend]()
+
+        def run(extractor=extractor):
+            for page in pages:
+                extractor.extract(page)
+        cases.append(('links.%s' % backend, len(pages), run))
+    return cases
+
+
+@benchmark('scope')
+def scope(crawler):
+    urls = fixture_urls(20000)
+
+    def matcher():
+        return crawler.ScopeMatcher(['example.com', 'example.org'], sub_urls=['seg'],
+                                    exclude=[r'\.png$'])
+    warm = matcher()
+
+    def run_warm():
+        for url in urls:
+            warm.check(url)
+
+    def run_cold():
+        m = matcher()
+        for url in urls:
+            m.check(url)
+    return [('scope.check.warm', len(urls), run_warm),
+            ('scope.check.cold', len(urls), run_cold)]
+
+
+@benchmark('dups')
+def dups(crawler):
+    # Half of the URLs are seen twice, some are sections.
+    urls = fixture_urls(20000)
+    urls = urls + urls[::2]
+    random.Random(1).shuffle(urls)
+    items = []
+    for url in urls:
+        item = crawler.Item()
+        item.url = url
+        items.append(item)
+
+    def run():
+        m = crawler.ItemMgr(temp_dir())
+        for item in items:
+            if not m.check_dup(item):
+                m.finish(item)
+    return [('dups.check_dup', len(items), run)]
+
+
+@benchmark('filename')
+def filenames(crawler):
+    urls = fixture_urls(20000)
+
+    def run():
+        for url in urls:
+            crawler.build_filename(url)
+    return [('filename.build_filename', len(urls), run)]
+
+
+@benchmark('itemmgr')
+def item_mgr(crawler):
+    cases = []
+    for size in SIZES:
+        output_dir = temp_dir()
+        m = crawler.ItemMgr(output_dir)
+        for i in range(size):
+            item = crawler.Item()
+            item.url = 'http://www.example.com/page/%s' % i
+            item.referrer = 'http://www.example.com/page/%s' % (i // 10)
+            item.title = 'Page %s' % i
+            item.processed = True
+            item.generated_next = True
+            level = min(len(str(i)), 6)
+            m.add_item(item, level)
+            m.check_dup(item)
+            m.finish(item)
+
+        def save(m=m):
+            m.save()
+
+        def load(output_dir=output_dir):
+            crawler.ItemMgr(output_dir).load()
+        save()
+        cases += [('itemmgr.save.%s' % size, size, save),
+                  ('itemmgr.load.%s' % size, size, load)]
+    return cases
+
+
+@benchmark('log')
+def logging(crawler):
+    n = 20000
+
+    def run_sync():
+        for i in range(n):
+            crawler.log('INFO', crawler.logfile, 'Found link %s: http://www.example.com/' % i)
+    cases = [('log.sync', n, run_sync)]
+    if hasattr(crawler, 'LogWriter'):
+        def run_async():
+            crawler.log_writer = crawler.LogWriter()
+            try:
+                start = time.time()
+                for i in range(n):
+                    crawler.log('INFO', crawler.logfile,
+                                'Found link %s: http://www.example.com/' % i)
+                # Only the callers' cost, not the writes.
+                secs = time.time() - start
+            finally:
+                writer, crawler.log_writer = crawler.log_writer, None
+            writer.close()
+            return secs
+        cases.append(('log.async', n, run_async))
+    return cases
+
+
+@benchmark('stitch')
+def stitch(crawler):
+    sys.path.insert(0, here)
+    from fake_browser import FakeBrowser
+
+    class DiscardEncodes(object):
+        """Only the stitching is timed, not the encoding."""
+        def submit(self, image, outputs):
+            pass
+    output_dir = temp_dir()
+    cases = []
+    for height in (3000, 20000):
+        def run(height=height):
+            encode_pool, crawler.encode_pool = crawler.encode_pool, DiscardEncodes()
+            try:
+                crawler.stitch_screenshot(FakeBrowser(page_height=height),
+                                          os.path.join(output_dir, 'page.png'))
+            finally:
+                crawler.encode_pool = encode_pool
+        cases.append(('stitch.%spx' % height, 1, run))
+    return cases
+
+
+def main():
+    global SIZES
+    opts, args = getopt.getopt(sys.argv[1:], '', [
+        'crawler-dir=', 'filter=', 'repeat=', 'sizes=', 'output=', 'compare=',
+        'threshold='])
+    opts = dict(opts)
+    crawler_dir = os.path.abspath(opts.get('--crawler-dir') or os.path.join(
+        here, os.pardir, 'src'))
+    sys.path.insert(0, crawler_dir)
+    import crawler
+    repeat = int(opts.get('--repeat', 5))
+    SIZES = [int(x) for x in opts.get('--sizes', '10000,100000').split(',')]
+    name_re = re.compile(opts.get('--filter', ''))
+    threshold = float(opts.get('--threshold', 10))
+    previous = {}
+    if '--compare' in opts:
+        with open(opts['--compare']) as f:
+            previous = json.load(f)['results']
+
+    # Log to a temporary file, without printing.
+    log_dir = tempfile.mkdtemp()
+    crawler.logfile = os.path.join(log_dir, 'crawler.log')
+    crawler.init_logfile(crawler.logfile)
+    crawler.console_level = 100
+    crawler.page_waiter = crawler.PageWaiter()
+    crawler.page_waiter.logfile = crawler.logfile
+    crawler.link_extractor = crawler.LINK_EXTRACTORS['stream']()
+
+    results = {}
+    regressions = []
+    print >>sys.stderr, '%-24s %8s %12s %12s %10s' % ('BENCHMARK', 'OPS', 'BEST_US/OP',
+                                                     'MEDIAN_US/OP', 'CHANGE')
+    for group, function in BENCHMARKS:
+        # Skips the setup of the groups filtered out.
+        if not (name_re.search(group) or group in name_re.pattern):
+            continue
+        for name, ops, run in function(crawler):
+            if not name_re.search(name):
+                continue
+            secs = []
+            for _ in range(repeat):
+                start = time.time()
+                elapsed = run()
+                secs.append(time.time() - start if elapsed is None else elapsed)
+            secs.sort()
+            result = results[name] = {
+                'ops': ops, 'repeat': repeat, 'best_secs': secs[0],
+                'median_secs': secs[len(secs) // 2],
+                'best_us_per_op': secs[0] * 1e6 / ops,
+                'median_us_per_op': secs[len(secs) // 2] * 1e6 / ops}
+            change = ''
+            if name in previous:
+                old = previous[name]['best_us_per_op']
+                pct = (result['best_us_per_op'] - old) * 100.0 / old
+                change = '%+.1f%%' % pct
+                if pct > threshold:
+                    change += ' !!'
+                    regressions.append(name)
+            print >>sys.stderr, '%-24s %8s %12.2f %12.2f %10s' % (
+                name, ops, result['best_us_per_op'], result['median_us_per_op'], change)
+    for path in TEMP_DIRS + [log_dir]:
+        shutil.rmtree(path, ignore_errors=True)
+
+    report = {'meta': {'crawler_dir': crawler_dir, 'python': platform.python_version(),
+                       'platform': platform.platform(), 'time': time.time(),
+                       'repeat': repeat, 'sizes': SIZES},
+              'results': results,
+              'regressions': regressions}
+    if '--output' in opts:
+        with open(opts['--output'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+    if regressions:
+        print >>sys.stderr, 'Regressions (> %s%% slower): %s' % (threshold, ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Screenshot stitching benchmark.
+
+Stitches synthetic pages with stitch_screenshot() and a fake webdriver,
+each run in its own process, and reports the time and peak RSS per page.
+
+Usage: python stitch_screenshots.py [options]
+
+Options:
+  --crawler-dir=<DIR>   Directory of the crawler.py to benchmark, eg: a
+                        checkout of an older revision to compare against
+                        (default: ../src).
+  --width=<PX>          Page width (default: 1280).
+  --heights=<PX,...>    Page heights (default: 8000,30000,65500).
+  --viewport=<PX>       Viewport height (default: 900).
+  --repeat=<N>          Runs per page height, best is reported (default: 3).
+  --tall-output=<pdf|segments>
+                        Stitch with the crawler's --tall-output bands.
+
+"""
+
+import getopt
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+
+def run(crawler_dir, width, height, viewport_height, tall_output=None):
+    """Stitches one page, in this process."""
+    sys.path.insert(0, crawler_dir)
+    import crawler
+    from PIL import Image
+    # The synthetic pages are big on purpose.
+    Image.MAX_IMAGE_PIXELS = None
+
+    # A page of horizontal bands, so misplaced tiles show up.
+    page = Image.new('RGB', (width, height))
+    for y in range(0, height, 50):
+        page.paste(((y // 50) % 256, (y // 7) % 256, 128), (0, y, width, min(y + 50, height)))
+
+    class FakeDriver(object):
+        scroll_top = 0
+
+        def execute_script(self, script, *args):
+            if '__crawlerReady' in script:
+                return ['complete', 0, 0, 1e6, 1e6]
+            if 'offsetWidth' in script or 'clientWidth' in script:
+                return width
+            if 'scrollHeight' in script:
+                return height
+            if 'innerHeight' in script:
+                return viewport_height
+            if 'top:' in script:
+                self.scroll_top = int(script.split('top:')[1].split(',')[0])
+            elif 'scrollTo(' in script:
+                self.scroll_top = int(script.split(',')[1].split(')')[0])
+            return None
+
+        def _tile(self):
+            top = min(self.scroll_top, height - viewport_height)
+            return page.crop((0, top, width, top + viewport_height))
+
+        def get_screenshot_as_png(self):
+            f = StringIO()
+            self._tile().save(f, 'PNG')
+            return f.getvalue()
+
+        def get_screenshot_as_file(self, filename):
+            self._tile().save(filename, 'PNG')
+            return True
+
+    out_dir = tempfile.mkdtemp()
+    crawler.logfile = os.path.join(out_dir, 'crawler.log')
+    crawler.init_logfile(crawler.logfile)
+    crawler.page_waiter = crawler.PageWaiter()
+    crawler.page_waiter.logfile = crawler.logfile
+    crawler.tall_output = tall_output
+    filepath = os.path.join(out_dir, 'page.png')
+    stitch = getattr(crawler, 'stitch_screenshot', crawler.fullpage_screenshot)
+    # Only the stitching is timed, the page and RSS so far are the baseline.
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    stitch(FakeDriver(), filepath)
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux, bytes on Mac.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    if tall_output == 'segments':
+        with open(os.path.join(out_dir, 'page_manifest.json')) as f:
+            manifest = json.load(f)
+        result = Image.new('RGB', (manifest['width'], manifest['height']))
+        for segment in manifest['segments']:
+            result.paste(Image.open(os.path.join(out_dir, segment['file'])), (0, segment['top']))
+    elif tall_output == 'pdf':
+        # Not checked.
+        result = None
+    else:
+        result = Image.open(filepath)
+    correct = None
+    if result is not None:
+        expected = page.crop((0, 0, width, min(height, result.size[1])))
+        correct = result.convert('RGB').tobytes() == expected.tobytes()
+    return {'secs': elapsed,
+            'peak_rss_mb': peak_rss * scale / 1048576.0,
+            'stitch_rss_mb': (peak_rss - base_rss) * scale / 1048576.0,
+            'correct': correct}
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], '', ['crawler-dir=', 'width=', 'heights=',
+                                                  'viewport=', 'repeat=', 'tall-output=',
+                                                  'run'])
+    opts = dict(opts)
+    crawler_dir = os.path.abspath(opts.get('--crawler-dir') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+    width = int(opts.get('--width', 1280))
+    viewport_height = int(opts.get('--viewport', 900))
+    if '--run' in opts:
+        # Quiet the crawler logging, only print the result.
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        result = run(crawler_dir, width, int(opts['--heights']), viewport_height,
+                     tall_output=opts.get('--tall-output'))
+        sys.stdout = stdout
+        print json.dumps(result)
+        return 0
+    heights = [int(x) for x in opts.get('--heights', '8000,30000,65500').split(',')]
+    repeat = int(opts.get('--repeat', 3))
+    extra_args = []
+    if opts.get('--tall-output'):
+        extra_args.append('--tall-output=%s' % opts['--tall-output'])
+    print 'crawler: %s' % crawler_dir
+    print '%8s %10s %14s %14s %8s' % ('height', 'secs', 'peak_rss_mb', 'stitch_rss_mb', 'correct')
+    for height in heights:
+        results = []
+        for _ in range(repeat):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--run',
+                 '--crawler-dir=%s' % crawler_dir, '--width=%s' % width,
+                 '--heights=%s' % height, '--viewport=%s' % viewport_height] + extra_args)
+            results.append(json.loads(output.splitlines()[-1]))
+        correct = [x['correct'] for x in results]
+        print '%8s %10.2f %14.1f %14.1f %8s' % (
+            height, min(x['secs'] for x in results),
+            min(x['peak_rss_mb'] for x in results),
+            min(x['stitch_rss_mb'] for x in results),
+            'n/a' if None in correct else all(correct))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
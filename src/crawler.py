@@ -10,29 +10,57 @@ informs crawler to go n levels down on the website.
 
 """
 
+import array
+import atexit
+import base64
 from cStringIO import StringIO
 import codecs
+from collections import deque, namedtuple
 import csv
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
 import getopt
+import hashlib
+import heapq
+import htmlentitydefs
+import HTMLParser
+import itertools
+import json
+import math
 import mimetypes
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
-from PIL import Image, ImageDraw
+from PIL import Image, features
 import pickle
+import Queue
 import re
+import select
 import shutil
+import struct
 from subprocess import Popen, PIPE
 import sys
+import tempfile
 import time
 from textwrap import dedent
+import threading
 import traceback
 import urllib2
 import urlparse
 import uuid
 
 from bs4 import BeautifulSoup
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 import pdfkit
+import requests
 from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from tld import get_tld
 
 
@@ -55,10 +83,104 @@ item_mgr = None
 browser = None
 browser_profile = None
 browser_type = None
+browser_mgr = None
+worker_pool = None
+# Page fetch backends.  http_fetcher is only set when pages that are not
+# screenshot may be fetched without the browser.
+browser_fetcher = None
+http_fetcher = None
+# Waits for pages to be ready (PageWaiter).
+page_waiter = None
+# Screenshots encoding (see EncodePool), None to encode on the browser thread.
+encode_pool = None
+image_format = 'png'
+# PNG compress level (0-9), or JPEG/WebP quality (1-100).
+image_quality = None
+# Write screenshots as bands ('pdf' or 'segments'), None for one image.
+tall_output = None
+# Native full page screenshots, None to always stitch.
+page_capture = None
+# Browser window.  device_scale_factor is the device pixels per CSS pixel,
+# None for the display's.
+headless = False
+window_size = (1920, 1080)
+device_scale_factor = None
+# Scale of the screenshots (0-1].
+downscale = 1.0
+# Link extractor (see --link-parser).
+link_extractor = None
+# Get links from the live DOM of browser loaded pages.
+js_links = False
+# Page load profile (see LOAD_PROFILES), 'auto' to pick it per page.
+load_profile = 'auto'
+# URL patterns also blocked by the source and discovery load profiles.
+blocked_urls = []
+# Skip capturing pages with the content of pages captured already.
+skip_duplicate_content = False
+# Moves downloads as they complete (see DownloadTracker), None to move them
+# after each page.
+download_tracker = None
+# Downloads files without the browser (see Downloader), None to use the browser.
+downloader = None
+# Content types of URLs without extension (see ContentTypeClassifier), None
+# to only guess from extensions.
+content_classifier = None
+# URL canonicalizer, None to use URLs as found.
+url_canonicalizer = None
+# Writes the log on a background thread (see LogWriter), None to write it
+# on the calling thread.
+log_writer = None
+# Lowest levels written to the log file and printed.
+LOG_LEVELS = {'DEBUG':10, 'INFO':20, 'WARNING':30, 'ERROR':40}
+log_level = LOG_LEVELS['INFO']
+console_level = LOG_LEVELS['INFO']
+# Per thread state (eg: the browser bound to a worker thread).
+_thread_local = threading.local()
+
+# This MAX_HEIGHT is a limitation of the PIL library.
+# NOTE: The PDF max height appears to be less than this.
+# TODO: Break into different pages based on PDF max page height?
+SCREENSHOT_MAX_HEIGHT = 65500
+# --image-format: (PIL format, file extension).
+IMAGE_FORMATS = {'png':('PNG','.png'),
+                 'jpeg':('JPEG','.jpg'),
+                 'webp':('WEBP','.webp')}
+# Height of the bands written with --tall-output.
+TALL_BAND_HEIGHT = 8192
+# Resources that page loads can skip: (URL patterns blocked through
+# DevTools in Chrome, Firefox preferences).
+BLOCKABLE_RESOURCES = {
+    'image':(['*.%s%s' % (ext, q) for ext in ('png','jpg','jpeg','gif','webp','svg','ico','bmp')
+              for q in ('', '?*')],
+             {'permissions.default.image':2}),
+    'font':(['*.%s%s' % (ext, q) for ext in ('woff','woff2','ttf','otf','eot')
+             for q in ('', '?*')],
+            {'browser.display.use_document_fonts':0,
+             'gfx.downloadable_fonts.enabled':False}),
+    'media':(['*.%s%s' % (ext, q) for ext in ('mp4','webm','ogg','ogv','mp3','m4a','m3u8','mov','avi')
+              for q in ('', '?*')],
+             {'media.autoplay.default':5,
+              'media.autoplay.blocking_policy':2}),
+    'stylesheet':(['*.css', '*.css?*'],
+                  {'permissions.default.stylesheet':2}),
+    # Third-party analytics and ads, Firefox blocks them (and other
+    # trackers) with its tracking protection.
+    'analytics':(['*google-analytics.com/*', '*googletagmanager.com/*',
+                  '*doubleclick.net/*', '*googlesyndication.com/*',
+                  '*connect.facebook.net/*', '*hotjar.com/*', '*segment.com/*',
+                  '*segment.io/*', '*mixpanel.com/*', '*newrelic.com/*',
+                  '*nr-data.net/*', '*scorecardresearch.com/*'],
+                 {'privacy.trackingprotection.enabled':True}),
+}
+# --load-profile: the resources each page load profile skips.
+LOAD_PROFILES = {'full':(),
+                 'source':('image','font','media','analytics'),
+                 'discovery':('image','font','media','stylesheet','analytics')}
 
 start_url = None
 allowed_domains = []
 sub_urls = []
+scope_matcher = None
 parent_output_dir = None
 export_to_pdf = False
 search_result_links = False
@@ -76,6 +198,10 @@ class BrowserType(object):
     CHROME = 2
 
 
+# A hyperlink found on a page.  span_id is None if the anchor has no span.
+Link = namedtuple('Link', 'href text data_type onclick span_id')
+
+
 class Item(object):
     
     """Structure to hold relevant crawled data."""
@@ -93,8 +219,18 @@ class Item(object):
         self.pdf_export_link = None
         self.processed = False
         self.generated_next = False
+        # List of Link tuples, until the next level is generated.
         self.next_level_links = None
         self.data_type = None
+        # URL as found, if canonicalizing changed it.
+        self.raw_url = None
+        # Content type, once classified by is_download_type() ('' if
+        # unknown).
+        self.content_type = None
+        # Content fingerprint (sha1, simhash), taken once the page is loaded.
+        self.fingerprint = None
+        # Position in the ItemMgr items of its level.
+        self.index = None
     
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__,self.url)
@@ -104,9 +240,743 @@ class Item(object):
                 (self.level,self.url,self.onclick_id, self.referrer))
 
 
+class BloomFilter(object):
+    
+    """Bloom filter over 64-bit fingerprints.
+    
+    Answers "never added" without false negatives.
+    
+    """
+    
+    def __init__(self, num_bits, num_hashes=7, bits=None):
+        """Constructs a Bloom Filter instance.
+        
+        @param num_bits: The size of the filter in bits.
+        @keyword num_hashes: The number of bits set per fingerprint.
+        @keyword bits: The bits (eg: loaded from file), all clear if None.
+        
+        """
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+    
+    def _positions(self, fp):
+        h1 = fp & 0xffffffff
+        h2 = (fp >> 32) | 1
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+    
+    def add(self, fp):
+        for pos in self._positions(fp):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, fp):
+        for pos in self._positions(fp):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class DupStore(object):
+    
+    """Compact store of the seen (url, onclick_id) pairs and their counters.
+    
+    Pairs are keyed by a 64-bit fingerprint in an open addressing hash
+    table, with the 'cnt' and 'sec_cnt' counters stored alongside, all in
+    one flat buffer.  That buffer is also the save file format, so loading
+    just maps the file (copy-on-write).  An optional Bloom filter in front
+    of the table answers "never seen" without probing it.
+    
+    The URLs themselves are only kept for the pairs found duplicate, for
+    the reports.
+    
+    """
+    
+    MAGIC = 'CRDUPS01'
+    # magic, capacity, size, bloom bits, bloom hashes.
+    _HEADER = struct.Struct('<8sQQQQ')
+    # fingerprint (0 = empty slot), cnt, sec_cnt.
+    _SLOT = struct.Struct('<QII')
+    MAX_LOAD = 0.7
+    
+    def __init__(self, capacity=1024, bloom_bits=0):
+        """Constructs a Dup Store instance.
+        
+        @keyword capacity: Initial number of slots (rounded to a power of 2).
+        @keyword bloom_bits: Size of the Bloom filter in bits, 0 for none.
+        
+        """
+        cap = 1
+        while cap < capacity:
+            cap *= 2
+        self.capacity = cap
+        self.size = 0
+        self._buf = bytearray(self._HEADER.size + cap * self._SLOT.size)
+        self._mmap = None
+        self.bloom = BloomFilter(bloom_bits) if bloom_bits else None
+        # {fingerprint: (url, onclick_id), ...} of the duplicates.
+        self.labels = {}
+    
+    @staticmethod
+    def fingerprint(url, onclick_id):
+        """Returns the 64-bit fingerprint of a (url, onclick_id) pair."""
+        key = '\0'.join([x.encode('utf-8') if isinstance(x, unicode) else x
+                         for x in (url, onclick_id or '')])
+        fp = struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+        # 0 marks empty slots.
+        return fp or 1
+    
+    def _find(self, fp):
+        """Returns the offset of the slot of fp, or of the empty slot
+        where it would go."""
+        mask = self.capacity - 1
+        i = fp & mask
+        while True:
+            offset = self._HEADER.size + i * self._SLOT.size
+            slot_fp = self._SLOT.unpack_from(self._buf, offset)[0]
+            if slot_fp == fp or slot_fp == 0:
+                return offset
+            i = (i + 1) & mask
+    
+    def get(self, url, onclick_id):
+        """Gets the counters of a pair.
+        
+        @return: (cnt, sec_cnt), or None if never seen.
+        
+        """
+        fp = self.fingerprint(url, onclick_id)
+        if self.bloom is not None and fp not in self.bloom:
+            return None
+        slot_fp, cnt, sec_cnt = self._SLOT.unpack_from(self._buf, self._find(fp))
+        if slot_fp == 0:
+            return None
+        return (cnt, sec_cnt)
+    
+    def __contains__(self, key):
+        return self.get(*key) is not None
+    
+    def __len__(self):
+        return self.size
+    
+    def set(self, url, onclick_id, cnt=0, sec_cnt=0):
+        """Sets the counters of a pair, adding it if needed."""
+        fp = self.fingerprint(url, onclick_id)
+        offset = self._find(fp)
+        if self._SLOT.unpack_from(self._buf, offset)[0] == 0:
+            if self.size + 1 > self.capacity * self.MAX_LOAD:
+                self._grow()
+                offset = self._find(fp)
+            self.size += 1
+            if self.bloom is not None:
+                self.bloom.add(fp)
+        self._SLOT.pack_into(self._buf, offset, fp, cnt, sec_cnt)
+        if cnt:
+            self.labels[fp] = (url, onclick_id)
+    
+    def incr(self, url, onclick_id, sec=False):
+        """Increments the counters of a seen pair.
+        
+        @keyword sec: Also increment sec_cnt (section duplicate).
+        @return: The new (cnt, sec_cnt).
+        
+        """
+        cnt, sec_cnt = self.get(url, onclick_id)
+        cnt, sec_cnt = cnt + 1, sec_cnt + (1 if sec else 0)
+        self.set(url, onclick_id, cnt, sec_cnt)
+        return (cnt, sec_cnt)
+    
+    def remove(self, url, onclick_id):
+        """Removes a pair, if present."""
+        fp = self.fingerprint(url, onclick_id)
+        offset = self._find(fp)
+        if self._SLOT.unpack_from(self._buf, offset)[0] == 0:
+            return
+        self.labels.pop(fp, None)
+        self.size -= 1
+        # Backward shift deletion: move following slots of the probe run
+        # into the hole unless they are already at or past their home slot.
+        mask = self.capacity - 1
+        i = (offset - self._HEADER.size) // self._SLOT.size
+        j = i
+        while True:
+            self._SLOT.pack_into(self._buf, self._HEADER.size + i * self._SLOT.size, 0, 0, 0)
+            while True:
+                j = (j + 1) & mask
+                slot = self._SLOT.unpack_from(self._buf, self._HEADER.size + j * self._SLOT.size)
+                if slot[0] == 0:
+                    return
+                home = slot[0] & mask
+                if i <= j:
+                    stays = i < home <= j
+                else:
+                    stays = i < home or home <= j
+                if not stays:
+                    break
+            self._SLOT.pack_into(self._buf, self._HEADER.size + i * self._SLOT.size, *slot)
+            i = j
+    
+    def iter_dups(self):
+        """Yields (url, onclick_id, cnt, sec_cnt) of the duplicates."""
+        for url, onclick_id in self.labels.values():
+            cnt, sec_cnt = self.get(url, onclick_id)
+            yield (url, onclick_id, cnt, sec_cnt)
+    
+    def _grow(self):
+        old_buf, old_capacity = self._buf, self.capacity
+        self.capacity *= 2
+        self._buf = bytearray(self._HEADER.size + self.capacity * self._SLOT.size)
+        for i in xrange(old_capacity):
+            slot = self._SLOT.unpack_from(old_buf, self._HEADER.size + i * self._SLOT.size)
+            if slot[0]:
+                self._SLOT.pack_into(self._buf, self._find(slot[0]), *slot)
+        self._close_mmap()
+    
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+    
+    def save(self, save_file):
+        """Saves the table (and Bloom filter) to save_file atomically."""
+        if self._mmap is not None:
+            # The mapped file is replaced below (not possible on Windows
+            # while it is mapped).
+            self._buf = bytearray(self._buf)
+            self._close_mmap()
+        bloom_bits = self.bloom.num_bits if self.bloom is not None else 0
+        bloom_hashes = self.bloom.num_hashes if self.bloom is not None else 0
+        self._HEADER.pack_into(self._buf, 0, self.MAGIC, self.capacity, self.size,
+                               bloom_bits, bloom_hashes)
+        tmp_file = save_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(self._buf)
+            if self.bloom is not None:
+                f.write(self.bloom.bits)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp_file, save_file)
+    
+    def load(self, save_file, bloom_bits=0):
+        """Loads a table saved by save(), by mapping the file.
+        
+        @keyword bloom_bits: Size of the Bloom filter to build if the save
+                file does not have one, 0 for none.
+        
+        """
+        with open(save_file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, capacity, size, saved_bloom_bits, bloom_hashes = \
+            self._HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC:
+            mm.close()
+            raise ValueError('%s is not a dup store file' % save_file)
+        self._close_mmap()
+        self._mmap = self._buf = mm
+        self.capacity, self.size = capacity, size
+        table_end = self._HEADER.size + capacity * self._SLOT.size
+        self.bloom = None
+        if saved_bloom_bits:
+            self.bloom = BloomFilter(saved_bloom_bits, bloom_hashes,
+                                     bytearray(mm[table_end:]))
+        # The labels (duplicates) are loaded from the report (dups.csv).
+        self.labels = {}
+        if bloom_bits and self.bloom is None:
+            self.bloom = BloomFilter(bloom_bits)
+            for i in xrange(capacity):
+                fp = self._SLOT.unpack_from(mm, self._HEADER.size + i * self._SLOT.size)[0]
+                if fp:
+                    self.bloom.add(fp)
+
+
+class UrlCanonicalizer(object):
+    
+    """Rewrites URLs to a canonical form, so variants of the same page are
+    only loaded once.
+    
+    By default: lower cases the scheme and host, drops default ports, empty
+    fragments, index files (eg: index.html) and tracking/session parameters
+    (eg: utm_*, jsessionid), and sorts the query parameters.  Fragments
+    are kept, they are the sections handled by ItemMgr.check_dup().
+    
+    Rules files have one rule per line ('#' starts a comment):
+        strip-param <GLOB>              Also strip parameters matching GLOB.
+        keep-param <GLOB>               Do not strip parameters matching GLOB.
+        sort-params <on|off>            Sort the query parameters.
+        index-file <NAME>               Also drop NAME at the end of paths.
+        rewrite <REGEX> <REPLACEMENT>   re.sub() on the canonical URL, eg
+                                        for per site rules.
+    
+    """
+    
+    STRIP_PARAMS = ['utm_*', 'gclid', 'fbclid', 'msclkid', 'mc_cid', 'mc_eid',
+                    '_ga', '_gl', 'jsessionid', 'phpsessid', 'aspsessionid*',
+                    'sessionid', 'sid']
+    INDEX_FILES = ['index.html', 'index.htm', 'index.php', 'index.jsp',
+                   'default.aspx', 'default.asp', 'default.htm']
+    DEFAULT_PORTS = {'http':'80', 'https':'443'}
+    _path_session_re = re.compile(r';(jsessionid|phpsessid|sid)=[^/?#]*', re.I)
+    
+    def __init__(self, rules_file=None):
+        """Constructs a URL Canonicalizer instance.
+        
+        @keyword rules_file: A rules file to load.
+        
+        """
+        self.strip_params = list(self.STRIP_PARAMS)
+        self.keep_params = []
+        self.sort_params = True
+        self.index_files = list(self.INDEX_FILES)
+        # [(compiled regex, replacement), ...]
+        self.rewrites = []
+        if rules_file:
+            self.load_rules(rules_file)
+        self._compile()
+    
+    def load_rules(self, rules_file):
+        """Loads a rules file (see class doc)."""
+        with codecs.open(rules_file, encoding='utf-8') as f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                rule, _, arg = line.partition(' ')
+                arg = arg.strip()
+                if rule == 'strip-param':
+                    self.strip_params.append(arg.lower())
+                elif rule == 'keep-param':
+                    self.keep_params.append(arg.lower())
+                elif rule == 'sort-params':
+                    self.sort_params = arg.lower() in ('on', 'true', 'yes', '1')
+                elif rule == 'index-file':
+                    self.index_files.append(arg.lower())
+                elif rule == 'rewrite':
+                    regex, _, replacement = arg.partition(' ')
+                    self.rewrites.append((re.compile(regex), replacement.strip()))
+                else:
+                    raise ValueError('%s:%s: Unknown rule: %s' % (rules_file, n, line))
+        self._compile()
+    
+    def _compile(self):
+        glob_re = lambda globs: re.compile(
+            '|'.join('(?:%s)' % fnmatch.translate(g) for g in globs) or '(?!)')
+        self._strip_re = glob_re(self.strip_params)
+        self._keep_re = glob_re(self.keep_params)
+        self._index_re = re.compile(
+            r'/(?:%s)$' % '|'.join(re.escape(x) for x in self.index_files), re.I)
+    
+    def _keep_param(self, param):
+        name = urllib2.unquote(param.split('=', 1)[0].replace('+', ' ')).lower()
+        return bool(self._keep_re.match(name) or not self._strip_re.match(name))
+    
+    def canonicalize(self, url):
+        """Returns the canonical form of an absolute URL.
+        
+        @param url: The URL.
+        
+        """
+        try:
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        except ValueError:
+            return url
+        scheme = scheme.lower()
+        if scheme not in self.DEFAULT_PORTS:
+            return url
+        # Host is case insensitive, user info is not.
+        userinfo, _, host = netloc.rpartition('@')
+        host = host.lower().rstrip('.')
+        if host.endswith(':' + self.DEFAULT_PORTS[scheme]):
+            host = host.rsplit(':', 1)[0]
+        netloc = userinfo + '@' + host if userinfo else host
+        path = self._index_re.sub('/', self._path_session_re.sub('', path))
+        params = [x for x in query.split('&') if x and self._keep_param(x)]
+        if self.sort_params:
+            params.sort()
+        if not fragment:
+            # Sections need the '/' (eg: '/#section'), empty fragments are
+            # dropped by urlunsplit().
+            path = path.rstrip('/')
+        url = urlparse.urlunsplit((scheme, netloc, path, '&'.join(params), fragment))
+        for regex, replacement in self.rewrites:
+            url = regex.sub(replacement, url)
+        return url
+
+
+class ScopeMatcher(object):
+    
+    """Decides if URLs are in the crawl scope.
+    
+    Allowed domains are kept in a suffix trie of host labels, so a domain
+    allows itself and all its sub-domains.  Sub URL constraints (must all
+    appear in the URL), include regexes (one must match) and exclude
+    regexes (none may match) are compiled into a single regex.
+    
+    Decisions per scheme and host are memoized in an LRU cache, get_tld()
+    (URL validity) and the trie are only used on cache misses.
+    
+    """
+    
+    # Decisions.
+    IN_SCOPE = None
+    INVALID = 'invalid'
+    NON_DOMAIN = 'non_domain'
+    # Trie node key marking the end of an allowed domain.
+    _END = ''
+    _origin_re = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:(?://[^/?#]*)?')
+    
+    def __init__(self, allowed_domains, sub_urls=None, include=None,
+                 exclude=None, cache_size=10000):
+        """Constructs a Scope Matcher instance.
+        
+        @param allowed_domains: List of allowed domains.
+        @keyword sub_urls: List of strings that must all appear in the URL.
+        @keyword include: List of regexes, one must match the URL.
+        @keyword exclude: List of regexes, none may match the URL.
+        @keyword cache_size: Max number of host decisions to cache.
+        
+        """
+        self.trie = {}
+        for domain in allowed_domains:
+            node = self.trie
+            for label in reversed(domain.lower().strip('.').split('.')):
+                node = node.setdefault(label, {})
+            node[self._END] = True
+        # Patterns are searched anywhere in the URL, as re.search() would.
+        lookaheads = ['(?=.*?%s)' % re.escape(x) for x in sub_urls or []]
+        if include:
+            lookaheads.append('(?=.*?(?:%s))' % '|'.join('(?:%s)' % x for x in include))
+        if exclude:
+            lookaheads.append('(?!.*?(?:%s))' % '|'.join('(?:%s)' % x for x in exclude))
+        self.url_re = re.compile(''.join(lookaheads), re.S) if lookaheads else None
+        # self.cache = {'scheme://host': decision, ...}
+        self.cache = {}
+        self.cache_size = cache_size
+        # Last use of the cached decisions, for evicting the least
+        # recently used ones in batches.
+        self._used = {}
+        self._clock = itertools.count()
+        self.lock = threading.Lock()
+    
+    def allowed_host(self, host):
+        """Checks if a host is an allowed domain or one of its sub-domains."""
+        node = self.trie
+        for label in reversed(host.split('.')):
+            if self._END in node:
+                return True
+            node = node.get(label)
+            if node is None:
+                return False
+        return self._END in node
+    
+    def _decide(self, url, origin):
+        try:
+            get_tld(url)
+        except Exception:
+            return self.INVALID
+        netloc = origin.partition('//')[2]
+        host = netloc.rpartition('@')[2].split(':')[0].rstrip('.')
+        if not self.allowed_host(host):
+            return self.NON_DOMAIN
+        return self.IN_SCOPE
+    
+    def _evict(self):
+        with self.lock:
+            excess = len(self.cache) - self.cache_size
+            if excess <= 0:
+                return
+            # Make room for a quarter of the cache at once.
+            used = self._used.items()
+            for key, _ in heapq.nsmallest(excess + self.cache_size // 4, used,
+                                          key=lambda x: x[1]):
+                self.cache.pop(key, None)
+                self._used.pop(key, None)
+    
+    def check(self, url):
+        """Checks if a URL is in scope.
+        
+        @param url: The absolute URL.
+        @return: IN_SCOPE (None), INVALID or NON_DOMAIN.
+        
+        """
+        m = self._origin_re.match(url)
+        origin = m.group(0).lower() if m else ''
+        decision = self.cache.get(origin, False)
+        if decision is False:
+            decision = self.cache[origin] = self._decide(url, origin)
+            if len(self.cache) > self.cache_size:
+                self._evict()
+        self._used[origin] = next(self._clock)
+        if decision is not self.IN_SCOPE:
+            return decision
+        if self.url_re is not None and not self.url_re.match(url):
+            return self.NON_DOMAIN
+        return self.IN_SCOPE
+
+
+class ContentIndex(object):
+    
+    """Index of the page contents captured, to find duplicate pages.
+    
+    Pages are fingerprinted by their visible text: a SHA-1 for exact
+    duplicates, and a 64-bit simhash of word shingles for near duplicates.
+    Simhashes are split into 4 bands of 16 bits, a simhash within
+    max_distance (< 4) bits of another one has at least one equal band.
+    
+    """
+    
+    # Pages with less words are not fingerprinted (eg: pages rendered by
+    # javascript, which all look alike).
+    MIN_WORDS = 50
+    _BANDS = 4
+    _BAND_BITS = 16
+    _skip_re = re.compile(r'<(script|style|noscript|template)\b.*?</\1\s*>|<!--.*?-->',
+                          re.I | re.S)
+    _tag_re = re.compile(r'<[^>]*>')
+    _word_re = re.compile(r'\w+', re.U)
+    
+    def __init__(self, max_distance=3):
+        """Constructs a Content Index instance.
+        
+        @keyword max_distance: Max simhash bits differing for near duplicates.
+        
+        """
+        self.max_distance = max_distance
+        # self.records = [[sha1, simhash, url, onclick_id, file], ...]
+        self.records = []
+        self.sha1s = {}
+        # self.bands = [{band value: [record index, ...]}, ...]
+        self.bands = [{} for _ in range(self._BANDS)]
+    
+    def __len__(self):
+        return len(self.records)
+    
+    @classmethod
+    def fingerprint(cls, page_source):
+        """Fingerprints a page.
+        
+        @param page_source: The HTML page source.
+        @return: (sha1, simhash), or None if the page has too little text.
+        
+        """
+        if not page_source:
+            return None
+        text = cls._tag_re.sub(' ', cls._skip_re.sub(' ', page_source))
+        words = cls._word_re.findall(text.lower())
+        if len(words) < cls.MIN_WORDS:
+            return None
+        sha1 = hashlib.sha1(u' '.join(words).encode('utf-8')).hexdigest()
+        counts = [0] * 64
+        shingles = set(u' '.join(words[i:i+3]) for i in range(len(words) - 2))
+        for shingle in shingles:
+            h = struct.unpack('<Q', hashlib.md5(shingle.encode('utf-8')).digest()[:8])[0]
+            for bit in range(64):
+                if h >> bit & 1:
+                    counts[bit] += 1
+        half = len(shingles) / 2.0
+        simhash = 0
+        for bit in range(64):
+            if counts[bit] > half:
+                simhash |= 1 << bit
+        return sha1, simhash
+    
+    def _band_values(self, simhash):
+        mask = (1 << self._BAND_BITS) - 1
+        return [simhash >> (i * self._BAND_BITS) & mask for i in range(self._BANDS)]
+    
+    def add(self, sha1, simhash, url, onclick_id, filepath):
+        """Adds a captured page."""
+        index = len(self.records)
+        self.records.append([sha1, simhash, url, onclick_id, filepath])
+        self.sha1s.setdefault(sha1, index)
+        for band, value in zip(self.bands, self._band_values(simhash)):
+            band.setdefault(value, []).append(index)
+    
+    def find(self, sha1, simhash):
+        """Finds a captured page with the same or near content.
+        
+        @return: (record, distance), distance is None for exact duplicates,
+                or None if not found.
+        
+        """
+        if sha1 in self.sha1s:
+            return self.records[self.sha1s[sha1]], None
+        best = None
+        for band, value in zip(self.bands, self._band_values(simhash)):
+            for index in band.get(value, ()):
+                distance = bin(self.records[index][1] ^ simhash).count('1')
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (self.records[index], distance)
+        return best
+
+
+class StageTimer(object):
+    
+    """Records where the time goes when Items are processed.
+    
+    The stages of an Item (see STAGES) are timed on the thread processing
+    it, between begin() and end(), then written as a JSON line to the save
+    file: url, onclick_id, level, phase ("capture" when the Item is
+    loaded and exported, "links" when its links are collected), total and
+    the secs of each stage.  Stages nested in another stage are not counted
+    in the outer stage, Items processed within another Item are not
+    counted in its total.
+    
+    """
+    
+    STAGES = ('navigate', 'wait', 'onclick', 'links', 'scope', 'tiles', 'stitch',
+              'encode', 'write', 'download_wait', 'checkpoint')
+    
+    def __init__(self, save_file=None):
+        """Constructs a Stage Timer instance.
+        
+        @keyword save_file: The JSON lines file to append the timings to.
+        
+        """
+        self.save_file = save_file
+        self.lock = threading.Lock()
+        # self.samples = {stage: array of secs}, for the summary.
+        self.samples = dict((x, array.array('d')) for x in self.STAGES + ('total',))
+        self.pages = 0
+        self.start_time = time.time()
+        self._file = None
+    
+    def begin(self, item, level, phase='capture'):
+        """Starts timing an Item on the calling thread.
+        
+        @return: The timing to pass to end(), or None if the Item is being
+                timed already.
+        
+        """
+        timings = getattr(_thread_local, 'timings', None)
+        if timings is None:
+            timings = _thread_local.timings = []
+        elif timings and timings[-1].item is item and timings[-1].phase == phase:
+            return None
+        timing = _Timing(item, level, phase)
+        timings.append(timing)
+        return timing
+    
+    def end(self, timing):
+        """Stops timing an Item and records its timings."""
+        if timing is None:
+            return
+        timings = _thread_local.timings
+        timings.remove(timing)
+        elapsed = time.time() - timing.start
+        if timings:
+            timings[-1].nested += elapsed
+        item = timing.item
+        row = {'url':item.url,
+               'onclick_id':item.onclick_id,
+               'level':timing.level,
+               'phase':timing.phase,
+               'total':round(elapsed - timing.nested, 4)}
+        for stage, secs in timing.stages.iteritems():
+            row[stage] = round(secs, 4)
+        with self.lock:
+            if timing.phase == 'capture':
+                self.pages += 1
+                self.samples['total'].append(elapsed - timing.nested)
+            for stage, secs in timing.stages.iteritems():
+                self.samples[stage].append(secs)
+            if self.save_file:
+                if self._file is None:
+                    self._file = open(self.save_file, 'ab')
+                self._file.write(json.dumps(row) + '\n')
+    
+    def flush(self):
+        """Flushes the save file."""
+        with self.lock:
+            if self._file is not None:
+                self._file.flush()
+    
+    def summary(self):
+        """Returns [(stage, count, p50, p95, max, total secs), ...] of the
+        stages timed, and the Items captured per minute.
+        
+        """
+        rows = []
+        with self.lock:
+            for stage in self.STAGES + ('total',):
+                samples = sorted(self.samples[stage])
+                if not samples:
+                    continue
+                rows.append((stage, len(samples), percentile(samples, 0.5),
+                             percentile(samples, 0.95), samples[-1], sum(samples)))
+            minutes = (time.time() - self.start_time) / 60.0
+            pages_per_min = self.pages / minutes if minutes else 0.0
+        return rows, pages_per_min
+
+
+class _Timing(object):
+    
+    """The timing of an Item in progress (see StageTimer)."""
+    
+    __slots__ = ('item', 'level', 'phase', 'start', 'nested', 'stages', 'stage', 'stage_start')
+    
+    def __init__(self, item, level, phase):
+        self.item = item
+        self.level = level
+        self.phase = phase
+        self.start = time.time()
+        self.nested = 0.0
+        # self.stages = {stage: secs}
+        self.stages = {}
+        self.stage = None
+        self.stage_start = None
+    
+    def _add(self, now):
+        self.stages[self.stage] = self.stages.get(self.stage, 0.0) + now - self.stage_start
+
+
+class _Stage(object):
+    
+    """Times a stage of the Item timed on the calling thread (see timed())."""
+    
+    __slots__ = ('name', 'timing', 'outer')
+    
+    def __init__(self, name):
+        self.name = name
+        timings = getattr(_thread_local, 'timings', None)
+        self.timing = timings[-1] if timings else None
+    
+    def __enter__(self):
+        timing = self.timing
+        if timing is None:
+            return
+        now = time.time()
+        self.outer = timing.stage
+        if timing.stage is not None:
+            # Paused while the inner stage runs.
+            timing._add(now)
+        timing.stage = self.name
+        timing.stage_start = now
+    
+    def __exit__(self, *exc_info):
+        timing = self.timing
+        if timing is None:
+            return
+        now = time.time()
+        timing._add(now)
+        timing.stage = self.outer
+        timing.stage_start = now
+
+
 class ItemMgr(object):
     
-    """Manages items and progress."""
+    """Manages items and progress.
+    
+    Progress is saved as a snapshot (the csv save files) plus an append-only
+    journal of the changes made since the snapshot.  Checkpoints only flush
+    the journal, the snapshot is rewritten (compacted) once the journal gets
+    long, and on save().
+    
+    """
+    
+    # URL counters by kind: (count attribute, urls attribute).
+    _URL_COUNTERS = {'invalid':('invalid_cnt','invalid_urls'),
+                     'non_domain':('non_domain_cnt','non_domain_urls'),
+                     'timeout':('timeout_cnt','timeout_urls'),
+                     'error':('error_cnt','error_urls')}
     
     def __init__(self, output_dir):
         self.output_dir = output_dir
@@ -114,9 +984,33 @@ class ItemMgr(object):
         self.cnt = 0
         self.items = {}
         self.items_save_file = os.path.join(output_dir,'items.csv')
+        # Next level links of the items that have not generated next yet,
+        # so resuming does not reload their pages.
+        self.links_save_file = os.path.join(output_dir,'links.jsonl')
         self.dup_cnt = 0
-        self.dup_urls = {}
+        self.dups = DupStore()
         self.dups_save_file = os.path.join(output_dir,'dups.csv')
+        self.dups_table_file = os.path.join(output_dir,'dups.bin')
+        # Size of the dups Bloom filter in bits, 0 for none.
+        self.dups_bloom_bits = 0
+        # Duplicates found by URL canonicalization (URLs as found that
+        # canonicalized to a URL already seen), kept without a store of
+        # the raw URLs so a raw URL found again is counted again.
+        self.canon_saved_cnt = 0
+        # Page contents captured, and the pages skipped as duplicate content.
+        self.content = ContentIndex()
+        self.content_save_file = os.path.join(output_dir,'content.csv')
+        self.content_dup_cnt = 0
+        # [[url, onclick_id, match, distance, original_url, original_onclick_id,
+        #   original_file, file], ...]
+        self.content_dups = []
+        self.content_dups_save_file = os.path.join(output_dir,'content_dups.csv')
+        # Downloads moved by the DownloadTracker or written by the Downloader.
+        # [[file, url, onclick_id, level, size, secs, sha256], ...]
+        self.downloads = []
+        self.downloads_save_file = os.path.join(output_dir,'downloads.csv')
+        # Stage timings of the Items processed by this run.
+        self.timer = StageTimer(os.path.join(output_dir,'timings.jsonl'))
         self.invalid_cnt = 0
         self.invalid_urls = {}
         self.invalids_save_file = os.path.join(output_dir,'invalids.csv')
@@ -129,84 +1023,372 @@ class ItemMgr(object):
         self.error_cnt = 0
         self.error_urls = {}
         self.errors_save_file = os.path.join(output_dir,'errors.csv')
+        self.journal_file = os.path.join(output_dir,'journal.jsonl')
+        self._journal = None
+        self._journal_events = 0
+        # Checkpoint after this many documents or secs, whichever is first.
+        self.save_every = 25
+        self.save_secs = 60
+        # Compact the journal into the snapshot after this many events.
+        self.compact_every = 50000
+        self._last_save_cnt = 0
+        self._last_save_time = time.time()
+        # (url, onclick_id) pairs claimed by check_dup() that are still
+        # being captured.  These are not saved as dups, so a resumed crawl
+        # will collect them again.
+        self.pending = set()
+        # Guards all counters and containers when using worker threads.
+        self.lock = threading.RLock()
         self.logfile = logfile
         self._TAG = self.__class__.__name__
+
+    def reserve_cnt(self):
+        """Reserves the next document number.
+
+        @return: The document number to use for output filenames.
+
+        """
+        with self.lock:
+            cnt = self.cnt
+            self.cnt += 1
+            self._log_event(['cnt', self.cnt])
+            return cnt
+
+    def _count_url(self, kind, url):
+        cnt_attr, urls_attr = self._URL_COUNTERS[kind]
+        with self.lock:
+            urls = getattr(self, urls_attr)
+            setattr(self, cnt_attr, getattr(self, cnt_attr) + 1)
+            urls[url] = urls.get(url, 0) + 1
+            self._log_event(['url', kind, url, urls[url], getattr(self, cnt_attr)])
+            return urls[url]
+
+    def add_invalid(self, url):
+        """Records an invalid URL.
+
+        @return: The number of times the URL was recorded.
+
+        """
+        return self._count_url('invalid', url)
+
+    def add_non_domain(self, url):
+        """Records a non domain URL.
+
+        @return: The number of times the URL was recorded.
+
+        """
+        return self._count_url('non_domain', url)
+
+    def add_timeout(self, url):
+        """Records a URL that timed out.
+
+        @return: The number of times the URL was recorded.
+
+        """
+        return self._count_url('timeout', url)
+
+    def add_error(self, url):
+        """Records a URL (or file) that errored.
+
+        @return: The number of times the URL was recorded.
+
+        """
+        return self._count_url('error', url)
+
+    def add_item(self, item, level):
+        """Appends an Item to the items of the level."""
+        with self.lock:
+            items = self.items.setdefault(str(level), [])
+            item.index = len(items)
+            items.append(item)
+            self._log_item(item)
+            if item.next_level_links is not None:
+                self._log_event(['links', str(level), item.index, item.next_level_links])
+
+    def update_item(self, item):
+        """Records changes made to an Item (eg: processed, generated_next)."""
+        with self.lock:
+            if item.index is not None:
+                self._log_item(item)
+
+    def _log_item(self, item):
+        self._log_event(['item', str(item.level), item.index] + self.item_row(item)[1:])
+
+    def _set_dup(self, url, onclick_id, cnt, sec_cnt):
+        self.dups.set(url, onclick_id, cnt, sec_cnt)
+        self._log_dup(url, onclick_id)
+
+    def _incr_dup(self, url, onclick_id, sec=False):
+        counters = self.dups.incr(url, onclick_id, sec=sec)
+        self.dup_cnt += 1
+        self._log_dup(url, onclick_id)
+        return counters
+
+    def _log_dup(self, url, onclick_id):
+        if (url, onclick_id) not in self.pending:
+            cnt, sec_cnt = self.dups.get(url, onclick_id)
+            self._log_event(['dup', url, onclick_id, cnt, sec_cnt, self.dup_cnt])
+
+    def check_dup(self, item):
+        """Checks if an Item's URL is a duplicate.
+
+        URLs not seen before are claimed (added to dups and pending)
+        so no other worker collects them.  Call finish() once the Item
+        has been collected.
+
+        Sections (base URL plus '/#fragment') are duplicates of the base
+        URL if the base URL was already seen.
+
+        @param item: The Item object.
+        @return: True if duplicate, False otherwise.
+
+        """
+        url, onclick_id = item.url, item.onclick_id
+        # Check for sections.
+        try:
+            (base_url,section) = re.search(r'(.*)/([#][^/]+)$',url).groups()
+        except AttributeError:
+            (base_url,section) = None,None
+        with self.lock:
+            if (url, onclick_id) in self.dups:
+                counters = self._incr_dup(url, onclick_id)
+                log('INFO',self.logfile,'DUPLICATE URL FOUND (cnt=%s,sec_cnt=%s): %s' %
+                    (counters + (item,)))
+                if item.raw_url:
+                    # The URL as found differs from the canonical one
+                    # already seen.
+                    self.canon_saved_cnt += 1
+                    self._log_event(['canon', self.canon_saved_cnt])
+                return True
+            if section:
+                if (base_url, onclick_id) in self.dups:
+                    # Add full url to dups.
+                    self._set_dup(url, onclick_id, 0, 0)
+                    # Then increment section counter of base_url.
+                    counters = self._incr_dup(base_url, onclick_id, sec=True)
+                    log('INFO',self.logfile,'DUPLICATE URL SECTION FOUND (cnt=%s,sec_cnt=%s): %s' %
+                        (counters + (item,)))
+                    return True
+                self._set_dup(base_url, onclick_id, 0, 0)
+            self.pending.add((url, onclick_id))
+            self._set_dup(url, onclick_id, 0, 0)
+            return False
+
+    def add_download(self, row):
+        """Records a download moved to the output directory.
+        
+        @param row: [file, url, onclick_id, level, size, secs, sha256],
+                file is relative to the output dir, secs since the download
+                started.
+        
+        """
+        with self.lock:
+            self.downloads.append(row)
+            self._log_event(['download'] + row)
+
+    def check_content(self, item, filepath):
+        """Checks if an Item's page content was already captured.
+        
+        Pages not captured before are added to the content index.
+        
+        @param item: The Item object, with its fingerprint (or page_source).
+        @param filepath: The capture's file, relative to the output dir.
+        @return: The original capture record [sha1, simhash, url,
+                onclick_id, file] if duplicate, None otherwise.
+        
+        """
+        fingerprint = item.fingerprint
+        if fingerprint is None and item.page_source:
+            fingerprint = ContentIndex.fingerprint(item.page_source)
+        if fingerprint is None:
+            return None
+        with self.lock:
+            match = self.content.find(*fingerprint)
+            if match is None:
+                record = list(fingerprint) + [item.url, item.onclick_id, filepath]
+                self.content.add(*record)
+                self._log_event(['content'] + record)
+                return None
+            original, distance = match
+            if original[2:4] == [item.url, item.onclick_id]:
+                # Captured before a crash, capture again.
+                return None
+            row = [item.url, item.onclick_id, 'near' if distance is not None else 'exact',
+                   distance] + original[2:] + [filepath]
+            self.content_dups.append(row)
+            self.content_dup_cnt += 1
+            self._log_event(['content_dup'] + row)
+            log('INFO',self.logfile,'DUPLICATE CONTENT FOUND (%s, distance=%s): %s, same as %s' %
+                (row[2], distance, item, original[2]))
+            return original
+
+    def finish(self, item):
+        """Marks an Item claimed by check_dup() as collected."""
+        with self.lock:
+            self.pending.discard((item.url, item.onclick_id))
+            self._log_dup(item.url, item.onclick_id)
+
+    def _log_event(self, event):
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'ab')
+        self._journal.write(json.dumps(event) + '\n')
+        self._journal_events += 1
+
+    def maybe_save(self):
+        """Checkpoints progress every save_every documents or save_secs secs."""
+        with self.lock:
+            if (self.cnt - self._last_save_cnt >= self.save_every or
+                time.time() - self._last_save_time >= self.save_secs):
+                with timed('checkpoint'):
+                    self.checkpoint()
+
+    def checkpoint(self):
+        """Makes the progress so far durable.
+
+        Flushes the journal, and compacts it into the snapshot if it has
+        gotten long.
+
+        """
+        with self.lock:
+            self._last_save_cnt = self.cnt
+            self._last_save_time = time.time()
+            if self._journal_events >= self.compact_every:
+                self._save()
+            elif self._journal is not None:
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self.timer.flush()
     
     def save(self):
         """Saves progress.
         
         This enables resume capability if crawler was to stop prematurely.
+        Writes a new snapshot and truncates the journal.
         
         """
+        with self.lock:
+            self._save()
+
+    def _save(self):
         log('INFO',self.logfile,'SAVING TO SAVE FILES...',TAG=self._TAG)
-        with open(self.items_save_file,'w') as f:
-            csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
-            # Write the count first, then the header.
-            self.writerow(csv_writer, ['COUNT',self.cnt])
-            header = ['LEVEL','TITLE','URL','REFERRER','RESPONSE','ONCLICK_ID','PDF_EXPORT_LINK','PROCESSED','GENERATED_NEXT']
-            self.writerow(csv_writer, header)
-            for k in sorted(self.items.keys()):
-                v = self.items[k]
-                for item in v:
-                    row = [item.level,item.title,item.url,item.referrer,
-                           item.response,item.onclick_id,item.pdf_export_link,
-                           item.processed,item.generated_next]
-                    self.writerow(csv_writer, row)
-        with open(self.dups_save_file,'w') as f:
-            csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
-            # Write the count first, then the header.
-            self.writerow(csv_writer, ['DUP_COUNT',self.dup_cnt])
-            header = ['URL','ONCLICK_ID','COUNT','DUP_SEC_CNT']
-            self.writerow(csv_writer, header)
-            for k in sorted(self.dup_urls.keys()):
-                v = self.dup_urls[k]
-                for k2 in sorted(v):
-                    v2 = v[k2]
-                    row = [k,k2,v2['cnt'],v2['sec_cnt']]
-                    self.writerow(csv_writer, row)
-        with open(self.invalids_save_file,'w') as f:
-            csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
-            # Write the count first, then the header.
-            self.writerow(csv_writer, ['INVALID_COUNT',self.invalid_cnt])
-            header = ['URL','COUNT']
-            self.writerow(csv_writer, header)
-            for k,v in self.invalid_urls.iteritems():
-                row = [k,v]
-                self.writerow(csv_writer, row)
-        with open(self.non_domain_save_file,'w') as f:
-            csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
-            # Write the count first, then the header.
-            self.writerow(csv_writer, ['NON_DOMAIN_COUNT',self.non_domain_cnt])
-            header = ['URL','COUNT']
-            self.writerow(csv_writer, header)
-            for k,v in self.non_domain_urls.iteritems():
-                row = [k,v]
-                self.writerow(csv_writer, row)
-        with open(self.timeout_save_file,'w') as f:
-            csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
-            # Write the count first, then the header.
-            self.writerow(csv_writer, ['TIMEOUT_COUNT',self.timeout_cnt])
-            header = ['URL','COUNT']
-            self.writerow(csv_writer, header)
-            for k,v in self.timeout_urls.iteritems():
-                row = [k,v]
-                self.writerow(csv_writer, row)
-        with open(self.errors_save_file,'w') as f:
+        self._last_save_cnt = self.cnt
+        self._last_save_time = time.time()
+        self.timer.flush()
+        header = ['LEVEL','TITLE','URL','REFERRER','RESPONSE','ONCLICK_ID','PDF_EXPORT_LINK','PROCESSED','GENERATED_NEXT']
+        self.write_snapshot(self.items_save_file, ['COUNT',self.cnt], header,
+                            (self.item_row(item)
+                             for k in sorted(self.items.keys())
+                             for item in self.items[k]))
+        self.write_lines(self.links_save_file,
+                         ([k, item.index, item.next_level_links]
+                          for k in sorted(self.items.keys())
+                          for item in self.items[k]
+                          if item.next_level_links is not None
+                          and not item.generated_next))
+        # The dups table holds every seen URL, dups.csv only reports the
+        # duplicates.  Pending URLs are left out of both.
+        pending = [(url, onclick_id, self.dups.get(url, onclick_id))
+                   for url, onclick_id in self.pending]
+        for url, onclick_id, _ in pending:
+            self.dups.remove(url, onclick_id)
+        self.dups.save(self.dups_table_file)
+        self.write_snapshot(self.dups_save_file,
+                            ['DUP_COUNT',self.dup_cnt,'CANON_SAVED',self.canon_saved_cnt],
+                            ['URL','ONCLICK_ID','COUNT','DUP_SEC_CNT'],
+                            sorted(self.dups.iter_dups()))
+        for url, onclick_id, counters in pending:
+            self.dups.set(url, onclick_id, *counters)
+        for kind,save_file in [('invalid',self.invalids_save_file),
+                               ('non_domain',self.non_domain_save_file),
+                               ('timeout',self.timeout_save_file),
+                               ('error',self.errors_save_file)]:
+            cnt_attr, urls_attr = self._URL_COUNTERS[kind]
+            self.write_snapshot(save_file, [cnt_attr.upper(),getattr(self,cnt_attr)],
+                                ['URL','COUNT'],
+                                ([k,v] for k,v in getattr(self,urls_attr).iteritems()))
+        self.write_snapshot(self.content_save_file, ['CONTENT_COUNT',len(self.content)],
+                            ['SHA1','SIMHASH','URL','ONCLICK_ID','FILE'],
+                            self.content.records)
+        self.write_snapshot(self.content_dups_save_file,
+                            ['CONTENT_DUP_COUNT',self.content_dup_cnt],
+                            ['URL','ONCLICK_ID','MATCH','DISTANCE','ORIGINAL_URL',
+                             'ORIGINAL_ONCLICK_ID','ORIGINAL_FILE','FILE'],
+                            self.content_dups)
+        self.write_snapshot(self.downloads_save_file, ['DOWNLOAD_COUNT',len(self.downloads)],
+                            ['FILE','URL','ONCLICK_ID','LEVEL','SIZE','SECS','SHA256'],
+                            self.downloads)
+        # Everything is in the snapshot now, start a new journal.
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_file, 'wb')
+        self._journal_events = 0
+
+    def item_row(self, item):
+        """Returns the save file row of an Item."""
+        return [item.level,item.title,item.url,item.referrer,
+                item.response,item.onclick_id,item.pdf_export_link,
+                item.processed,item.generated_next]
+
+    def write_snapshot(self, save_file, count_row, header, rows):
+        """Writes a save file atomically.
+
+        The rows are written to a temporary file which then replaces the
+        save file, so a crash never leaves a partially written save file.
+
+        @param save_file: The save file.
+        @param count_row: The first row, with the count.
+        @param header: The header row.
+        @param rows: The rows.
+
+        """
+        tmp_file = save_file + '.tmp'
+        with open(tmp_file,'w') as f:
             csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
             # Write the count first, then the header.
-            self.writerow(csv_writer, ['ERROR_COUNT',self.error_cnt])
-            header = ['URL','COUNT']
+            self.writerow(csv_writer, count_row)
             self.writerow(csv_writer, header)
-            for k,v in self.non_domain_urls.iteritems():
-                row = [k,v]
+            for row in rows:
                 self.writerow(csv_writer, row)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp_file, save_file)
+
+    def write_lines(self, save_file, events):
+        """Writes a JSON lines save file atomically (see write_snapshot()).
+        
+        @param save_file: The save file.
+        @param events: The JSON serializable lines.
+        
+        """
+        tmp_file = save_file + '.tmp'
+        with open(tmp_file,'wb') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp_file, save_file)
+
+    def _set_links(self, level, index, links):
+        items = self.items.get(level, [])
+        if index < len(items):
+            items[index].next_level_links = [Link(*x) for x in links]
+
+    def _snapshot_file(self, save_file):
+        """Returns the save file to load, None if there is none."""
+        if os.path.exists(save_file):
+            return save_file
+        # Crashed while replacing the save file (Windows).
+        if os.path.exists(save_file + '.tmp'):
+            return save_file + '.tmp'
+        return None
     
     def load(self):
-        """Loads from save files."""
-        if os.path.exists(self.items_save_file):
+        """Loads from save files, then replays the journal."""
+        items_save_file = self._snapshot_file(self.items_save_file)
+        if items_save_file:
             log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
-                                       self.items_save_file), TAG=self._TAG)
-            with open(self.items_save_file,'rb') as f:
+                                       items_save_file), TAG=self._TAG)
+            with open(items_save_file,'rb') as f:
                 csv_reader = csv.reader(f, delimiter=',', quotechar='"')
                 # Assume first line is count, then header.
                 try:
@@ -226,14 +1408,33 @@ class ItemMgr(object):
                         self.items[level].append(item)
                     else:
                         self.items[level] = [item]
-        if os.path.exists(self.dups_save_file):
+                    item.index = len(self.items[level]) - 1
+        links_save_file = self._snapshot_file(self.links_save_file)
+        if links_save_file:
             log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
-                                       self.dups_save_file), TAG=self._TAG)
-            with open(self.dups_save_file,'rb') as f:
+                                       links_save_file), TAG=self._TAG)
+            with open(links_save_file,'rb') as f:
+                for line in f:
+                    self._set_links(*json.loads(line))
+        dups_table_file = self._snapshot_file(self.dups_table_file)
+        if dups_table_file:
+            log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
+                                       dups_table_file), TAG=self._TAG)
+            self.dups.load(dups_table_file, bloom_bits=self.dups_bloom_bits)
+        elif self.dups_bloom_bits:
+            self.dups = DupStore(bloom_bits=self.dups_bloom_bits)
+        dups_save_file = self._snapshot_file(self.dups_save_file)
+        if dups_save_file:
+            log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
+                                       dups_save_file), TAG=self._TAG)
+            with open(dups_save_file,'rb') as f:
                 csv_reader = csv.reader(f, delimiter=',', quotechar='"')
                 # Assume first line is count, then header.
                 try:
-                    self.dup_cnt = int(self.translate_row(csv_reader.next())[1])
+                    row = self.translate_row(csv_reader.next())
+                    self.dup_cnt = int(row[1])
+                    if len(row) > 3:
+                        self.canon_saved_cnt = int(row[3])
                 except Exception:
                     log('WARNING', self.logfile,
                         'Unable to read dup_cnt.\n' + traceback.format_exc(),
@@ -243,76 +1444,147 @@ class ItemMgr(object):
                     [url,onclick_id,count,sec_cnt] = self.translate_row(row)
                     if not onclick_id:
                         onclick_id = None
-                    if url in self.dup_urls:
-                        self.dup_urls[url].update({onclick_id:{'cnt':int(count),
-                                                               'sec_cnt':int(sec_cnt)}})
+                    if dups_table_file:
+                        # Counters come from the table, only label them.
+                        self.dups.labels[DupStore.fingerprint(url, onclick_id)] = (url, onclick_id)
                     else:
-                        self.dup_urls[url] = {onclick_id:{'cnt':int(count),
-                                                          'sec_cnt':int(sec_cnt)}}
-        if os.path.exists(self.invalids_save_file):
+                        self.dups.set(url, onclick_id, int(count), int(sec_cnt))
+        for kind,save_file in [('invalid',self.invalids_save_file),
+                               ('non_domain',self.non_domain_save_file),
+                               ('timeout',self.timeout_save_file),
+                               ('error',self.errors_save_file)]:
+            cnt_attr, urls_attr = self._URL_COUNTERS[kind]
+            save_file = self._snapshot_file(save_file)
+            if not save_file:
+                continue
             log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
-                                       self.invalids_save_file), TAG=self._TAG)
-            with open(self.invalids_save_file,'rb') as f:
+                                       save_file), TAG=self._TAG)
+            urls = getattr(self, urls_attr)
+            with open(save_file,'rb') as f:
                 csv_reader = csv.reader(f, delimiter=',', quotechar='"')
                 # Assume first line is count, then header.
                 try:
-                    self.invalid_cnt = int(self.translate_row(csv_reader.next())[1])
+                    setattr(self, cnt_attr, int(self.translate_row(csv_reader.next())[1]))
                 except Exception:
                     log('WARNING', self.logfile,
-                        'Unable to read invalid_cnt.\n' + traceback.format_exc(),
+                        ('Unable to read %s.\n' % cnt_attr) + traceback.format_exc(),
                         TAG=self._TAG)
                 csv_reader.next()
                 for row in csv_reader:
                     [url,count] = self.translate_row(row)
-                    self.invalid_urls[url] = int(count)
-        if os.path.exists(self.non_domain_save_file):
+                    urls[url] = int(count)
+        content_save_file = self._snapshot_file(self.content_save_file)
+        if content_save_file:
             log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
-                                       self.non_domain_save_file), TAG=self._TAG)
-            with open(self.non_domain_save_file,'rb') as f:
+                                       content_save_file), TAG=self._TAG)
+            with open(content_save_file,'rb') as f:
                 csv_reader = csv.reader(f, delimiter=',', quotechar='"')
                 # Assume first line is count, then header.
-                try:
-                    self.non_domain_cnt = int(self.translate_row(csv_reader.next())[1])
-                except Exception:
-                    log('WARNING', self.logfile,
-                        'Unable to read non_domain_cnt.\n' + traceback.format_exc(),
-                        TAG=self._TAG)
+                csv_reader.next()
                 csv_reader.next()
                 for row in csv_reader:
-                    [url,count] = self.translate_row(row)
-                    self.non_domain_urls[url] = int(count)
-        if os.path.exists(self.timeout_save_file):
+                    [sha1,simhash,url,onclick_id,filepath] = self.translate_row(row)
+                    self.content.add(sha1, int(simhash), url, onclick_id, filepath)
+        content_dups_save_file = self._snapshot_file(self.content_dups_save_file)
+        if content_dups_save_file:
             log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
-                                       self.timeout_save_file), TAG=self._TAG)
-            with open(self.timeout_save_file,'rb') as f:
+                                       content_dups_save_file), TAG=self._TAG)
+            with open(content_dups_save_file,'rb') as f:
                 csv_reader = csv.reader(f, delimiter=',', quotechar='"')
                 # Assume first line is count, then header.
                 try:
-                    self.timeout_cnt = int(self.translate_row(csv_reader.next())[1])
+                    self.content_dup_cnt = int(self.translate_row(csv_reader.next())[1])
                 except Exception:
                     log('WARNING', self.logfile,
-                        'Unable to read timeout_cnt.\n' + traceback.format_exc(),
+                        'Unable to read content_dup_cnt.\n' + traceback.format_exc(),
                         TAG=self._TAG)
                 csv_reader.next()
                 for row in csv_reader:
-                    [url,count] = self.translate_row(row)
-                    self.timeout_urls[url] = int(count)
-        if os.path.exists(self.errors_save_file):
+                    row = self.translate_row(row)
+                    if row[3] is not None:
+                        row[3] = int(row[3])
+                    # Saved before the FILE column.
+                    row += [None] * (8 - len(row))
+                    self.content_dups.append(row)
+        downloads_save_file = self._snapshot_file(self.downloads_save_file)
+        if downloads_save_file:
             log('INFO', self.logfile, ('FOUND SAVE FILE: %s, LOADING...' %
-                                       self.errors_save_file), TAG=self._TAG)
-            with open(self.errors_save_file,'rb') as f:
+                                       downloads_save_file), TAG=self._TAG)
+            with open(downloads_save_file,'rb') as f:
                 csv_reader = csv.reader(f, delimiter=',', quotechar='"')
                 # Assume first line is count, then header.
-                try:
-                    self.error_cnt = int(self.translate_row(csv_reader.next())[1])
-                except Exception:
-                    log('WARNING', self.logfile,
-                        'Unable to read error_cnt.\n' + traceback.format_exc(),
-                        TAG=self._TAG)
+                csv_reader.next()
                 csv_reader.next()
                 for row in csv_reader:
-                    [url,count] = self.translate_row(row)
-                    self.error_urls[url] = int(count)
+                    row = self.translate_row(row)
+                    row[3] = int(row[3])
+                    row[4] = int(row[4])
+                    if row[5] is not None:
+                        row[5] = float(row[5])
+                    self.downloads.append(row)
+        if os.path.exists(self.journal_file):
+            log('INFO', self.logfile, ('FOUND JOURNAL: %s, REPLAYING...' %
+                                       self.journal_file), TAG=self._TAG)
+            self.replay_journal()
+        # Links are only needed until the next level is generated.
+        for items in self.items.itervalues():
+            for item in items:
+                if item.generated_next:
+                    item.next_level_links = None
+
+    def replay_journal(self):
+        """Applies the journal events on top of the loaded snapshot.
+
+        Events hold absolute values, so replaying events already in the
+        snapshot is harmless.
+
+        """
+        with open(self.journal_file,'rb') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Partially written last event (crash).
+                    log('WARNING', self.logfile, 'Ignoring bad journal event: %r' % line,
+                        TAG=self._TAG)
+                    break
+                self._journal_events += 1
+                kind = event[0]
+                if kind == 'cnt':
+                    self.cnt = event[1]
+                elif kind == 'url':
+                    [kind, url, count, total] = event[1:]
+                    cnt_attr, urls_attr = self._URL_COUNTERS[kind]
+                    getattr(self, urls_attr)[url] = count
+                    setattr(self, cnt_attr, total)
+                elif kind == 'dup':
+                    [url, onclick_id, count, sec_cnt, self.dup_cnt] = event[1:]
+                    self.dups.set(url, onclick_id, count, sec_cnt)
+                elif kind == 'links':
+                    self._set_links(*event[1:])
+                elif kind == 'content':
+                    self.content.add(*event[1:])
+                elif kind == 'download':
+                    self.downloads.append(event[1:])
+                elif kind == 'content_dup':
+                    self.content_dups.append(event[1:] + [None] * (9 - len(event)))
+                    self.content_dup_cnt = len(self.content_dups)
+                elif kind == 'canon':
+                    self.canon_saved_cnt = event[1]
+                elif kind == 'item':
+                    item = Item()
+                    [level, index, item.title, item.url, item.referrer,
+                     item.response, item.onclick_id, item.pdf_export_link,
+                     item.processed, item.generated_next] = event[1:]
+                    item.level = int(level)
+                    items = self.items.setdefault(level, [])
+                    if index < len(items):
+                        item.index = index
+                        item.next_level_links = items[index].next_level_links
+                        items[index] = item
+                    else:
+                        item.index = len(items)
+                        items.append(item)
     
     def writerow(self, csv_writer, row):
         """Encode everything into UTF-8 before writing to csv.
@@ -353,14 +1625,22 @@ class ItemMgr(object):
         log('INFO',self.logfile,'')
         log('INFO',self.logfile, 'Processed %s documents.' % self.cnt)
         log('INFO',self.logfile, 'Number of Duplicates: %s' % self.dup_cnt)
-        if self.dup_urls:
+        log('INFO',self.logfile, 'Duplicates found by URL canonicalization: %s' %
+            self.canon_saved_cnt)
+        if self.dups.labels:
+            log('INFO',self.logfile, '=======================')
+            for k,k2,cnt,sec_cnt in self.dups.iter_dups():
+                log('INFO',self.logfile,
+                    '%s (onclick=%s): cnt=%s,sec_cnt=%s' %
+                    (k,k2,cnt,sec_cnt))
+            log('INFO',self.logfile,'')
+        log('INFO',self.logfile, 'Number of Duplicate Content Pages: %s' % self.content_dup_cnt)
+        log('INFO',self.logfile, 'Number of Downloads: %s' % len(self.downloads))
+        if self.content_dups:
             log('INFO',self.logfile, '=======================')
-            for k,v in self.dup_urls.iteritems():
-                for k2,v2 in v.iteritems():
-                    if v2['cnt'] > 0:
-                        log('INFO',self.logfile,
-                            '%s (onclick=%s): cnt=%s,sec_cnt=%s' %
-                            (k,k2,v2['cnt'],v2['sec_cnt']))
+            for row in self.content_dups:
+                log('INFO',self.logfile, '%s (onclick=%s): %s (distance=%s) of %s' %
+                    (row[0],row[1],row[2],row[3],row[4]))
             log('INFO',self.logfile,'')
         log('INFO',self.logfile, 'Number of Invalid URLs: %s' % self.invalid_cnt)
         if self.invalid_urls:
@@ -386,129 +1666,1734 @@ class ItemMgr(object):
             for k,v in self.error_urls.iteritems():
                 log('INFO',self.logfile, '%s: %s' % (k,v))
             log('INFO',self.logfile,'')
+        stages, pages_per_min = self.timer.summary()
+        if stages:
+            log('INFO',self.logfile, 'Stage timings (secs, see timings.jsonl):')
+            log('INFO',self.logfile, '%-14s %7s %8s %8s %8s %10s' %
+                ('STAGE','COUNT','P50','P95','MAX','TOTAL'))
+            for stage, cnt, p50, p95, max_secs, total in stages:
+                log('INFO',self.logfile, '%-14s %7s %8.3f %8.3f %8.3f %10.1f' %
+                    (stage, cnt, p50, p95, max_secs, total))
+        log('INFO',self.logfile, 'Pages captured: %s, %.1f pages/min' %
+            (self.timer.pages, pages_per_min))
         log('INFO',self.logfile, 'DONE')
 
 
+def new_webdriver(browser_type, profile=None, download_dir=None):
+    """Creates a browser, headless with --headless.
+    
+    @param browser_type: The BrowserType.
+    @keyword profile: The browser profile (see
+            BrowserMgr.get_new_browser_profile()).
+    @keyword download_dir: The download directory of the profile.
+    @return: The webdriver.
+    
+    """
+    if browser_type == BrowserType.CHROME:
+        browser = webdriver.Chrome(chrome_options=profile)
+        if headless and download_dir:
+            # Headless Chrome does not download files by default.
+            browser.execute_cdp_cmd('Page.setDownloadBehavior',
+                                    {'behavior':'allow', 'downloadPath':download_dir})
+        return browser
+    options = webdriver.FirefoxOptions()
+    if headless:
+        options.add_argument('-headless')
+    return webdriver.Firefox(firefox_profile=profile, options=options)
+
+
 class BrowserMgr(object):
     
-    """Manages Browsers."""
+    """Manages Browsers."""
+    
+    _start_url = None
+    # Cookies are global for all browsers.
+    _cookies = None
+    
+    def __init__(self, start_url=None, cookies=None,
+                 browser_type=BrowserType.FIREFOX):
+        """Constructs a Browser Manager instance.
+        
+        @param start_url: The start URL to load on the browsers.
+        @param cookies: The cookies to use on the browsers.
+        @keyword browser_type: The BrowserType of the browsers.
+        
+        """
+        # {key: browser, ...}
+        self.browsers = {}
+        self._start_url = start_url
+        self._cookies = cookies
+        self.browser_type = browser_type
+        self.lock = threading.Lock()
+    
+    def set_browser_cookies(self, browser, url, cookies):
+        """Sets cookies on the browser at the requested url page.
+        
+        @param browser: The browser to set the cookie.
+        @param url: The URL to load on the browser.
+        @param cookies: The cookies to load on the browser.
+        
+        """
+        if not any([url,cookies]):
+            return
+        # Load cookies.
+        browser.get(url)
+        page_waiter.wait(browser)
+        for cookie in cookies:
+            browser.add_cookie(cookie)
+        # Re-load the page so the cookies will take effect.
+        browser.get(url)
+        page_waiter.wait(browser)
+    
+    @staticmethod
+    def get_new_browser_profile(download_dir=None, browser_type=BrowserType.FIREFOX,
+                                load_profile='full'):
+        """Gets a new Firefox Profile with some preferences set for
+        automatically downloading files without prompting.
+        
+        http://yizeng.me/2014/05/23/download-pdf-files-automatically-in-firefox-using-selenium-webdriver/
+        
+        @keyword download_dir: The download directory to set.
+        @keyword load_profile: The LOAD_PROFILES resources Firefox skips,
+                Chrome skips them per page (see set_load_profile()).
+        @return: A webdriver.FirefoxProfile.
+        
+        """
+        if browser_type == BrowserType.CHROME:
+            return BrowserMgr._get_new_chrome_profile(download_dir=download_dir)
+        # Initialize browser profiles.
+        # For now it is set on all browsers.
+        profile = webdriver.FirefoxProfile()
+        profile.set_preference('browser.download.folderList', 2)
+        profile.set_preference('browser.download.manager.showWhenStarting', False)
+        # Disable Firefox's built-in PDF viewer.
+        profile.set_preference('pdfjs.disabled', True)
+        # Disable Adobe Acrobat's PDF preview plugin.
+        profile.set_preference('plugin.scan.plid.all', False)
+        profile.set_preference('plugin.scan.Acrobat', '99.0')
+        # Set download dir.
+        if download_dir:
+            profile.set_preference('browser.download.dir', download_dir)
+        # MIME types to always save to disk (download_dir).
+        # Try to set all of the Microsoft Office file types.
+        types = ('application/pdf,application/octet-stream,text/calendar' +
+                 MS_MimeTypes.get_unique_mime_types(as_string=True))
+        profile.set_preference('browser.helperApps.neverAsk.saveToDisk', types)
+        if device_scale_factor:
+            profile.set_preference('layout.css.devPixelsPerPx', str(device_scale_factor))
+        # Resources skipped, for the life of the browser.
+        for resource in LOAD_PROFILES[load_profile]:
+            for name, value in BLOCKABLE_RESOURCES[resource][1].iteritems():
+                profile.set_preference(name, value)
+        return profile
+    
+    @staticmethod
+    def _get_new_chrome_profile(download_dir=None):
+        profile = webdriver.ChromeOptions()
+        prefs = {'download.prompt_for_download':False,
+                 'download.directory_upgrade':True,
+                 'plugins.plugins_disabled':['Chrome PDF Viewer'],
+                 'extensions_to_open':'',
+                 # Chrome 57 changed pdf settings.
+                 'plugins.always_open_pdf_externally':True}
+        if download_dir:
+            prefs.update({'download.default_directory':download_dir})
+        profile.add_experimental_option('prefs',prefs)
+        # Remove the "Chrome is controlled by automated software" infobar.
+        profile.add_experimental_option('excludeSwitches', ['enable-automation'])
+        if headless:
+            profile.add_argument('--headless')
+            profile.add_argument('--window-size=%s,%s' % window_size)
+        if device_scale_factor:
+            profile.add_argument('--force-device-scale-factor=%s' % device_scale_factor)
+        return profile
+    
+    def _new_browser(self, start_url=None, cookies=None, download_dir=None):
+        profile = self.get_new_browser_profile(download_dir=download_dir,
+                                               browser_type=self.browser_type,
+                                               load_profile=launch_load_profile())
+        browser = new_webdriver(self.browser_type, profile, download_dir=download_dir)
+        browser.set_window_size(*window_size)
+        _cookies = cookies or self._cookies
+        if start_url and _cookies:
+            self.set_browser_cookies(browser, start_url, _cookies)
+        if start_url:
+            browser.get(start_url)
+            page_waiter.wait(browser)
+        return browser
+    
+    def get_browser(self, key, download_dir=None):
+        """Gets the browser associated with the key (eg: level or worker).
+        
+        @param key: The key of the browser.
+        @keyword download_dir: If browser have not been created yet, 
+                uses this as the new download dir.
+        
+        """
+        key = str(key)
+        with self.lock:
+            try:
+                browser = self.browsers[key]
+            except KeyError:
+                browser = self._new_browser(start_url=self._start_url,
+                                            cookies=self._cookies,
+                                            download_dir=download_dir)
+                self.browsers[key] = browser
+        return browser
+    
+    def close(self):
+        """Quits all managed browsers."""
+        with self.lock:
+            for browser in self.browsers.values():
+                try:
+                    browser.quit()
+                except Exception:
+                    log('WARNING',logfile,traceback.format_exc())
+            self.browsers = {}
+    
+    def get_validation_browser(self):
+        """Gets the validation browser (level 0)."""
+        return self.get_browser(0)
+
+
+class WorkerPool(object):
+
+    """Pool of browser workers pulling tasks from a shared queue.
+
+    Each worker drives its own browser (from a BrowserMgr) and has its own
+    download directory.  Both are bound to the worker thread, so the
+    capture functions pick them up through get_browser() and
+    get_download_dir().
+
+    """
+
+    def __init__(self, browser_mgr, num_workers, parent_dir):
+        """Constructs a Worker Pool instance.
+
+        @param browser_mgr: The BrowserMgr to get the worker browsers from.
+        @param num_workers: The number of workers (browsers).
+        @param parent_dir: Specify parent_output_dir here.  Worker download
+                directories are created as main_<n> underneath.
+
+        """
+        self.browser_mgr = browser_mgr
+        self.num_workers = num_workers
+        self.parent_dir = parent_dir
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+
+    def start(self):
+        """Launches the worker browsers and threads."""
+        for worker_id in range(1, self.num_workers + 1):
+            download_dir = os.path.join(self.parent_dir, 'main_%s' % worker_id)
+            if not os.path.isdir(download_dir):
+                os.makedirs(download_dir, 0777)
+            if download_tracker is not None:
+                download_tracker.watch(download_dir)
+            log('INFO',self.logfile,'Loading browser for worker %s...' % worker_id,
+                TAG=self._TAG)
+            # Browsers are launched from the main thread, one at a time.
+            browser = self.browser_mgr.get_browser(worker_id, download_dir=download_dir)
+            t = threading.Thread(target=self._run, name='worker-%s' % worker_id,
+                                 args=(browser, download_dir))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self, browser, download_dir):
+        _thread_local.browser = browser
+        _thread_local.download_dir = download_dir
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    break
+                func, item, level = task
+                try:
+                    func(item, level)
+                except Exception:
+                    log('ERROR',self.logfile,'Worker failed on %s:\n%s' %
+                        (item, traceback.format_exc()), TAG=self._TAG)
+                    item_mgr.add_error(item.url)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, item, level):
+        """Queues func(item, level) to be run by a worker."""
+        self.queue.put((func, item, level))
+
+    def join(self):
+        """Blocks until all queued tasks are done."""
+        self.queue.join()
+
+    def close(self):
+        """Stops the workers and quits their browsers.
+
+        Tasks still queued (eg: after an error) are dropped.
+
+        """
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.queue.task_done()
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.browser_mgr.close()
+
+
+class FetchBackend(object):
+
+    """Base class of the page fetch backends."""
+
+    def fetch(self, item):
+        """Fetches the page source of an Item.
+
+        @param item: The Item object.
+        @return: The page source, or None if the page can not be fetched
+                by this backend (the caller should fall back to the browser).
+        @raise TimeoutException: If the page timed out.
+
+        """
+        raise NotImplementedError
+
+
+class BrowserFetcher(FetchBackend):
+
+    """Fetches pages with the browser of the calling thread."""
+
+    # Returns the links of the page as Link fields (see --js-links).
+    _LINKS_JS = """
+        var searchResults = arguments[0], links = [];
+        var anchors = document.getElementsByTagName('a');
+        for (var i = 0; i < anchors.length; i++) {
+            var a = anchors[i];
+            if (searchResults && !(a.classList.contains('search-result-link') &&
+                                   a.classList.contains('visitable'))) {
+                continue;
+            }
+            var href = a.getAttribute('href');
+            // Resolve relative links, onclick links ('#') are kept as is.
+            if (href && href != '#' && typeof a.href == 'string') {
+                href = a.href;
+            }
+            var onclick = a.getAttribute('onclick');
+            var spanId = null;
+            if (onclick) {
+                var span = a.getElementsByTagName('span')[0];
+                spanId = span ? (span.getAttribute('id') || '') : null;
+            }
+            links.push([href, a.textContent, a.getAttribute('data-type'),
+                        onclick, spanId]);
+        }
+        return links;
+    """
+
+    def fetch(self, item, source=True, profile='full'):
+        """Loads an Item in the browser, following its onclick_id.
+
+        @keyword source: Return the page source, otherwise None.
+        @keyword profile: The LOAD_PROFILES resources to skip.
+
+        """
+        browser = get_browser()
+        set_load_profile(browser, profile)
+        with timed('navigate'):
+            browser.get(item.url)
+        # Execute some javascript to manipulate the page for better screenshots.
+        # Get rid of the scrollbars if any.
+        browser.execute_script('''
+            const s = document.createElement("style");
+            s.textContent = "body::-webkit-scrollbar { display: none;} body { scrollbar-width: none; }";
+            document.head.insertAdjacentElement("beforeend", s);
+        ''');
+        page_waiter.wait(browser)
+        # Check onclick_id and follow that click.
+        if item.onclick_id:
+            with timed('onclick'):
+                browser.find_element_by_id(item.onclick_id).click()
+            page_waiter.wait(browser, what='onclick')
+        _thread_local.page_item = item
+        if source:
+            return browser.page_source
+        return None
+
+    def get_links(self, search_results=False):
+        """Gets the links of the page loaded in the calling thread's browser.
+
+        @keyword search_results: Only get links with class
+            "search-result-link visitable".
+        @return: A list of Link tuples.
+
+        """
+        return [Link(*x) for x in
+                get_browser().execute_script(self._LINKS_JS, search_results)]
+
+
+class HttpFetcher(FetchBackend):
+
+    """Fetches pages over HTTP, without a browser.
+
+    Uses a pooled keep-alive session carrying the crawl's cookies.  Pages
+    that are not HTML, need a click (onclick_id) or look like they are
+    rendered by javascript are left to the browser.
+
+    """
+
+    # Pages with less visible text than this and scripts need javascript.
+    MIN_TEXT_LEN = 200
+    _script_re = re.compile(r'<(script|style|noscript)\b.*?</\1\s*>', re.I | re.S)
+    _tag_re = re.compile(r'<[^>]*>')
+    _charset_re = re.compile(r'''<meta[^>]+charset=["']?([\w-]+)''', re.I)
+
+    def __init__(self, cookies=None, user_agent=None, pool_size=10, timeout=30):
+        """Constructs a HTTP Fetcher instance.
+
+        @keyword cookies: The browser cookies (from browser.get_cookies()).
+        @keyword user_agent: The User-Agent header to send.
+        @keyword pool_size: Maximum number of connections kept per host.
+        @keyword timeout: The timeout in secs of a request.
+
+        """
+        self.timeout = timeout
+        self.session = new_http_session(cookies=cookies, user_agent=user_agent,
+                                        pool_size=pool_size)
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+
+    def fetch(self, item):
+        if item.onclick_id:
+            return None
+        try:
+            with timed('navigate'):
+                r = self.session.get(item.url, timeout=self.timeout, stream=True)
+        except requests.exceptions.Timeout:
+            raise TimeoutException('HTTP request timed out: %s' % item.url)
+        except requests.exceptions.RequestException:
+            log('WARNING',self.logfile,'Unable to fetch %s: %s' %
+                (item.url,traceback.format_exc().splitlines()[-1]),TAG=self._TAG)
+            return None
+        try:
+            content_type = r.headers.get('Content-Type', '')
+            if content_classifier is not None and content_type:
+                content_classifier.learn(item.url, content_type.split(';')[0].strip().lower())
+            if 'html' not in content_type:
+                return None
+            item.response = r.status_code
+            content = r.content
+        finally:
+            r.close()
+        page_source = content.decode(self.get_encoding(r, content), 'replace')
+        if self.needs_js(page_source):
+            log('INFO',self.logfile,'%s needs javascript, using browser...' % item.url,
+                TAG=self._TAG)
+            return None
+        return page_source
+
+    def get_encoding(self, response, content):
+        """Gets the encoding of the response body."""
+        if 'charset' in response.headers.get('Content-Type', ''):
+            return response.encoding
+        m = self._charset_re.search(content[:2048])
+        if m:
+            try:
+                codecs.lookup(m.group(1))
+                return m.group(1)
+            except LookupError:
+                pass
+        return 'utf-8'
+
+    def needs_js(self, page_source):
+        """Guesses if the page is rendered by javascript.
+
+        @param page_source: The HTML page source.
+
+        """
+        if '<script' not in page_source.lower():
+            return False
+        text = self._tag_re.sub('', self._script_re.sub('', page_source))
+        return len(text.strip()) < self.MIN_TEXT_LEN
+
+
+class Downloader(object):
+    
+    """Downloads files over HTTP, without the browser.
+    
+    Bodies are streamed to the level directory by a few threads sharing a
+    pooled keep-alive session with the crawl's cookies.  A download is
+    written to a .part file first (with its URL and validators in a
+    .part.json file) and resumed with a range request after an error or a
+    crash.  Completed downloads are recorded with their size and SHA-256.
+    
+    Downloads that are not files (eg: a login page) or keep failing are
+    left to the browser, see close().
+    
+    """
+    
+    CHUNK_SIZE = 65536
+    TRIES = 3
+    _disposition_re = re.compile(r'''filename\*?=(?:[\w-]+'[\w-]*')?["']?([^"';]+)''', re.I)
+    
+    def __init__(self, cookies=None, user_agent=None, workers=4, timeout=60):
+        """Constructs a Downloader instance.
+        
+        @keyword cookies: The browser cookies (from browser.get_cookies()).
+        @keyword user_agent: The User-Agent header to send.
+        @keyword workers: Number of downloads in parallel.
+        @keyword timeout: The timeout in secs of a request (not of the
+                whole download).
+        
+        """
+        self.timeout = timeout
+        self.session = new_http_session(cookies=cookies, user_agent=user_agent,
+                                        pool_size=workers)
+        # Submitting blocks while the downloads are behind.
+        self.queue = Queue.Queue(workers * 4)
+        self.lock = threading.Lock()
+        # self.failed = [(item, level), ...], left to the browser.
+        self.failed = []
+        self.bytes = 0
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._run, name='downloader-%s' % (i + 1))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    
+    def submit(self, item, level):
+        """Queues the download of an Item."""
+        self.queue.put((item, level))
+    
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    break
+                self.download(*task)
+            except Exception:
+                log('ERROR',self.logfile,'Download failed: %s\n%s' %
+                    (task[0], traceback.format_exc()), TAG=self._TAG)
+                with self.lock:
+                    self.failed.append(task)
+            finally:
+                self.queue.task_done()
+    
+    def download(self, item, level):
+        """Downloads an Item's file to the level directory.
+        
+        @return: The path downloaded to, or None if left to the browser.
+        
+        """
+        parent_path = os.path.join(parent_output_dir, str(level))
+        if not os.path.isdir(parent_path):
+            try:
+                os.makedirs(parent_path, 0777)
+            except OSError:
+                # Created by another thread.
+                if not os.path.isdir(parent_path):
+                    raise
+        part_path = os.path.join(parent_path, '.%s.part' %
+                                 hashlib.sha1(item.url.encode('utf-8')).hexdigest())
+        start_time = time.time()
+        for i in range(1, self.TRIES + 1):
+            try:
+                result = self._download(item, part_path)
+                break
+            except (requests.exceptions.RequestException, IOError):
+                log('WARNING',self.logfile,'Try %s: Unable to download %s: %s' %
+                    (i,item.url,traceback.format_exc().splitlines()[-1]),TAG=self._TAG)
+                if i == self.TRIES:
+                    raise
+                time.sleep(i)
+        if result is None:
+            log('INFO',self.logfile,'%s is not a file, leaving it to the browser...' %
+                item.url, TAG=self._TAG)
+            with self.lock:
+                self.failed.append((item, level))
+            return None
+        filename, size, sha256 = result
+        filepath = rename_unique(part_path, os.path.join(parent_path, filename))
+        os.remove(part_path + '.json')
+        secs = round(time.time() - start_time, 3)
+        with self.lock:
+            self.bytes += size
+        log('INFO',self.logfile,'Downloaded %s (%s bytes, %s secs) from %s' %
+            (filepath, size, secs, item), TAG=self._TAG)
+        item_mgr.add_download([os.path.relpath(filepath, parent_output_dir), item.url,
+                               item.onclick_id, level, size, secs, sha256])
+        return filepath
+    
+    def _download(self, item, part_path):
+        # Streams the body to part_path, resuming it if it has the same URL.
+        # Returns (filename, size, sha256), or None if the body is a page.
+        headers = {}
+        info = {}
+        offset = 0
+        if os.path.exists(part_path + '.json') and os.path.exists(part_path):
+            with open(part_path + '.json', 'rb') as f:
+                info = json.load(f)
+            validator = info.get('etag') or info.get('last_modified')
+            offset = os.path.getsize(part_path)
+            if info.get('url') == item.url and validator and offset:
+                headers['Range'] = 'bytes=%s-' % offset
+                headers['If-Range'] = validator
+            else:
+                offset = 0
+        r = self.session.get(item.url, headers=headers, timeout=self.timeout, stream=True)
+        try:
+            if r.status_code == 416:
+                # Complete already.
+                r.close()
+                r = self.session.get(item.url, timeout=self.timeout, stream=True)
+                offset = 0
+            r.raise_for_status()
+            item.response = r.status_code
+            if 'html' in r.headers.get('Content-Type', ''):
+                if content_classifier is not None:
+                    content_classifier.learn(item.url, 'text/html')
+                return None
+            if r.status_code != 206:
+                offset = 0
+            info = {'url':item.url,
+                    'etag':r.headers.get('ETag'),
+                    'last_modified':r.headers.get('Last-Modified'),
+                    'filename':self.get_filename(item, r)}
+            with open(part_path + '.json', 'wb') as f:
+                json.dump(info, f)
+            length = r.headers.get('Content-Length')
+            expected = offset + int(length) if length and length.isdigit() else None
+            sha256 = hashlib.sha256()
+            with open(part_path, 'r+b' if offset else 'wb') as f:
+                # Hash the part downloaded before.
+                while f.tell() < offset:
+                    sha256.update(f.read(min(self.CHUNK_SIZE, offset - f.tell())))
+                f.truncate(offset)
+                for chunk in r.raw.stream(self.CHUNK_SIZE, decode_content=True):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                size = f.tell()
+        finally:
+            r.close()
+        if expected is not None and size != expected and not r.headers.get('Content-Encoding'):
+            raise IOError('Incomplete download of %s: %s of %s bytes' %
+                          (item.url, size, expected))
+        return info['filename'], size, sha256.hexdigest()
+    
+    def get_filename(self, item, response):
+        """Gets the file name of a download.
+        
+        From the Content-Disposition header, else the URL path, else built
+        from the URL with the extension of the content type.
+        
+        """
+        m = self._disposition_re.search(response.headers.get('Content-Disposition', ''))
+        if m:
+            filename = urlparse.unquote(m.group(1).strip())
+        else:
+            filename = urlparse.unquote(urlparse.urlparse(response.url).path.rstrip('/'))
+        filename = os.path.basename(filename.replace('\\', '/')).strip()
+        if not filename or filename.startswith('.') or '.' not in filename:
+            ext = mimetypes.guess_extension(
+                response.headers.get('Content-Type', '').split(';')[0].strip()) or ''
+            filename = build_filename(item.url) + ext
+        return filename
+    
+    def close(self):
+        """Waits for the queued downloads.
+        
+        @return: The [(item, level), ...] downloads left to the browser.
+        
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.session.close()
+        return self.failed
+
+
+def new_http_session(cookies=None, user_agent=None, pool_size=10):
+    """Creates a pooled keep-alive HTTP session.
+    
+    @keyword cookies: The browser cookies (from browser.get_cookies()).
+    @keyword user_agent: The User-Agent header to send.
+    @keyword pool_size: Maximum number of connections kept per host.
+    
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if user_agent:
+        session.headers['User-Agent'] = user_agent
+    for cookie in cookies or []:
+        session.cookies.set(cookie['name'], cookie['value'],
+                            domain=cookie.get('domain', ''),
+                            path=cookie.get('path', '/'))
+    return session
+
+
+class PageWaiter(object):
+
+    """Waits for a page to be ready, instead of sleeping for fixed times.
+
+    A page is ready once all of these hold:
+    1. document.readyState is 'complete'.
+    2. There are no XHR/fetch requests in flight, and no resource finished
+       loading during the quiet window.
+    3. There were no DOM mutations during the quiet window.
+    4. All images are complete (loaded and decoded, or failed).
+
+    The wait gives up after max_wait secs.  Every wait is logged and kept
+    in the stats.
+
+    """
+
+    # Installs the observers once per document and returns the signals:
+    # [readyState, requests in flight, incomplete images,
+    #  ms since last mutation, ms since last network activity].
+    _SIGNALS_JS = '''
+        var w = window;
+        if (!w.__crawlerReady) {
+            var r = w.__crawlerReady = {pending: 0,
+                                        lastMutation: performance.now(),
+                                        lastNet: 0};
+            var done = function() {
+                r.pending = Math.max(0, r.pending - 1);
+                r.lastNet = performance.now();
+            };
+            try {
+                new MutationObserver(function() {
+                    r.lastMutation = performance.now();
+                }).observe(document, {childList: true, subtree: true,
+                                      attributes: true, characterData: true});
+            } catch (e) {}
+            var send = XMLHttpRequest.prototype.send;
+            XMLHttpRequest.prototype.send = function() {
+                r.pending++;
+                this.addEventListener('loadend', done);
+                return send.apply(this, arguments);
+            };
+            if (w.fetch) {
+                var fetch = w.fetch;
+                w.fetch = function() {
+                    r.pending++;
+                    return fetch.apply(this, arguments).then(
+                        function(v) { done(); return v; },
+                        function(e) { done(); throw e; });
+                };
+            }
+        }
+        var r = w.__crawlerReady, now = performance.now();
+        var lastNet = r.lastNet;
+        if (performance.getEntriesByType) {
+            var res = performance.getEntriesByType('resource');
+            for (var i = 0; i < res.length; i++) {
+                lastNet = Math.max(lastNet, res[i].responseEnd);
+            }
+        }
+        var images = 0;
+        for (var j = 0; j < document.images.length; j++) {
+            if (!document.images[j].complete) { images++; }
+        }
+        return [document.readyState, r.pending, images,
+                now - r.lastMutation, now - lastNet];
+    '''
+
+    def __init__(self, max_wait=10, quiet=0.5, poll=0.1):
+        """Constructs a Page Waiter instance.
+
+        @keyword max_wait: The maximum secs to wait for a page.
+        @keyword quiet: The secs without DOM mutations or network
+                activity for the page to be considered ready.
+        @keyword poll: The secs between polls of the page.
+
+        """
+        self.max_wait = max_wait
+        self.quiet = quiet
+        self.poll = poll
+        # Stats.
+        self.wait_cnt = 0
+        self.wait_secs = 0.0
+        self.max_wait_secs = 0.0
+        self.timeout_cnt = 0
+        self.lock = threading.Lock()
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+
+    def is_ready(self, driver, quiet=None):
+        """Returns True if the page in the driver is ready."""
+        quiet_ms = (self.quiet if quiet is None else quiet) * 1000
+        try:
+            state, in_flight, images, since_mutation, since_net = \
+                driver.execute_script(self._SIGNALS_JS)
+        except Exception:
+            # Eg: page is still navigating.
+            return False
+        return (state == 'complete' and not in_flight and not images and
+                since_mutation >= quiet_ms and since_net >= quiet_ms)
+
+    def wait(self, driver, max_wait=None, quiet=None, what='page'):
+        """Waits for the page in the driver to be ready.
+
+        @param driver: The webdriver (eg: browser).
+        @keyword max_wait: Overrides the maximum secs to wait.
+        @keyword quiet: Overrides the quiet window secs.
+        @keyword what: What is waited for, for the log.
+        @return: The secs waited.
+
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        start = time.time()
+        with timed('onclick' if what == 'onclick' else 'wait'):
+            ready = self.is_ready(driver, quiet=quiet)
+            while not ready and time.time() - start < max_wait:
+                time.sleep(self.poll)
+                ready = self.is_ready(driver, quiet=quiet)
+        elapsed = time.time() - start
+        with self.lock:
+            self.wait_cnt += 1
+            self.wait_secs += elapsed
+            self.max_wait_secs = max(self.max_wait_secs, elapsed)
+            if not ready:
+                self.timeout_cnt += 1
+        log('INFO',self.logfile,'Waited %.2f secs for %s%s' %
+            (elapsed, what, '' if ready else ' (gave up)'),
+            print_stdout=False, TAG=self._TAG)
+        return elapsed
+
+    def wait_for_scroll(self, driver):
+        """Waits for the page to settle after scrolling."""
+        return self.wait(driver, max_wait=min(self.max_wait, 2), quiet=0.05,
+                         what='scroll')
+
+    def print_results(self):
+        log('INFO',self.logfile,'Page waits: %s, total=%.1f secs, avg=%.2f secs, '
+            'max=%.2f secs, gave up=%s' %
+            (self.wait_cnt, self.wait_secs,
+             self.wait_secs / self.wait_cnt if self.wait_cnt else 0,
+             self.max_wait_secs, self.timeout_cnt))
+
+
+class LinkExtractor(object):
+    
+    """Extracts the hyperlinks of pages as Link tuples."""
+    
+    def extract(self, page_source, search_results=False):
+        """Extracts the hyperlinks of a page.
+        
+        @param page_source: The HTML page source.
+        @keyword search_results: Only extract links with class
+            "search-result-link visitable".
+        @return: A list of Link tuples.
+        
+        """
+        raise NotImplementedError
+
+
+class Bs4LinkExtractor(LinkExtractor):
+    
+    """Extracts links from a BeautifulSoup tree, freed once done."""
+    
+    def extract(self, page_source, search_results=False):
+        soup = BeautifulSoup(page_source, 'html.parser')
+        links = []
+        for a in soup.find_all('a'):
+            if search_results:
+                classes = a.get('class') or []
+                if 'search-result-link' not in classes or 'visitable' not in classes:
+                    continue
+            onclick = a.get('onclick')
+            span_id = None
+            if onclick:
+                span = a.find('span')
+                if span is not None:
+                    span_id = span.get('id', '')
+            links.append(Link(a.get('href'), a.get_text(), a.get('data-type'),
+                              onclick, span_id))
+        soup.decompose()
+        return links
+
+
+class _LinkCollector(object):
+    
+    """Builds Link tuples from parser events, without building a tree.
+    
+    Anchors nest like in the bs4 tree: text and spans belong to all the
+    open anchors.
+    
+    """
+    
+    # Text of these elements is not part of the link text.
+    _SKIP_TEXT = frozenset(['script', 'style', 'template'])
+    
+    def __init__(self, search_results=False):
+        self.search_results = search_results
+        # [[href, text parts, data_type, onclick, span_id], ...]
+        self.links = []
+        # Open anchors, None for filtered out ones.
+        self.open = []
+        self.skip = 0
+    
+    def start(self, tag, attrs):
+        if tag == 'a':
+            link = None
+            classes = (attrs.get('class') or '').split()
+            if (not self.search_results or
+                ('search-result-link' in classes and 'visitable' in classes)):
+                link = [attrs.get('href'), [], attrs.get('data-type'),
+                        attrs.get('onclick'), None]
+                self.links.append(link)
+            self.open.append(link)
+        elif tag == 'span':
+            for link in self.open:
+                if link is not None and link[3] and link[4] is None:
+                    link[4] = attrs.get('id') or ''
+        elif tag in self._SKIP_TEXT:
+            self.skip += 1
+    
+    def end(self, tag):
+        if tag == 'a':
+            if self.open:
+                self.open.pop()
+        elif tag in self._SKIP_TEXT:
+            if self.skip:
+                self.skip -= 1
+    
+    def data(self, text):
+        if self.open and not self.skip:
+            for link in self.open:
+                if link is not None:
+                    link[1].append(text)
+    
+    def close(self):
+        return [Link(href, u''.join(text), data_type, onclick, span_id)
+                for href, text, data_type, onclick, span_id in self.links]
+
+
+class LxmlLinkExtractor(LinkExtractor):
+    
+    """Extracts links with the lxml (libxml2) HTML parser, which feeds
+    parser events to a collector instead of building a tree.
+    
+    Like browsers, libxml2 closes an open anchor when another one starts.
+    
+    """
+    
+    def extract(self, page_source, search_results=False):
+        if not page_source:
+            return []
+        collector = _LinkCollector(search_results=search_results)
+        parser = etree.HTMLParser(target=collector)
+        parser.feed(page_source)
+        return parser.close()
+
+
+class _StreamParser(HTMLParser.HTMLParser):
+    
+    def __init__(self, collector):
+        HTMLParser.HTMLParser.__init__(self)
+        self.collector = collector
+    
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, dict(attrs))
+    
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
+    
+    def handle_data(self, data):
+        self.collector.data(data)
+    
+    def handle_entityref(self, name):
+        if name in htmlentitydefs.name2codepoint:
+            self.collector.data(unichr(htmlentitydefs.name2codepoint[name]))
+        else:
+            self.collector.data(u'&' + name)
+    
+    def handle_charref(self, name):
+        try:
+            if name[:1] in ('x', 'X'):
+                self.collector.data(unichr(int(name[1:], 16)))
+            else:
+                self.collector.data(unichr(int(name)))
+        except ValueError:
+            self.collector.data(u'&#' + name)
+
+
+class StreamLinkExtractor(LinkExtractor):
+    
+    """Extracts links with the standard library HTML tokenizer."""
+    
+    def extract(self, page_source, search_results=False):
+        collector = _LinkCollector(search_results=search_results)
+        parser = _StreamParser(collector)
+        try:
+            parser.feed(page_source or u'')
+            parser.close()
+        except HTMLParser.HTMLParseError:
+            # Malformed markup, the bs4 tree builder copes with more.
+            return Bs4LinkExtractor().extract(page_source, search_results)
+        return collector.close()
+
+
+# Link extractors by --link-parser name.
+LINK_EXTRACTORS = {'bs4':Bs4LinkExtractor,
+                   'lxml':LxmlLinkExtractor,
+                   'stream':StreamLinkExtractor}
+
+
+class NativeCapture(object):
+    
+    """Takes full page screenshots with the browser's native support, in a
+    single round trip instead of scrolling and stitching.
+    
+    Firefox uses geckodriver's full page screenshot command, Chrome uses
+    the DevTools Page.captureScreenshot with captureBeyondViewport.
+    Browsers without support get None, and are not tried again.
+    
+    """
+    
+    _FIREFOX_COMMAND = 'mozFullPageScreenshot'
+    # Scrolls through the page in the browser, so lazy contents load.
+    _SCROLL_JS = '''
+        var done = arguments[arguments.length - 1];
+        var step = window.innerHeight, top = 0;
+        (function scroll() {
+            if (top >= document.body.parentNode.scrollHeight) {
+                window.scrollTo(0, 0);
+                done(top);
+                return;
+            }
+            window.scrollTo(0, top);
+            top += step;
+            setTimeout(scroll, 50);
+        })();
+    '''
+    
+    def __init__(self):
+        # Webdriver classes without native support.
+        self.unsupported = set()
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+    
+    def capture(self, driver):
+        """Takes a full page screenshot.
+        
+        @param driver: The webdriver (eg: browser).
+        @return: The PNG data, or None if not supported by the browser
+                (the caller should fall back to stitching).
+        
+        """
+        if type(driver) in self.unsupported:
+            return None
+        if isinstance(driver, webdriver.Firefox):
+            capture = self._capture_firefox
+        elif isinstance(driver, webdriver.Chrome):
+            capture = self._capture_chrome
+        else:
+            return None
+        self.load_lazy_contents(driver)
+        try:
+            return capture(driver)
+        except WebDriverException:
+            log('WARNING',self.logfile,'Native full page screenshot not supported, '
+                'stitching screenshots instead.\n' + traceback.format_exc(),
+                TAG=self._TAG)
+            self.unsupported.add(type(driver))
+            return None
+    
+    def load_lazy_contents(self, driver):
+        """Scrolls through the page and waits for lazy contents to load."""
+        driver.set_script_timeout(page_waiter.max_wait * 3)
+        driver.execute_async_script(self._SCROLL_JS)
+        page_waiter.wait(driver, what='lazy contents')
+        page_waiter.wait_for_scroll(driver)
+    
+    def _capture_firefox(self, driver):
+        if hasattr(driver, 'get_full_page_screenshot_as_png'):
+            return driver.get_full_page_screenshot_as_png()
+        driver.command_executor._commands[self._FIREFOX_COMMAND] = (
+            'GET', '/session/$sessionId/moz/screenshot/full')
+        return base64.b64decode(driver.execute(self._FIREFOX_COMMAND)['value'])
+    
+    def _capture_chrome(self, driver):
+        metrics = driver.execute_cdp_cmd('Page.getLayoutMetrics', {})
+        size = metrics.get('cssContentSize') or metrics['contentSize']
+        result = driver.execute_cdp_cmd('Page.captureScreenshot', {
+            'format':'png',
+            'captureBeyondViewport':True,
+            'clip':{'x':0, 'y':0, 'width':size['width'],
+                    'height':size['height'], 'scale':downscale}})
+        return base64.b64decode(result['data'])
+
+
+class BandWriter(object):
+    
+    """Writes a tall screenshot as fixed height bands (see --tall-output)."""
+    
+    def __init__(self, filepath):
+        """Constructs a Band Writer instance.
+        
+        @param filepath: The screenshot filepath the output is named after.
+        
+        """
+        self.filepath = filepath
+        self.base_filepath = '.'.join(filepath.split('.')[:-1])
+        self.bands = 0
+    
+    def write(self, band):
+        """Writes the next band (a PIL Image)."""
+        raise NotImplementedError
+    
+    def close(self):
+        """Finishes the output."""
+        pass
+
+
+class PdfBandWriter(BandWriter):
+    
+    """Writes the bands as the pages of a PDF."""
+    
+    def write(self, band):
+        if band.mode != 'RGB':
+            band = band.convert('RGB')
+        band.save(self.base_filepath + '.pdf', 'PDF', append=self.bands > 0)
+        self.bands += 1
+
+
+class SegmentBandWriter(BandWriter):
+    
+    """Writes the bands as numbered PNG segments, listed in a JSON manifest
+    (<name>_manifest.json) once done.
+    
+    """
+    
+    def __init__(self, filepath):
+        BandWriter.__init__(self, filepath)
+        self.width = 0
+        self.height = 0
+        self.segments = []
+    
+    def write(self, band):
+        segment_filepath = '%s_seg_%03d.png' % (self.base_filepath, self.bands)
+        band.save(segment_filepath, 'PNG')
+        self.segments.append({'file':os.path.basename(segment_filepath),
+                              'top':self.height,
+                              'height':band.size[1]})
+        self.width = band.size[0]
+        self.height += band.size[1]
+        self.bands += 1
+    
+    def close(self):
+        manifest = {'width':self.width,
+                    'height':self.height,
+                    'segments':self.segments}
+        with open(self.base_filepath + '_manifest.json', 'wb') as f:
+            json.dump(manifest, f, indent=2)
+
+
+# Band writers by --tall-output name.
+BAND_WRITERS = {'pdf':PdfBandWriter,
+                'segments':SegmentBandWriter}
+
+
+class BandCanvas(object):
+    
+    """A stitching canvas that only keeps the bands being pasted into.
+    
+    Images must be pasted top to bottom (as the stitched screenshots are),
+    bands above the last paste are complete and flushed to the writer.
+    Memory stays about two bands plus the screenshot, however tall the
+    page is.
+    
+    """
+    
+    def __init__(self, writer, width, height, band_height=None):
+        """Constructs a Band Canvas instance.
+        
+        @param writer: The BandWriter.
+        @param width: The width of the page.
+        @param height: The height of the page.
+        @keyword band_height: The height of the bands.
+        
+        """
+        self.writer = writer
+        self.size = (width, height)
+        self.band_height = band_height or TALL_BAND_HEIGHT
+        # self.open = {band number: Image, ...}
+        self.open = {}
+        # Next band to flush.
+        self.next_band = 0
+    
+    def _band(self, n):
+        band = self.open.get(n)
+        if band is None:
+            top = n * self.band_height
+            band = self.open[n] = Image.new(
+                'RGB', (self.size[0], min(self.band_height, self.size[1] - top)))
+        return band
+    
+    def _flush(self, end):
+        while self.next_band < end:
+            self.writer.write(self._band(self.next_band))
+            del self.open[self.next_band]
+            self.next_band += 1
+    
+    def paste(self, image, offset):
+        """Pastes an image, like Image.paste(image, offset)."""
+        x, y = offset
+        # Later pastes are at or below y.
+        self._flush(min(y, self.size[1]) // self.band_height)
+        bottom = min(y + image.size[1], self.size[1])
+        for n in range(max(y // self.band_height, self.next_band),
+                       (bottom - 1) // self.band_height + 1):
+            self._band(n).paste(image, (x, y - n * self.band_height))
+    
+    def close(self):
+        """Flushes the remaining bands and closes the writer."""
+        self._flush((self.size[1] + self.band_height - 1) // self.band_height)
+        self.writer.close()
+
+
+class EncodePool(object):
+    
+    """Encodes and writes screenshots in worker processes.
+    
+    The browser threads hand over the images and move on to the next page.
+    Images go to the processes as uncompressed temporary files, written in
+    blocks, so the canvas is not copied in memory and is freed as soon as
+    it is handed over.  At most max_pending images wait to be encoded,
+    submit() blocks while the pool is behind.
+    
+    On Windows, where processes are spawned and re-import this module, the
+    images are encoded by threads instead (PIL releases the GIL while
+    encoding).
+    
+    An image not written after task_timeout secs is counted as an error
+    and its slot freed: the pool does not report the tasks of a process
+    that died (eg: killed when out of memory).
+    
+    """
+    
+    def __init__(self, processes=2, max_pending=None, task_timeout=600):
+        """Constructs an Encode Pool instance.
+        
+        @keyword processes: Number of encoding processes, 0 to encode on
+            the calling thread.
+        @keyword max_pending: Max number of images submitted and not
+            encoded yet (default: 2 per process).
+        @keyword task_timeout: Secs after which a submitted image not
+            written yet is given up.
+        
+        """
+        self.pool = None
+        self.threads = os.name == 'nt'
+        if processes:
+            self.pool = ThreadPool(processes) if self.threads else multiprocessing.Pool(processes)
+        self.max_pending = max_pending or processes * 2 or 1
+        self.task_timeout = task_timeout
+        # self.results = [(AsyncResult, raw_filepath, outputs, deadline), ...]
+        self.results = []
+        # Slots taken by submit() calls handing over their image.
+        self.reserved = 0
+        # Notified when a result is ready or a slot is freed.
+        self.cond = threading.Condition()
+        self.errors = 0
+        self.lost = 0
+        self.lock = threading.Lock()
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+    
+    def submit(self, image, outputs):
+        """Encodes and writes an image.
+        
+        @param image: The PIL Image.
+        @param outputs: List of (filepath, format, save params) to write.
+        
+        """
+        if self.pool is None:
+            self._done(save_image(image, outputs))
+            return
+        with self.cond:
+            while True:
+                self._collect()
+                if len(self.results) + self.reserved < self.max_pending:
+                    break
+                self._wait()
+            self.reserved += 1
+        raw_filepath = None
+        result = None
+        try:
+            if self.threads:
+                result = self.pool.apply_async(save_image, (image, outputs),
+                                               callback=self._notify)
+            else:
+                fd, raw_filepath = tempfile.mkstemp(prefix='encode-', suffix='.tiff')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        image.save(f, 'TIFF')
+                except Exception:
+                    os.remove(raw_filepath)
+                    raise
+                result = self.pool.apply_async(encode_image, (raw_filepath, outputs),
+                                               callback=self._notify)
+        finally:
+            with self.cond:
+                self.reserved -= 1
+                if result is not None:
+                    self.results.append((result, raw_filepath, outputs,
+                                         time.time() + self.task_timeout))
+                self.cond.notify_all()
+    
+    def _notify(self, error):
+        # Runs on the pool's result thread, the result is collected by
+        # _collect().
+        with self.cond:
+            self.cond.notify_all()
+    
+    def _wait(self):
+        # Waits (holding self.cond) for a result, or the first deadline.
+        secs = 1.0
+        if self.results:
+            secs = min(r[3] for r in self.results) - time.time()
+        self.cond.wait(max(secs, 0.01))
+    
+    def _collect(self):
+        # Collects (holding self.cond) the results ready, and gives up on
+        # the ones past their deadline.
+        now = time.time()
+        results = []
+        for result, raw_filepath, outputs, deadline in self.results:
+            if result.ready():
+                try:
+                    error = result.get()
+                except Exception:
+                    error = traceback.format_exc()
+                self._done(error)
+            elif now >= deadline:
+                self.lost += 1
+                self._done('Gave up on writing %s after %s secs (encoding process died?)' %
+                           (outputs[0][0], self.task_timeout))
+                if raw_filepath and os.path.exists(raw_filepath):
+                    os.remove(raw_filepath)
+            else:
+                results.append((result, raw_filepath, outputs, deadline))
+        self.results = results
+    
+    def _done(self, error):
+        if error:
+            with self.lock:
+                self.errors += 1
+            log('ERROR',self.logfile,error,TAG=self._TAG)
+    
+    def close(self):
+        """Waits for the submitted images to be written."""
+        if self.pool is None:
+            return
+        self.pool.close()
+        with self.cond:
+            while True:
+                self._collect()
+                if not self.results and not self.reserved:
+                    break
+                self._wait()
+        if self.lost:
+            # The pool waits for the lost tasks forever.
+            self.pool.terminate()
+        else:
+            self.pool.join()
+        self.pool = None
+
+
+class DownloadTracker(object):
+    
+    """Tracks the browser downloads and moves them as they complete.
+    
+    Downloads are moved to the level directory of the Item whose page
+    started them (see expect()), on a mover thread, so the crawl does not
+    wait on downloads.  A download is complete when its final file (no
+    .part/.crdownload) is renamed or written in a download directory.
+    
+    Subclasses watch the download directories (_watch()) and call
+    _created(), _renamed() and _completed().
+    
+    """
+    
+    # Partial downloads of Firefox (<name>.part) and Chrome.
+    _partial_re = re.compile(r'\.(part|crdownload)$')
+    # Number of Items loaded kept per download directory.
+    _OWNERS = 16
+    # File times lag time.time() by up to a kernel tick.
+    _MTIME_SLACK = 0.05
     
-    _start_url = None
-    # Cookies are global for all browsers.
-    _cookies = None
+    def __init__(self):
+        """Constructs a Download Tracker instance."""
+        self.lock = threading.Lock()
+        self.dirs = set()
+        # self.owners = {download_dir: [(since, item, level), ...]}, the last
+        # Items loaded in each download directory.
+        self.owners = {}
+        # self.downloads = {(download_dir, name): (item, level, start time)},
+        # the downloads in progress, by final name.
+        self.downloads = {}
+        self.moves = Queue.Queue()
+        # self.queued = set([(download_dir, name), ...]), the files to move.
+        self.queued = set()
+        self.moved_cnt = 0
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+        self._mover = threading.Thread(target=self._move_loop, name='download-mover')
+        self._mover.daemon = True
+        self._mover.start()
     
-    def __init__(self, start_url=None, cookies=None):
-        """Constructs a Browser Manager instance.
+    def watch(self, download_dir):
+        """Starts tracking the downloads of a download directory."""
+        with self.lock:
+            self.dirs.add(download_dir)
+        self._watch(download_dir)
+    
+    def _watch(self, download_dir):
+        raise NotImplementedError
+    
+    def expect(self, download_dir, item, level):
+        """Attributes the downloads started next in download_dir to an Item.
         
-        @param start_url: The start URL to load on the browsers.
-        @param cookies: The cookies to use on the browsers.
+        @param download_dir: The download directory of the Item's browser.
+        @param item: The Item object about to be loaded.
+        @param level: The level of the Item.
         
         """
-        # {level: browser, ...}
-        self.browsers = {}
-        self._cookies = cookies
+        with self.lock:
+            owners = self.owners.setdefault(download_dir, [])
+            owners.append((time.time(), item, level))
+            del owners[:-self._OWNERS]
     
-    def set_browser_cookies(self, browser, url, cookies):
-        """Sets cookies on the browser at the requested url page.
+    def _owner(self, download_dir, at=None):
+        # The Item loading at time at (default: now), or (None, None).
+        for since, item, level in reversed(self.owners.get(download_dir, ())):
+            if at is None or since <= at + self._MTIME_SLACK:
+                return item, level
+        return None, None
+    
+    def _final_name(self, name):
+        return self._partial_re.sub('', name)
+    
+    def _created(self, download_dir, name, at=None):
+        key = (download_dir, self._final_name(name))
+        with self.lock:
+            item, level = self._owner(download_dir, at)
+            if key not in self.downloads and item is not None:
+                self.downloads[key] = (item, level, at or time.time())
+    
+    def _renamed(self, download_dir, old_name, new_name):
+        # Chrome renames temporary downloads to <name>.crdownload, then <name>.
+        with self.lock:
+            owner = self.downloads.pop((download_dir, self._final_name(old_name)), None)
+            if owner is not None:
+                self.downloads.setdefault((download_dir, self._final_name(new_name)), owner)
+        self._created(download_dir, new_name)
+        if not self._partial_re.search(new_name):
+            self._completed(download_dir, new_name)
+    
+    def _completed(self, download_dir, name):
+        if self._partial_re.search(name):
+            return
+        # Firefox writes an empty <name> next to <name>.part while downloading.
+        if os.path.exists(os.path.join(download_dir, name + '.part')):
+            return
+        with self.lock:
+            if (download_dir, name) in self.queued:
+                return
+            self.queued.add((download_dir, name))
+            owner = (self.downloads.pop((download_dir, name), None) or
+                     self._owner(download_dir) + (None,))
+        self.moves.put((download_dir, name) + owner)
+    
+    def _move_loop(self):
+        while True:
+            task = self.moves.get()
+            try:
+                if task is None:
+                    break
+                self._move(*task)
+            except Exception:
+                log('ERROR',self.logfile,traceback.format_exc(),TAG=self._TAG)
+            finally:
+                if task is not None:
+                    with self.lock:
+                        self.queued.discard(task[:2])
+                self.moves.task_done()
+    
+    def _move(self, download_dir, name, item, level, start_time):
+        src = os.path.join(download_dir, name)
+        if item is None or not os.path.isfile(src):
+            # Not started by a page, or moved already (eg: by a rescan).
+            return
+        size = os.path.getsize(src)
+        secs = round(time.time() - start_time, 3) if start_time else None
+        dst = move_file(src, os.path.join(parent_output_dir, str(level)))
+        if dst is None:
+            return
+        with self.lock:
+            self.moved_cnt += 1
+        log('INFO',self.logfile,'Download complete: %s (%s bytes, %s secs) from %s' %
+            (dst, size, secs, item), TAG=self._TAG)
+        item_mgr.add_download([os.path.relpath(dst, parent_output_dir), item.url,
+                               item.onclick_id, level, size, secs, file_sha256(dst)])
+    
+    def _partials(self):
+        with self.lock:
+            download_dirs = list(self.dirs)
+        return [os.path.join(x, name) for x in download_dirs if os.path.isdir(x)
+                for name in os.listdir(x) if self._partial_re.search(name)]
+    
+    def close(self, timeout=300, wait_secs=10):
+        """Waits for the downloads in progress, then moves what is left.
         
-        @param browser: The browser to set the cookie.
-        @param url: The URL to load on the browser.
-        @param cookies: The cookies to load on the browser.
+        Call before the browsers are closed.
+        
+        @keyword timeout: Max secs to wait for the downloads in progress.
+        @keyword wait_secs: The interval to check the downloads.
         
         """
-        if not any([url,cookies]):
-            return
-        # Load cookies.
-        browser.get(url)
-        time.sleep(0.2)
-        cookies = pickle.load(open(script_args.get('cookies'),'rb'))
-        for cookie in cookies:
-            browser.add_cookie(cookie)
-        # Re-load the page so the cookies will take effect.
-        browser.get(url)
-        time.sleep(0.2)
+        deadline = time.time() + timeout
+        incomplete = self._partials()
+        while incomplete and time.time() < deadline:
+            log('INFO',self.logfile,'Waiting for downloads to complete...: %s' % incomplete,
+                TAG=self._TAG)
+            time.sleep(min(wait_secs, max(0, deadline - time.time())))
+            incomplete = self._partials()
+        for path in incomplete:
+            log('WARNING',self.logfile,'Download did not complete: %s' % path,
+                TAG=self._TAG)
+        self._stop()
+        # Completions the watcher missed.
+        with self.lock:
+            download_dirs = list(self.dirs)
+        for download_dir in download_dirs:
+            if not os.path.isdir(download_dir):
+                continue
+            for name in os.listdir(download_dir):
+                if not self._partial_re.search(name):
+                    self._completed(download_dir, name)
+        self.moves.put(None)
+        self._mover.join()
     
-    @staticmethod
-    def get_new_browser_profile(download_dir=None, browser_type=BrowserType.FIREFOX):
-        """Gets a new Firefox Profile with some preferences set for
-        automatically downloading files without prompting.
-        
-        http://yizeng.me/2014/05/23/download-pdf-files-automatically-in-firefox-using-selenium-webdriver/
+    def _stop(self):
+        """Stops watching the download directories."""
+        pass
+
+
+class PollingDownloadTracker(DownloadTracker):
+    
+    """Tracks downloads by listing the download directories.
+    
+    A file is complete once it is not partial and its size did not change
+    between two listings.
+    
+    """
+    
+    def __init__(self, poll_secs=1):
+        """Constructs a Polling Download Tracker instance.
         
-        @keyword download_dir: The download directory to set.
-        @return: A webdriver.FirefoxProfile.
+        @keyword poll_secs: Secs between the listings.
         
         """
-        if browser_type == BrowserType.CHROME:
-            return BrowserMgr._get_new_chrome_profile(download_dir=download_dir)
-        # Initialize browser profiles.
-        # For now it is set on all browsers.
-        profile = webdriver.FirefoxProfile()
-        profile.set_preference('browser.download.folderList', 2)
-        profile.set_preference('browser.download.manager.showWhenStarting', False)
-        # Disable Firefox's built-in PDF viewer.
-        profile.set_preference('pdfjs.disabled', True)
-        # Disable Adobe Acrobat's PDF preview plugin.
-        profile.set_preference('plugin.scan.plid.all', False)
-        profile.set_preference('plugin.scan.Acrobat', '99.0')
-        # Set download dir.
-        if download_dir:
-            profile.set_preference('browser.download.dir', download_dir)
-        # MIME types to always save to disk (download_dir).
-        # Try to set all of the Microsoft Office file types.
-        types = ('application/pdf,application/octet-stream,text/calendar' +
-                 MS_MimeTypes.get_unique_mime_types(as_string=True))
-        profile.set_preference('browser.helperApps.neverAsk.saveToDisk', types)
-        return profile
+        super(PollingDownloadTracker, self).__init__()
+        self.poll_secs = poll_secs
+        # self.listings = {download_dir: {name: size}}, the last listings.
+        self.listings = {}
+        self._stopped = threading.Event()
+        self._poller = threading.Thread(target=self._poll_loop, name='download-poller')
+        self._poller.daemon = True
+        self._poller.start()
     
-    @staticmethod
-    def _get_new_chrome_profile(download_dir=None):
-        profile = webdriver.ChromeOptions()
-        prefs = {'download.prompt_for_download':False,
-                 'download.directory_upgrade':True,
-                 'plugins.plugins_disabled':['Chrome PDF Viewer'],
-                 'extensions_to_open':'',
-                 # Chrome 57 changed pdf settings.
-                 'plugins.always_open_pdf_externally':True}
-        if download_dir:
-            prefs.update({'download.default_directory':download_dir})
-        profile.add_experimental_option('prefs',prefs)
-        # Remove the "Chrome is controlled by automated software" infobar.
-        profile.add_experimental_option('excludeSwitches', ['enable-automation'])
-        return profile
+    def _watch(self, download_dir):
+        # The first listing is of the files there already.
+        with self.lock:
+            self.listings[download_dir] = None
     
-    def _new_browser(self, start_url=None, cookies=None, download_dir=None):
-        profile = self.get_new_browser_profile(download_dir=download_dir)
-        browser = webdriver.Firefox(firefox_profile=profile)
-        _cookies = cookies or self.cookies
-        if start_url and _cookies:
-            self.set_browser_cookies(browser, start_url, _cookies)
-        if start_url:
-            browser.get(start_url)
-            time.sleep(0.3)
-        return browser
+    def _list(self, download_dir):
+        stats = {}
+        for name in os.listdir(download_dir):
+            try:
+                stats[name] = os.stat(os.path.join(download_dir, name))
+            except OSError:
+                # Renamed or moved since listed.
+                pass
+        return stats
+    
+    def _poll_loop(self):
+        while not self._stopped.wait(self.poll_secs):
+            with self.lock:
+                download_dirs = list(self.listings)
+            for download_dir in download_dirs:
+                try:
+                    self._poll(download_dir)
+                except Exception:
+                    log('ERROR',self.logfile,traceback.format_exc(),TAG=self._TAG)
+    
+    def _poll(self, download_dir):
+        last = self.listings[download_dir]
+        stats = self._list(download_dir)
+        self.listings[download_dir] = sizes = dict((k, v.st_size) for k, v in stats.iteritems())
+        if last is None:
+            return
+        # Attributed to the Item loading when the file was created, Firefox
+        # placeholders are not written to after that.
+        new_names = sorted((x for x in sizes if x not in last), key=lambda x: stats[x].st_mtime)
+        for name in new_names:
+            self._created(download_dir, name, at=stats[name].st_mtime)
+        # A partial gone at the same time a final file appears was renamed.
+        gone = [x for x in last if x not in sizes and self._partial_re.search(x)]
+        for name in new_names:
+            if gone and not self._partial_re.search(name):
+                self._renamed(download_dir, gone.pop(), name)
+        for name, size in sizes.iteritems():
+            if (name in last and last[name] == size and size and
+                    not self._partial_re.search(name)):
+                self._completed(download_dir, name)
+    
+    def _stop(self):
+        self._stopped.set()
+        self._poller.join()
+
+
+class InotifyDownloadTracker(DownloadTracker):
     
-    def get_browser(self, level, download_dir=None):
-        """Gets the browser associated with the level.
+    """Tracks downloads with Linux inotify events (through ctypes)."""
+    
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct('iIII')
+    _libc = None
+    
+    @classmethod
+    def available(cls):
+        """Returns True if inotify can be used."""
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                   use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+            except (OSError, AttributeError):
+                cls._libc = False
+            else:
+                libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                                   ctypes.c_uint32]
+                cls._libc = libc
+        return bool(cls._libc)
+    
+    def __init__(self):
+        """Constructs an Inotify Download Tracker instance.
         
-        @param level: The level of the browser.
-        @keyword download_dir: If browser have not been created yet, 
-                uses this as the new download dir.
+        @raise OSError: If inotify is not available.
         
         """
-        level = str(level)
-        try:
-            browser = self.browsers[level]
-        except KeyError:
-            browser = self._new_browser(start_url=self._start_url,
-                                        cookies=self._cookies,
-                                        download_dir=download_dir)
-            self.browsers[level] = browser
-        return browser
+        if not self.available():
+            raise OSError('inotify is not available')
+        super(InotifyDownloadTracker, self).__init__()
+        self.fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # self.watches = {watch descriptor: download_dir}
+        self.watches = {}
+        # self.renames = {cookie: old name}, renames seen half way.
+        self.renames = {}
+        self._stop_r, self._stop_w = os.pipe()
+        self._reader = threading.Thread(target=self._read_loop, name='download-inotify')
+        self._reader.daemon = True
+        self._reader.start()
     
-    def get_validation_browser(self):
-        """Gets the validation browser (level 0)."""
-        return self.get_browser(0)
+    def _watch(self, download_dir):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self._libc.inotify_add_watch(self.fd, download_dir, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), download_dir)
+        with self.lock:
+            self.watches[wd] = download_dir
+    
+    def _read_loop(self):
+        while True:
+            ready = select.select([self.fd, self._stop_r], [], [])[0]
+            if self._stop_r in ready:
+                break
+            data = os.read(self.fd, 65536)
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = self._EVENT.unpack_from(data, pos)
+                pos += self._EVENT.size
+                name = data[pos:pos + length].rstrip('\0')
+                pos += length
+                try:
+                    self._event(wd, mask, cookie, name)
+                except Exception:
+                    log('ERROR',self.logfile,traceback.format_exc(),TAG=self._TAG)
+    
+    def _event(self, wd, mask, cookie, name):
+        if mask & self.IN_Q_OVERFLOW:
+            log('WARNING',self.logfile,'Events lost, downloads are moved on close.',
+                TAG=self._TAG)
+            return
+        with self.lock:
+            download_dir = self.watches.get(wd)
+        if download_dir is None:
+            return
+        if mask & self.IN_CREATE:
+            # Attributed to the Item loading when the file was created, the
+            # events are read later.
+            try:
+                at = os.stat(os.path.join(download_dir, name)).st_mtime
+            except OSError:
+                at = None
+            self._created(download_dir, name, at=at)
+        elif mask & self.IN_MOVED_FROM:
+            # Only renames of downloads, not the moves to the level directories.
+            with self.lock:
+                tracked = (download_dir, self._final_name(name)) in self.downloads
+            if tracked:
+                self.renames[cookie] = name
+        elif mask & self.IN_MOVED_TO:
+            old_name = self.renames.pop(cookie, None)
+            if old_name is None:
+                # Moved in from elsewhere.
+                self._created(download_dir, name)
+                self._completed(download_dir, name)
+            else:
+                self._renamed(download_dir, old_name, name)
+        elif mask & self.IN_CLOSE_WRITE:
+            # Empty files are placeholders, or get moved on close.
+            path = os.path.join(download_dir, name)
+            if os.path.isfile(path) and os.path.getsize(path):
+                self._completed(download_dir, name)
+    
+    def _stop(self):
+        os.write(self._stop_w, 'x')
+        self._reader.join()
+        os.close(self.fd)
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+
+
+# --download-watch backends.
+DOWNLOAD_TRACKERS = {'inotify':InotifyDownloadTracker,
+                     'poll':PollingDownloadTracker}
 
 
 class MS_MimeTypes(object):
@@ -561,6 +3446,344 @@ class MS_MimeTypes(object):
             return list(set(cls.ms_map.values()))
 
 
+# MIME types of the files downloaded instead of screenshot.  vnd includes
+# Microsoft file types.
+DOWNLOAD_MIME_TYPES = frozenset(['application/pdf','application/octet-stream','text/calendar'] +
+                                MS_MimeTypes.get_unique_mime_types())
+
+
+class ContentTypeClassifier(object):
+    
+    """Classifies URLs by content type.
+    
+    The type is guessed from the URL extension first.  URLs without one
+    are probed (HEAD, or a 1 byte GET if HEAD is not allowed) and the
+    Content-Type/Content-Disposition found is memoized for the URL pattern:
+    the host, the path with numbers and the last segment (if it has no
+    extension) as wildcards, and the query parameter names.  Patterns are
+    appended to a CSV file, and loaded from it by the next runs.
+    
+    """
+    
+    _digits_re = re.compile(r'\d+')
+    
+    def __init__(self, cache_file=None, cookies=None, user_agent=None, probe=True,
+                 timeout=10):
+        """Constructs a Content Type Classifier instance.
+        
+        @keyword cache_file: The CSV file of the patterns classified.
+        @keyword cookies: The browser cookies (from browser.get_cookies()).
+        @keyword user_agent: The User-Agent header to send.
+        @keyword probe: Probe URLs without extension, otherwise only their
+                pattern is looked up.
+        @keyword timeout: The timeout in secs of a probe.
+        
+        """
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.session = (new_http_session(cookies=cookies, user_agent=user_agent)
+                        if probe else None)
+        self.lock = threading.Lock()
+        # self.types = {pattern: content type}
+        self.types = {}
+        self.probe_cnt = 0
+        self.logfile = logfile
+        self._TAG = self.__class__.__name__
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                csv_reader = csv.reader(f, delimiter=',', quotechar='"')
+                # Assume first line is header.
+                csv_reader.next()
+                for row in csv_reader:
+                    # A crash may leave the last row incomplete.
+                    if len(row) == 2:
+                        self.types[row[0]] = row[1]
+            log('INFO',self.logfile,'Loaded %s content types from %s' %
+                (len(self.types), cache_file), TAG=self._TAG)
+    
+    @classmethod
+    def pattern(cls, url):
+        """Returns the pattern of a URL."""
+        parts = urlparse.urlsplit(url)
+        segments = cls._digits_re.sub('*', parts.path).split('/')
+        if '.' not in segments[-1]:
+            segments[-1] = '*'
+        params = sorted(set(k for k, _ in urlparse.parse_qsl(parts.query,
+                                                              keep_blank_values=True)))
+        return '%s://%s%s?%s' % (parts.scheme, parts.netloc.lower(), '/'.join(segments),
+                                 '&'.join(params))
+    
+    @staticmethod
+    def guess(url):
+        """Guesses the content type of a URL from its extension."""
+        return (mimetypes.guess_type(url)[0] or
+                mimetypes.guess_type(urlparse.urlsplit(url).path)[0])
+    
+    def classify(self, url):
+        """Gets the content type of a URL.
+        
+        @param url: The URL.
+        @return: The content type, or None if not known.
+        
+        """
+        content_type = self.guess(url)
+        if content_type is not None:
+            return content_type
+        pattern = self.pattern(url)
+        with self.lock:
+            if pattern in self.types:
+                return self.types[pattern]
+        if self.session is None:
+            return None
+        content_type = self.probe(url)
+        if content_type is not None:
+            self.learn(url, content_type, pattern=pattern)
+        return content_type
+    
+    def learn(self, url, content_type, pattern=None):
+        """Memoizes the content type of a URL pattern.
+        
+        @param url: The URL.
+        @param content_type: Its content type.
+        @keyword pattern: The URL pattern, if computed already.
+        
+        """
+        if pattern is None:
+            if self.guess(url) is not None:
+                # Classified by its extension.
+                return
+            pattern = self.pattern(url)
+        with self.lock:
+            if self.types.get(pattern) == content_type:
+                return
+            self.types[pattern] = content_type
+            if self.cache_file:
+                new_file = not os.path.exists(self.cache_file)
+                with open(self.cache_file, 'a') as f:
+                    csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+                    if new_file:
+                        csv_writer.writerow(['PATTERN','CONTENT_TYPE'])
+                    csv_writer.writerow([pattern, content_type])
+        log('INFO',self.logfile,'%s is %s' % (pattern, content_type), TAG=self._TAG)
+    
+    def probe(self, url):
+        """Requests the content type of a URL, without its body.
+        
+        @return: The content type, application/octet-stream for
+                attachments, or None if the request failed.
+        
+        """
+        with self.lock:
+            self.probe_cnt += 1
+        try:
+            r = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            r.close()
+            if r.status_code in (405, 501) or not r.headers.get('Content-Type'):
+                r = self.session.get(url, headers={'Range':'bytes=0-0'},
+                                     timeout=self.timeout, stream=True)
+                r.close()
+        except requests.exceptions.RequestException:
+            log('WARNING',self.logfile,'Unable to probe %s: %s' %
+                (url,traceback.format_exc().splitlines()[-1]),TAG=self._TAG)
+            return None
+        if r.status_code >= 400:
+            return None
+        content_type = r.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if (r.headers.get('Content-Disposition', '').lower().startswith('attachment') and
+                content_type not in DOWNLOAD_MIME_TYPES):
+            return 'application/octet-stream'
+        return content_type or None
+    
+    def close(self):
+        """Closes the probe connections."""
+        if self.session is not None:
+            self.session.close()
+
+
+def get_browser():
+    """Gets the browser of the calling thread.
+
+    Worker threads have their own browser, otherwise it is the main browser.
+
+    """
+    return getattr(_thread_local, 'browser', None) or browser
+
+
+def get_download_dir():
+    """Gets the browser download directory of the calling thread."""
+    return (getattr(_thread_local, 'download_dir', None) or
+            os.path.join(parent_output_dir,'main'))
+
+
+def fetch_page(item, screenshot=False):
+    """Fetches an Item's page source.
+    
+    Uses the HTTP fetcher when the page is not going to be screenshot, and
+    falls back to the browser when needed.
+    
+    @param item: The Item object.
+    @keyword screenshot: The page will be screenshot (needs the browser).
+    @return: The page source.
+    @raise TimeoutException: If the page timed out.
+    
+    """
+    if http_fetcher and not screenshot:
+        page_source = http_fetcher.fetch(item)
+        if page_source is not None:
+            return page_source
+    return browser_fetcher.fetch(item, source=needs_page_source(),
+                                 profile=page_load_profile(screenshot=screenshot))
+
+
+def page_load_profile(screenshot=False):
+    """Returns the load profile of a page (see LOAD_PROFILES).
+    
+    With --load-profile=auto, screenshots need the full page, saved and
+    fingerprinted sources do not need images, fonts or media, and pages
+    only loaded for their links do not need stylesheets either.
+    
+    @keyword screenshot: The page will be screenshot.
+    
+    """
+    if load_profile != 'auto':
+        return load_profile
+    if screenshot:
+        return 'full'
+    if script_args.get('get-source') or skip_duplicate_content:
+        return 'source'
+    return 'discovery'
+
+
+def launch_load_profile():
+    """Returns the load profile set in the Firefox profiles.
+    
+    Firefox preferences can not change once the browser is started, so
+    with --load-profile=auto it is the profile of the pages of the crawl
+    that need the most resources.
+    
+    """
+    return page_load_profile(screenshot=needs_screenshot())
+
+
+def set_load_profile(driver, profile):
+    """Sets the resources skipped by the next page loads of a browser.
+    
+    Chrome blocks the URL patterns of the profile through DevTools, other
+    browsers keep the profile they were started with.
+    
+    @param driver: The webdriver (eg: browser).
+    @param profile: The LOAD_PROFILES name.
+    
+    """
+    if not isinstance(driver, webdriver.Chrome):
+        return
+    if getattr(driver, '_load_profile', 'full') == profile:
+        return
+    urls = []
+    for resource in LOAD_PROFILES[profile]:
+        urls.extend(BLOCKABLE_RESOURCES[resource][0])
+    if LOAD_PROFILES[profile]:
+        urls.extend(blocked_urls)
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls':urls})
+    except WebDriverException:
+        log('WARNING',logfile,'Unable to set the load profile to %s: %s' %
+            (profile, traceback.format_exc().splitlines()[-1]))
+    driver._load_profile = profile
+
+
+def needs_screenshot():
+    """Returns True if collected pages are screenshot."""
+    return not dry_run and not script_args.get('only-downloadable')
+
+
+def needs_page_source():
+    """Returns True if page sources are needed from the browser.
+    
+    With --js-links, links are read from the live DOM instead, unless the
+    sources are saved or fingerprinted.
+    
+    """
+    return (not js_links or bool(script_args.get('get-source')) or
+            skip_duplicate_content)
+
+
+def extract_links(page_source, search_results=False):
+    """Extracts the hyperlinks of a page with the --link-parser extractor.
+    
+    Only the Link tuples are kept, no parse tree.
+    
+    @param page_source: The HTML page source.
+    @keyword search_results: Only extract links with class
+        "search-result-link visitable".
+    @return: A list of Link tuples.
+    
+    """
+    global link_extractor
+    return link_extractor.extract(page_source, search_results=search_results)
+
+
+def get_page_links(item, search_results=False):
+    """Gets the hyperlinks of an Item's page.
+    
+    With --js-links, the links are read from the live DOM if the Item is
+    loaded in the calling thread's browser.  Otherwise the page source is
+    parsed.
+    
+    @param item: The Item object.
+    @keyword search_results: Only get links with class
+        "search-result-link visitable".
+    @return: A list of Link tuples.
+    
+    """
+    global js_links
+    with timed('links'):
+        if (js_links and getattr(_thread_local, 'page_item', None) is item and
+            not is_download_type(item)):
+            return browser_fetcher.get_links(search_results=search_results)
+        if item.page_source:
+            return extract_links(item.page_source, search_results=search_results)
+    return None
+
+
+def canonicalize_item(item):
+    """Canonicalizes an Item's URL, keeping the URL as found in raw_url."""
+    global url_canonicalizer
+    if url_canonicalizer is None:
+        return
+    url = url_canonicalizer.canonicalize(item.url)
+    if url != item.url:
+        item.raw_url, item.url = item.url, url
+
+
+def build_filename(url):
+    """Builds the base name of the output files for a URL.
+
+    @param url: The URL of the page.
+
+    """
+    filename = url.split('https://')[-1]
+    filename = re.sub(r'[^a-z.A-Z0-9]','.-',filename.split('http://')[-1])
+    if windows_filenames:
+        if len(filename) > 255:
+            # Strip out some characters from filename.
+            filename = filename[:50] +'__'+ filename[-50:]
+    return filename
+
+
+def replace_file(src, dst):
+    """Renames src to dst, replacing dst.
+    
+    Atomic on POSIX.  On Windows dst is removed first, readers should fall
+    back to src if dst is missing.
+    
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
 def wkhtmltopdf(item, filename, parent_dir, level):
     """Converts a url page to pdf.
     
@@ -587,10 +3810,9 @@ def wkhtmltopdf(item, filename, parent_dir, level):
     log('INFO',logfile,'wkhtmltopdf: Exporting to pdf: filepath=%s' % filepath)
     try:
         pdfkit.from_url(item.url, filepath)
-        time.sleep(0.5)
     except IOError:
         print traceback.format_exc()
-        item_mgr.error_cnt += 1
+        item_mgr.add_error(item.url)
 
 
 def get_page_as_file(item, filename, parent_dir, level):
@@ -601,16 +3823,8 @@ def get_page_as_file(item, filename, parent_dir, level):
         log('ERROR',logfile,"Page='%s': EXC=%s" %
             (item.url,traceback.format_exc().splitlines()[-1]))
         log('ERROR',logfile,'SKIPPING PAGE (get_page_as_file)...')
-        item_mgr.timeout_cnt += 1
-        if item.url in item_mgr.timeout_urls:
-            item_mgr.timeout_urls[item.url] += 1
-        else:
-            item_mgr.timeout_urls[item.url] = 1
-        item_mgr.error_cnt += 1
-        if item.url in item_mgr.error_urls:
-            item_mgr.error_urls[item.url] += 1
-        else:
-            item_mgr.error_urls[item.url] = 1
+        item_mgr.add_timeout(item.url)
+        item_mgr.add_error(item.url)
 
 
 def _get_page_as_file(item, filename, parent_dir, level):
@@ -624,8 +3838,9 @@ def _get_page_as_file(item, filename, parent_dir, level):
     @param level: The current level.
     
     """
-    global browser, logfile, item_mgr
-    parent_path = os.path.join(parent_dir, str(level), 'screenshots')
+    global logfile, item_mgr
+    browser = get_browser()
+    parent_path = screenshots_dir(parent_dir, level)
     if not os.path.isdir(parent_path):
         os.makedirs(parent_path, 0777)
     filepath = os.path.join(parent_path, filename)
@@ -635,41 +3850,68 @@ def _get_page_as_file(item, filename, parent_dir, level):
         log('INFO',logfile,'%s is downloadable type, skipping screenshot...' % item.url)
         return
     log('INFO',logfile,'Exporting to filepath=%s' % filepath)
-    if browser.current_url != item.url:
-        browser.get(item.url)
-        time.sleep(1)
+    # Reload unless the browser has this Item loaded (its URL may differ
+    # from the canonical one) with the full profile.
+    if (getattr(_thread_local, 'page_item', None) is not item or
+        getattr(browser, '_load_profile', 'full') != 'full'):
+        set_load_profile(browser, 'full')
+        with timed('navigate'):
+            browser.get(item.url)
+        page_waiter.wait(browser)
         if item.onclick_id:
-            time.sleep(0.5)
-            browser.find_element_by_id(item.onclick_id).click()
-            time.sleep(1)
+            with timed('onclick'):
+                browser.find_element_by_id(item.onclick_id).click()
+            page_waiter.wait(browser, what='onclick')
         item.page_source = browser.page_source
+        _thread_local.page_item = item
+    if re.search(r'#[^/]+$',item.url):
+        # Wait for the scroll to the section before the capture.
+        page_waiter.wait(browser, what='fragment')
 #     browser.get_screenshot_as_file(filepath)
 #     get_fullpage_screenshot(filepath)
     fullpage_screenshot(browser, filepath)
-    time.sleep(0.5)
-    found_fragment = re.search(r'#[^/]+$',item.url)
-    if found_fragment:
-        # The get_screenshot_as_file
-        time.sleep(5)
+
+
+def screenshots_dir(parent_dir, level):
+    """Returns the directory of a level's page captures."""
+    return os.path.join(parent_dir, str(level), 'screenshots')
+
+
+def capture_path(filename, level):
+    """Returns the file a page capture is written to.
+    
+    The screenshot in --image-format (or the PDF with --export-to-pdf), or
+    with --tall-output, the PDF or the segments manifest.
+    
+    @param filename: The capture's file name, as passed to get_page_as_file.
+    @param level: The level of the page.
+    @return: The filepath, relative to the output dir.
+    
+    """
+    global tall_output
+    filepath = os.path.join(screenshots_dir('', level), filename)
+    if tall_output:
+        base_filepath = '.'.join(filepath.split('.')[:-1])
+        if tall_output == 'pdf':
+            return base_filepath + '.pdf'
+        return base_filepath + '_manifest.json'
+    return screenshot_outputs(filepath)[0][0]
 
 
 def fullpage_screenshot(driver, filepath):
     """Takes a full page screenshot.
     
-    This is a workaround for the Firefox/Chrome webdrivers that stopped
-    support for full page screenshots. This function scrolls through the page
-    taking screenshots and then stitch them together to produce the
-    final full page.
+    Uses the browser's native full page screenshot if available (see
+    NativeCapture), otherwise stitches viewport screenshots together
+    (see stitch_screenshot()).
     
-    @note: Works for Firefox/Chrome.
-    @note: Code from here with some internal modifications:
-    https://stackoverflow.com/questions/41721734/taking-screenshot-of-full-page-with-selenium-python-chromedriver
+    Also exports the screenshot to PDF next to filepath.
     
     @param driver: The webdriver (eg: browser)
     @param filepath: The filepath to save the image to.
     
     """
-    global nav_elements
+    global nav_elements, page_capture
     # Execute some javascript to manipulate the page for better screenshots.
     # Try to find the top navigation or header pane so the it is not
     # captured on every stitch. This will be passed to javascript querySelector.
@@ -683,17 +3925,187 @@ def fullpage_screenshot(driver, filepath):
             }
         ''' % (nav, nav));
     # Override any scrolling behavior.
-    browser.execute_script('''
+    driver.execute_script('''
         document.body.parentElement.style.scrollBehavior = 'auto';
     ''')
     # Execute some javascript to manipulate the page for better screenshots.
     # Get rid of the scrollbars if any.
-    browser.execute_script('''
+    driver.execute_script('''
         const s = document.createElement("style");
         s.textContent = "body::-webkit-scrollbar { display: none;} body { scrollbar-width: none; }";
         document.head.insertAdjacentElement("beforeend", s);
     ''');
-    time.sleep(0.3)
+    page_waiter.wait_for_scroll(driver)
+    if page_capture is not None:
+        with timed('tiles'):
+            png = page_capture.capture(driver)
+        if png is not None:
+            # Chrome captures at the --downscale scale already.
+            save_screenshot(png, filepath,
+                            scale=1 if isinstance(driver, webdriver.Chrome) else downscale)
+            return True
+    return stitch_screenshot(driver, filepath)
+
+
+def screenshot_outputs(filepath):
+    """Returns the files to write for a screenshot.
+    
+    The screenshot in --image-format, and a PDF next to it.
+    
+    @param filepath: The screenshot filepath.
+    @return: List of (filepath, format, save params).
+    
+    """
+    global image_format, image_quality
+    base_filepath = '.'.join(filepath.split('.')[:-1])
+    pdf_output = (base_filepath + '.pdf', 'PDF', {})
+    if filepath.endswith('.pdf'):
+        return [pdf_output]
+    if image_format == 'png':
+        params = {}
+        if image_quality is not None:
+            params['compress_level'] = image_quality
+    else:
+        params = {'quality':image_quality or 90}
+    return [(base_filepath + IMAGE_FORMATS[image_format][1],
+             IMAGE_FORMATS[image_format][0], params),
+            pdf_output]
+
+
+def save_image(image, outputs):
+    """Writes an image to each output.
+    
+    @param image: The PIL Image.
+    @param outputs: List of (filepath, format, save params).
+    @return: None, or the error (traceback).
+    
+    """
+    try:
+        for filepath, format, params in outputs:
+            if format in ('PDF', 'JPEG') and image.mode != 'RGB':
+                image.convert('RGB').save(filepath, format, **params)
+            else:
+                image.save(filepath, format, **params)
+    except Exception:
+        return 'Unable to write %s\n%s' % (filepath, traceback.format_exc())
+    return None
+
+
+def default_encode_workers():
+    """Returns the default --encode-workers: 2, leaving a CPU to the
+    crawl (0, encoding in the browser thread, on a single CPU)."""
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return max(min(2, cpus - 1), 0)
+
+
+def encode_image(raw_filepath, outputs):
+    """Writes an uncompressed image file to each output, then removes it
+    (runs in EncodePool processes).
+    
+    @return: None, or the error (traceback).
+    
+    """
+    try:
+        try:
+            image = Image.open(raw_filepath)
+            image.load()
+        except Exception:
+            return 'Unable to read %s\n%s' % (raw_filepath, traceback.format_exc())
+        return save_image(image, outputs)
+    finally:
+        try:
+            os.remove(raw_filepath)
+        except OSError:
+            # Removed by EncodePool, once given up.
+            pass
+
+
+def encode_screenshot(image, filepath, outputs=None):
+    """Hands a screenshot to the encode pool.
+    
+    @param image: The PIL Image.
+    @param filepath: The screenshot filepath.
+    @keyword outputs: The outputs to write (default: screenshot_outputs()).
+    
+    """
+    global encode_pool
+    if outputs is None:
+        outputs = screenshot_outputs(filepath)
+    if not outputs:
+        return
+    with timed('encode'):
+        if encode_pool is None:
+            error = save_image(image, outputs)
+            if error:
+                log('ERROR',logfile,error)
+        else:
+            encode_pool.submit(image, outputs)
+
+
+def save_screenshot(png, filepath, scale=1):
+    """Saves a full page PNG screenshot, and exports it to PDF.
+    
+    With --tall-output, writes the screenshot as bands instead.
+    
+    @param png: The PNG data.
+    @param filepath: The filepath to save the image to.
+    @keyword scale: Scales the screenshot down (0-1].
+    
+    """
+    global tall_output
+    image = Image.open(StringIO(png))
+    if scale != 1:
+        with timed('stitch'):
+            image = scale_image(image, scale)
+    if tall_output:
+        with timed('write'):
+            writer = BAND_WRITERS[tall_output](filepath)
+            width, height = image.size
+            for top in range(0, height, TALL_BAND_HEIGHT):
+                writer.write(image.crop((0, top, width, min(top + TALL_BAND_HEIGHT, height))))
+            writer.close()
+        return
+    outputs = screenshot_outputs(filepath)
+    if image.size[1] > SCREENSHOT_MAX_HEIGHT:
+        image = image.crop((0, 0, image.size[0], SCREENSHOT_MAX_HEIGHT))
+    elif outputs[0][1:] == ('PNG', {}) and scale == 1:
+        # Already encoded.
+        with timed('write'), open(outputs[0][0],'wb') as f:
+            f.write(png)
+        outputs = outputs[1:]
+    encode_screenshot(image, filepath, outputs=outputs)
+
+
+def scale_image(image, scale):
+    """Returns an image scaled down (0 < scale <= 1)."""
+    size = (max(int(round(image.size[0] * scale)), 1),
+            max(int(round(image.size[1] * scale)), 1))
+    return image.resize(size, Image.LANCZOS)
+
+
+def stitch_screenshot(driver, filepath):
+    """Takes a full page screenshot by stitching viewport screenshots.
+    
+    This is a workaround for the Firefox/Chrome webdrivers that stopped
+    support for full page screenshots. This function scrolls through the page
+    taking screenshots and then stitch them together to produce the
+    final full page.
+    
+    @note: Works for Firefox/Chrome.
+    @note: Code from here with some internal modifications:
+    https://stackoverflow.com/questions/41721734/taking-screenshot-of-full-page-with-selenium-python-chromedriver
+    
+    With --tall-output, completed bands are written as the screenshots are
+    stitched, so pages are not truncated and memory stays constant.
+    
+    @param driver: The webdriver (eg: browser), prepared by fullpage_screenshot().
+    @param filepath: The filepath to save the image to.
+    
+    """
+    global tall_output
     ###########################################################################
     # Initial calculations and scroll through of page to load all contents.
     # There may be some contents that are lazy load, meaning it might not
@@ -723,12 +4135,11 @@ def fullpage_screenshot(driver, filepath):
     # Initial scroll through of the page to load contents.
     for rectangle in rectangles:
         driver.execute_script("window.scrollTo({{left: {0}, top: {1}, behavior: 'auto'}})".format(rectangle[0], rectangle[1]))
-        time.sleep(0.2)
-    time.sleep(1)
+        page_waiter.wait_for_scroll(driver)
+    # Let the lazy loaded contents finish loading.
+    page_waiter.wait(driver, what='lazy contents')
     driver.execute_script("window.scrollTo(0, 0)")
-    time.sleep(1)
-    driver.execute_script("window.scrollTo(0, 0)")
-    time.sleep(1)
+    page_waiter.wait_for_scroll(driver)
     ###########################################################################
     # This should now be a pretty accurate fetch of viewport and page size.
     ###########################################################################
@@ -757,22 +4168,20 @@ def fullpage_screenshot(driver, filepath):
     ###########################################################################
     stitched_image = None
     stitched_image_height = 0
-    # This MAX_HEIGHT is a limitation of the PIL library.
-    # NOTE: The PDF max height appears to be less than this.
-    # TODO: Break into different pages based on PDF max page height?
-    STITCHED_IMAGE_MAX_HEIGHT = 65500
+    STITCHED_IMAGE_MAX_HEIGHT = SCREENSHOT_MAX_HEIGHT
     previous = None
     overlap = False
-    part = 0
     # Main scroll through page and take screenshots.
     for rectangle in rectangles:
         # Note: Always scroll to the top first otherwise we get
         # parts of website stitched unevenly.
         driver.execute_script("window.scrollTo({{left: {0}, top: {1}, behavior: 'auto'}})".format(rectangle[0], rectangle[1]))
-        time.sleep(0.2)
-        file_name = '%s_part_%s.png' % (filepath,part)
-        driver.get_screenshot_as_file(file_name)
-        screenshot = Image.open(file_name)
+        page_waiter.wait_for_scroll(driver)
+        with timed('tiles'):
+            screenshot = Image.open(StringIO(driver.get_screenshot_as_png()))
+        if downscale != 1:
+            with timed('stitch'):
+                screenshot = scale_image(screenshot, downscale)
         # NOTE: CSS pixels are not equal to device pixels.
         # We need to do conversion here as it might not always be equal.
         conv = float(screenshot.size[1]) / viewport_height
@@ -782,40 +4191,35 @@ def fullpage_screenshot(driver, filepath):
             overlap = True
         else:
             offset = (int(rectangle[0] * conv), int(rectangle[1] * conv))
-        if offset[1] >= STITCHED_IMAGE_MAX_HEIGHT:
+        if offset[1] >= STITCHED_IMAGE_MAX_HEIGHT and not tall_output:
             # Simply break here and do not add additional stitches.
-            os.remove(file_name)
             break
+        if stitched_image is None and tall_output:
+            stitched_image = BandCanvas(BAND_WRITERS[tall_output](filepath),
+                                        screenshot.size[0], int(total_height * conv))
         if stitched_image is None:
             stitched_image_height = int(total_height * conv)
             if (stitched_image_height > STITCHED_IMAGE_MAX_HEIGHT):
                 stitched_image_height = STITCHED_IMAGE_MAX_HEIGHT
             stitched_image = Image.new('RGB', (screenshot.size[0], stitched_image_height))
-        if overlap:
-            # Mask out portion of the last image so that we only paste the
-            # bottom portion of the overlap.
-            # Create a new mask, fill = black.
-            # Draw out the visible part we want to mask in white.
-            mask = Image.new('L', stitched_image.size, 0)
-            draw = ImageDraw.Draw(mask)
-            box = tuple(int(x*conv) for x in rectangle)
-            draw.rectangle(box, fill=255)
-            # This needs to be the same size as the stitched image.
-            bottom_img = Image.new('RGB', stitched_image.size)
-            bottom_img.paste(screenshot, offset)
-            # Paste into stitched while masking out upper portion.
-            stitched_image.paste(bottom_img, box=(0,0), mask=mask)
-        else:
-            stitched_image.paste(screenshot, offset)
+        with timed('stitch'):
+            if overlap:
+                # Only paste the bottom portion of the overlap, the part of the
+                # last screenshot that is not stitched yet.
+                box = tuple(int(x*conv) for x in rectangle)
+                stitched_image.paste(screenshot.crop((box[0] - offset[0], box[1] - offset[1],
+                                                      box[2] - offset[0], box[3] - offset[1])),
+                                     box[:2])
+            else:
+                stitched_image.paste(screenshot, offset)
         del screenshot
-        os.remove(file_name)
-        part = part + 1
         previous = rectangle
-    # Export PNG.
-    stitched_image.save(filepath)
-    # Export to PDF.
-    pdf_filepath = '.'.join(filepath.split('.')[:-1] + ['pdf'])
-    stitched_image.save(pdf_filepath)
+    if tall_output:
+        with timed('write'):
+            stitched_image.close()
+        return True
+    # Export PNG and PDF, in the background.
+    encode_screenshot(stitched_image, filepath)
     return True
 
 
@@ -827,16 +4231,8 @@ def get_page_as_source(item, filename, parent_dir, level):
         log('ERROR',logfile,"Page='%s': EXC=%s" %
             (item.url,traceback.format_exc().splitlines()[-1]))
         log('ERROR',logfile,'SKIPPING PAGE (get_page_as_source)...')
-        item_mgr.timeout_cnt += 1
-        if item.url in item_mgr.timeout_urls:
-            item_mgr.timeout_urls[item.url] += 1
-        else:
-            item_mgr.timeout_urls[item.url] = 1
-        item_mgr.error_cnt += 1
-        if item.url in item_mgr.error_urls:
-            item_mgr.error_urls[item.url] += 1
-        else:
-            item_mgr.error_urls[item.url] = 1
+        item_mgr.add_timeout(item.url)
+        item_mgr.add_error(item.url)
 
 
 def _get_page_as_source(item, filename, parent_dir, level):
@@ -848,7 +4244,7 @@ def _get_page_as_source(item, filename, parent_dir, level):
     @param level: The current level.
     
     """
-    global browser, logfile, item_mgr
+    global logfile, item_mgr
     parent_path = os.path.join(parent_dir, str(level), 'html_source')
     if not os.path.isdir(parent_path):
         os.makedirs(parent_path, 0777)
@@ -859,22 +4255,15 @@ def _get_page_as_source(item, filename, parent_dir, level):
         log('INFO',logfile,'%s is downloadable type, skipping collection of HTML source...' % item.url)
         return
     log('INFO',logfile,'Exporting to filepath=%s' % filepath)
-    if browser.current_url != item.url:
-        browser.get(item.url)
-        time.sleep(1)
-        if item.onclick_id:
-            time.sleep(0.5)
-            browser.find_element_by_id(item.onclick_id).click()
-            time.sleep(1)
-        item.page_source = browser.page_source
+    if item.page_source is None and get_browser().current_url != item.url:
+        item.page_source = fetch_page(item)
     # Check if page_source exists.
     if item.page_source is None:
         log('INFO',logfile,'%s no page_source found, skipping collection of HTML source...' % item.url)
         return
     # Save to file.
-    with open(filepath,'wb') as f:
+    with timed('write'), open(filepath,'wb') as f:
         f.write(item.page_source.encode('utf-8'))
-    time.sleep(0.2)
 
 
 def write_info_file(item, filename, parent_dir, level):
@@ -898,7 +4287,6 @@ def write_info_file(item, filename, parent_dir, level):
         message.append('changefreq: %s' % item.changefreq)
         message.append('lastmod: %s' % item.lastmod)
         f.write('\n'.join(message).encode('utf-8'))
-    time.sleep(0.1)
 
 
 def wget_file(item, filename, parent_dir, level):
@@ -923,7 +4311,7 @@ def wget_file(item, filename, parent_dir, level):
         (output,error) = p.communicate()
     except Exception:
         log('WARNING',logfile,traceback.format_exc())
-        item_mgr.error_cnt += 1
+        item_mgr.add_error(item.url)
     log('INFO',logfile,"[WGET] output='%s'" % output)
     log('ERROR',logfile,"[WGET] error='%s'" % error)
 
@@ -938,31 +4326,24 @@ def download_file(url, filename, parent_dir, level, content_type):
     @param content_type: The content type of the file.
     
     """
-    global browser, logfile, item_mgr
+    global logfile, item_mgr
+    browser = get_browser()
     parent_path = os.path.join(parent_dir, str(level))
     if not os.path.isdir(parent_path):
         os.makedirs(parent_path, 0777)
     log('INFO',logfile,'Attempting to download %s' % url)
+    _thread_local.page_item = None
     try:
         browser.get(url)
-        time.sleep(0.5)
     except TimeoutException:
         log('ERROR',logfile,"Page='%s': EXC=%s" %
             (url,traceback.format_exc().splitlines()[-1]))
         log('ERROR',logfile,'SKIPPING PAGE (get_page_as_file)...')
-        item_mgr.timeout_cnt += 1 
-        if url in item_mgr.timeout_urls:
-            item_mgr.timeout_urls[url] += 1 
-        else:
-            item_mgr.timeout_urls[url] = 1
-        item_mgr.error_cnt += 1 
-        if url in item_mgr.error_urls:
-            item_mgr.error_urls[url] += 1 
-        else:
-            item_mgr.error_urls[url] = 1
+        item_mgr.add_timeout(url)
+        item_mgr.add_error(url)
     except Exception:
         log('ERROR',logfile,traceback.format_exc())
-        item_mgr.error_cnt += 1
+        item_mgr.add_error(url)
 
 
 def is_download_type(item, get_content_type=False,
@@ -972,334 +4353,479 @@ def is_download_type(item, get_content_type=False,
     NOTE: "downloadable" here means if a URL is a link to a file
     that should be downloaded. (Eg: pdf, xls, doc).
     
-    The downloadable type is not complete.
+    The downloadable type is not complete.  URLs without extension are
+    classified by the ContentTypeClassifier.  The content type is kept on
+    the Item, so an Item is classified (and probed) only once.
     
     @keyword get_content_type: Returns the content type.
     @keyword get_content_type_if_true: Returns the content type if downloadable.
     @return: True if downloadable, False otherwise.
     
     """
+    global content_classifier
     # Check for attachment data type (NOTE: Might be client specific).
     if item.data_type and item.data_type == 'attachment':
         return True
-    url = item.url
-    f_type = mimetypes.guess_type(url)[0]
+    if item.content_type is None:
+        if content_classifier is not None:
+            item.content_type = content_classifier.classify(item.url) or ''
+        else:
+            item.content_type = mimetypes.guess_type(item.url)[0] or ''
+    f_type = item.content_type or None
     if f_type is None:
         return False
-    # Try to identify pdf files and vendor specific developed files.
-    # vnd includes Microsoft file types.
-    download_type = ['application/pdf','application/octet-stream','text/calendar'] + MS_MimeTypes.get_unique_mime_types()
     if get_content_type:
         return f_type
-    for dt in download_type:
-        if dt in f_type:
-            if get_content_type_if_true:
-                return f_type
-            return True
+    # Try to identify pdf files and vendor specific developed files.
+    if f_type in DOWNLOAD_MIME_TYPES:
+        if get_content_type_if_true:
+            return f_type
+        return True
     return False
 
 
-def move_files(src_dir, dst_dir, wait_for_downloads=True, verbose=True, wait_secs=10):
-    """Moves files from src_dir to dst_dir.
+def move_files(src_dir, dst_dir, wait_for_downloads=True, verbose=True, wait_secs=10):
+    """Moves files from src_dir to dst_dir.
+    
+    @keyword wait_for_downloads: Wait for the downloads to complete
+            before moving files.
+    @keyword verbose: Prints info as it's doing operations.
+    @keyword wait_secs: The wait interval if wait_for_downloads is True.
+    
+    """
+    global logfile, browser_type, item_mgr
+    if wait_for_downloads:
+        if browser_type == BrowserType.CHROME:
+            partial_download_ext = r'.crdownload$'
+        else:
+            partial_download_ext = r'.part$'
+        incomplete = [x for x in os.listdir(src_dir) if re.search(partial_download_ext,x)]
+        while incomplete:
+            if verbose:
+                log('INFO',logfile,'Waiting for downloads to complete...: %s' % incomplete)
+            time.sleep(wait_secs)
+            incomplete = [x for x in os.listdir(src_dir) if re.search(partial_download_ext,x)]
+    for i in os.listdir(src_dir):
+        move_file(os.path.join(src_dir,i), dst_dir, verbose=verbose, wait_secs=wait_secs)
+
+
+def move_file(i_path, dst_dir, verbose=True, wait_secs=10):
+    """Moves a file to dst_dir, under a unique name if the name is taken.
+    
+    @keyword verbose: Prints info as it's doing operations.
+    @keyword wait_secs: The wait interval between tries.
+    @return: The path moved to, or None if the file could not be moved.
+    
+    """
+    global logfile, item_mgr
+    if verbose:
+        log('INFO',logfile,'Moving %s to %s' % (i_path,dst_dir))
+    if not os.path.isdir(dst_dir):
+        try:
+            os.makedirs(dst_dir, 0777)
+        except OSError:
+            # Created by another thread.
+            if not os.path.isdir(dst_dir):
+                raise
+    # Try up to three times to move the file.
+    for i in range(1,4):
+        try:
+            shutil.move(i_path,dst_dir)
+            return os.path.join(dst_dir,os.path.basename(i_path))
+        except shutil.Error:
+            if 'already exists' in traceback.format_exc():
+                new_dst = os.path.sep.join([dst_dir,get_unique_filename(i_path)])
+                shutil.copy2(i_path,new_dst)
+                os.remove(i_path)
+                return new_dst
+        except Exception:
+            log('WARNING',logfile,
+                'Try %s: Unable to move file %s: %s' %
+                (i,i_path,traceback.format_exc().splitlines()[-1]))
+            if i == 3:
+                log('ERROR',logfile,
+                    'Tried %s times to move %s. Logging and skipping...' %
+                    (i,i_path))
+                item_mgr.add_error(i_path)
+                return None
+            else:
+                log('WARNING',logfile,'Trying again in %s secs...' % wait_secs)
+                time.sleep(wait_secs)
+
+
+def file_sha256(filepath):
+    """Returns the SHA-256 hex digest of a file."""
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_unique_filename(i_path):
+    """Returns a unique filename.
+    
+    @param i_path: The pathname of the file.
+    
+    """
+    fname_arr = os.path.basename(i_path).split('.')
+    t_fname = '.'.join(fname_arr[:-1]) + '_' + str(uuid.uuid4())
+    t_ext = fname_arr[-1]
+    if t_ext:
+        fname = t_fname + '.' + t_ext
+    else:
+        fname = t_fname
+    return fname
+
+
+def rename_unique(src, dst):
+    """Renames src to dst, or to a unique name next to dst if dst exists.
+    
+    The name is reserved by creating it exclusively, so threads and
+    processes renaming to the same name do not overwrite each other.
+    
+    @param src: The pathname of the file.
+    @param dst: The pathname to rename to.
+    @return: The pathname renamed to.
+    
+    """
+    while True:
+        try:
+            fd = os.open(dst, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            dst = os.path.join(os.path.dirname(dst), get_unique_filename(dst))
+            continue
+        os.close(fd)
+        try:
+            replace_file(src, dst)
+        except OSError:
+            # On Windows, the name was taken again once the reservation
+            # was removed for the rename.
+            if os.name == 'nt' and os.path.exists(dst):
+                continue
+            if os.name != 'nt':
+                # Do not leave the empty reservation behind.
+                os.remove(dst)
+            raise
+        return dst
+
+
+def get_items(item, level=None):
+    """Searches through an Item's html page source for hyperlinks.
+    
+    Searches for sub-links.  New Items are collected by capture_item(),
+    on the worker pool if one is running.
+    
+    @param item: The Item object.
+    @keyword level: The current level.
+    @return: A list of Items underneath the item passed in.
+    
+    """
+    global scope_matcher
+    global logfile
+    global search_result_links
+    global item_mgr, worker_pool
+    timing = begin_timing(item, level - 1 if level else level, phase='links')
+    try:
+        _get_items(item, level)
+    finally:
+        end_timing(timing)
+
+
+def _get_items(item, level):
+    next_level_links = item.next_level_links
+    if next_level_links is None:
+        next_level_links = get_page_links(item, search_results=search_result_links)
+        if next_level_links is None:
+            log('INFO',logfile,'Item does not have next level links nor page source, getting page source: %s, onclick_id=%s' % (item.url,item.onclick_id))
+            item.page_source = fetch_page(item)
+            next_level_links = get_page_links(item, search_results=search_result_links) or []
+    for href, text, data_type, onclick, span_id in next_level_links:
+        new_item = Item()
+        link = href
+        # Check for attachment data types (specific for wiki.hulu.com).
+        if data_type == 'attachment':
+            try:
+                link = '/download/attachments' + urllib2.unquote(link).split('preview=')[1] + '?download=true'
+            except IndexError:
+                pass
+            new_item.data_type = 'attachment'
+        # Get absolute link url.
+        new_item.url = urlparse.urljoin(item.url, link).rstrip('/')
+        new_item.referrer = item.url
+        new_item.text = text
+        new_item.level = level
+        # Check for onclick
+        if link == '#' and onclick:
+            if span_id is not None:
+                new_item.onclick_id = span_id or None
+            else:
+                m = re.search(r'goToSharedPage\((.*)\)',onclick)
+                if m:
+                    link = m.groups()[0].strip("'")
+                    new_item.url = urlparse.urljoin(item.url, link).rstrip('/')
+        with timed('scope'):
+            canonicalize_item(new_item)
+            scope = scope_matcher.check(new_item.url)
+            if scope == ScopeMatcher.INVALID:
+                cnt = item_mgr.add_invalid(new_item.url)
+                log('INFO',logfile,'INVALID URL FOUND (%s): %s' % (cnt,new_item))
+                continue
+            if scope == ScopeMatcher.NON_DOMAIN:
+                cnt = item_mgr.add_non_domain(new_item.url)
+                log('INFO',logfile,'NON DOMAIN URL FOUND (%s): %s' % (cnt,new_item))
+                continue
+            # Check if the url is a duplicate.
+            if item_mgr.check_dup(new_item):
+                continue
+        if worker_pool:
+            worker_pool.submit(capture_item, new_item, level)
+        else:
+            capture_item(new_item, level)
+    # With workers, process() marks the item once its new Items are collected.
+    if not worker_pool:
+        item.generated_next = True
+        item_mgr.update_item(item)
+    # Clear page source and next level links to save memory.
+    item.page_source = None
+    item.next_level_links = None
+
+
+def capture_item(new_item, level):
+    """Loads a new Item, exports it and collects its next level links.
+    
+    The Item must have been claimed by ItemMgr.check_dup().
+    
+    @param new_item: The Item object.
+    @param level: The level of the Item.
+    
+    """
+    global logfile, item_mgr
+    timing = begin_timing(new_item, level)
+    try:
+        _capture_item(new_item, level)
+        # If it failed, the Item stays pending so a resumed crawl retries it.
+        item_mgr.finish(new_item)
+    finally:
+        end_timing(timing)
+
+
+def _capture_item(new_item, level):
+    # Load URL (mostly to get page source).
+    log('INFO',logfile,'Getting new item page source: %s, onclick_id=%s' % (new_item.url,new_item.onclick_id))
+    track_downloads(new_item, level)
+    
+    try:
+        if not submit_download(new_item, level):
+            new_item.page_source = fetch_page(new_item, screenshot=needs_screenshot())
+            fingerprint_item(new_item)
+    except TimeoutException:
+        # Log and skip the page that times out.
+        # Consider this an Error. It stays in dups.
+        log('ERROR',logfile,"Page='%s': EXC=%s" %
+            (new_item.url,traceback.format_exc().splitlines()[-1]))
+        log('ERROR',logfile,'SKIPPING PAGE, NEEDS MANUAL COLLECTION.')
+        item_mgr.add_timeout(new_item.url)
+        item_mgr.add_error(new_item.url)
+        return
+    #######################################################################
+    # Export this level items here for quicker processing.
+    #######################################################################
+    export_item(new_item, level)
+    # Get next level links and erase page source after processing to save memory.
+    new_item.next_level_links = get_page_links(new_item)
+    new_item.page_source = None
+    # Append to items list.
+    item_mgr.add_item(new_item, level)
+    item_mgr.maybe_save()
+
+
+def is_duplicate_content(item, filename, level):
+    """Checks if an Item's page content was already captured.
+    
+    Only checked with --skip-duplicate-content. Duplicates are recorded in
+    content_dups.csv, with the capture of the original page, and linked to
+    it by link_duplicate_captures().
+    
+    @param item: The Item object, with its fingerprint (or page_source).
+    @param filename: The capture's file name.
+    @param level: The level of the Item.
+    @return: True if the page capture should be skipped.
+    
+    """
+    global skip_duplicate_content
+    if not skip_duplicate_content or not (item.fingerprint or item.page_source):
+        return False
+    if is_download_type(item):
+        return False
+    original = item_mgr.check_content(item, capture_path(filename, level))
+    item.fingerprint = None
+    return original is not None
+
+
+def fingerprint_item(item):
+    """Takes an Item's content fingerprint, once its page is loaded."""
+    global skip_duplicate_content, dry_run
+    if (skip_duplicate_content and not dry_run and item.page_source and
+        not script_args.get('only-downloadable')):
+        item.fingerprint = ContentIndex.fingerprint(item.page_source)
+
+
+def link_duplicate_captures():
+    """Links the captures of the pages skipped as duplicate content to
+    the captures of the original pages.
+    
+    Hard links each file of the original capture (eg: the png and the
+    pdf) under the skipped page's name, or copies it where hard links are
+    not supported.  Run once the captures are written, existing files are
+    left alone.  Tall segment captures are not linked, their manifest
+    names the segments.
+    
+    """
+    global parent_output_dir, logfile, item_mgr
+    for row in item_mgr.content_dups:
+        original_file, filepath = row[6], row[7]
+        if not original_file or not filepath or original_file.endswith('_manifest.json'):
+            continue
+        original_base = '.'.join(original_file.split('.')[:-1])
+        base = os.path.join(parent_output_dir, '.'.join(filepath.split('.')[:-1]))
+        # The capture file and the other outputs written with it.
+        original_files = [original_file] + [output[0] for output in
+                                            screenshot_outputs(original_file)]
+        for ext in sorted(set(f[len(original_base):] for f in original_files)):
+            src = os.path.join(parent_output_dir, original_base + ext)
+            dst = base + ext
+            if not os.path.exists(src) or os.path.exists(dst):
+                continue
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst), 0777)
+            try:
+                os.link(src, dst)
+            except (AttributeError, OSError):
+                shutil.copyfile(src, dst)
+            log('INFO',logfile,'Linked duplicate content capture %s to %s' % (dst, src))
+
+
+def submit_download(item, level):
+    """Downloads an Item's file with the Downloader, if it is a file.
+    
+    @param item: The Item object.
+    @param level: The level of the Item.
+    @return: True if submitted, the Item does not need to be loaded.
+    
+    """
+    if downloader is None or not is_download_type(item):
+        return False
+    log('INFO',logfile,'Queuing download of %s...' % item.url)
+    downloader.submit(item, level)
+    return True
+
+
+def fetch_failed_downloads(failed):
+    """Loads the files the Downloader could not get in the main browser.
+    
+    @param failed: [(item, level), ...] from Downloader.close().
+    
+    """
+    global logfile, item_mgr
+    for item, level in failed:
+        log('INFO',logfile,'Downloading %s with the browser...' % item.url)
+        track_downloads(item, level)
+        try:
+            browser_fetcher.fetch(item, source=False)
+        except Exception:
+            log('ERROR',logfile,traceback.format_exc())
+            item_mgr.add_error(item.url)
+            continue
+        if download_tracker is None:
+            with timed('download_wait'):
+                move_files(get_download_dir(),
+                           os.path.join(parent_output_dir,str(level)))
+
+
+def begin_timing(item, level, phase='capture'):
+    """Starts timing the stages of an Item (see StageTimer).
     
-    @keyword wait_for_downloads: Wait for the downloads to complete
-            before moving files.
-    @keyword verbose: Prints info as it's doing operations.
-    @keyword wait_secs: The wait interval if wait_for_downloads is True.
+    @return: The timing to pass to end_timing(), None if not timed.
     
     """
-    global logfile, browser_type, item_mgr
-    if wait_for_downloads:
-        if browser_type == BrowserType.CHROME:
-            partial_download_ext = r'.crdownload$'
-        else:
-            partial_download_ext = r'.part$'
-        incomplete = [x for x in os.listdir(src_dir) if re.search(partial_download_ext,x)]
-        while incomplete:
-            if verbose:
-                log('INFO',logfile,'Waiting for downloads to complete...: %s' % incomplete)
-            time.sleep(wait_secs)
-            incomplete = [x for x in os.listdir(src_dir) if re.search(partial_download_ext,x)]
-    for i in os.listdir(src_dir):
-        i_path = os.path.join(src_dir,i)
-        if verbose:
-            log('INFO',logfile,'Moving %s to %s' % (i_path,dst_dir))
-        if not os.path.isdir(dst_dir):
-            os.makedirs(dst_dir, 0777)
-        # Try up to three times to move the file.
-        for i in range(1,4):
-            try:
-                shutil.move(i_path,dst_dir)
-                break
-            except shutil.Error:
-                if 'already exists' in traceback.format_exc():
-                    new_dst = os.path.sep.join([dst_dir,get_unique_filename(i_path)])
-                    shutil.copy2(i_path,new_dst)
-                    os.remove(i_path)
-                    break
-            except Exception:
-                log('WARNING',logfile,
-                    'Try %s: Unable to move file %s: %s' %
-                    (i,i_path,traceback.format_exc().splitlines()[-1]))
-                if i == 3:
-                    log('ERROR',logfile,
-                        'Tried %s times to move %s. Logging and skipping...' %
-                        (i,i_path))
-                    item_mgr.error_cnt += 1
-                    if i_path in item_mgr.error_urls:
-                        item_mgr.error_urls[i_path] += 1
-                    else:
-                        item_mgr.error_urls[i_path] = 1
-                    break
-                else:
-                    log('WARNING',logfile,'Trying again in %s secs...' % wait_secs)
-                    time.sleep(wait_secs)
+    if item_mgr is None:
+        return None
+    return item_mgr.timer.begin(item, level, phase=phase)
 
 
-def get_unique_filename(i_path):
-    """Returns a unique filename.
+def end_timing(timing):
+    """Records the stage timings of an Item."""
+    if timing is not None:
+        item_mgr.timer.end(timing)
+
+
+def timed(stage):
+    """Times a stage of the Item timed on the calling thread.
     
-    @param i_path: The pathname of the file.
+    Eg: with timed('navigate'): browser.get(url)
     
     """
-    fname_arr = os.path.basename(i_path).split('.')
-    t_fname = '.'.join(fname_arr[:-1]) + '_' + str(uuid.uuid4())
-    t_ext = fname_arr[-1]
-    if t_ext:
-        fname = t_fname + '.' + t_ext
-    else:
-        fname = t_fname
-    return fname
+    return _Stage(stage)
 
 
-def get_items(item, level=None):
-    """Searches through an Item's html page source for hyperlinks.
+def percentile(sorted_values, q):
+    """Returns the q (0-1) percentile of sorted values (nearest rank)."""
+    return sorted_values[max(int(math.ceil(q * len(sorted_values))) - 1, 0)]
+
+
+def track_downloads(item, level):
+    """Attributes the downloads started next by the calling thread's browser
+    to an Item.
+    
+    @param item: The Item object about to be loaded.
+    @param level: The level of the Item.
     
-    Searches for sub-links.
+    """
+    if download_tracker is not None:
+        download_tracker.expect(get_download_dir(), item, level)
+
+
+def export_item(item, level):
+    """Exports an Item as png/pdf, HTML source and downloaded files.
     
     @param item: The Item object.
-    @keyword level: The current level.
-    @return: A list of Items underneath the item passed in.
+    @param level: The level of the Item.
     
     """
-    global allowed_domains, browser
-    global sub_urls
-    global logfile
-    global dry_run, parent_output_dir, export_to_pdf
-    global search_result_links, windows_filenames
+    global parent_output_dir
+    global dry_run, export_to_pdf, logfile
     global item_mgr
     global script_args
-    next_level_links = item.next_level_links
-    if next_level_links is None:
-        if item.page_source:
-            soup = BeautifulSoup(item.page_source, 'html.parser')
-            if search_result_links:
-                next_level_links = [x for x in soup.find_all('a')
-                                    if x.get('class')
-                                    and 'search-result-link' in x.get('class')
-                                    and 'visitable' in x.get('class')]
-            else:
-                next_level_links = soup.find_all('a')
-        else:
-            log('INFO',logfile,'Item does not have next level links nor page source, getting page source: %s, onclick_id=%s' % (item.url,item.onclick_id))
-            browser.get(item.url)
-            time.sleep(0.5)
-            # Check onclick_id and follow that click.
-            if item.onclick_id:
-                time.sleep(0.5)
-                browser.find_element_by_id(item.onclick_id).click()
-                time.sleep(0.3)
-            item.page_source = browser.page_source
-            soup = BeautifulSoup(item.page_source, 'html.parser')
-            if search_result_links:
-                next_level_links = [x for x in soup.find_all('a')
-                                    if x.get('class')
-                                    and 'search-result-link' in x.get('class')
-                                    and 'visitable' in x.get('class')]
-            else:
-                next_level_links = soup.find_all('a')
-    for l in next_level_links:
-        new_item = Item()
-        link = l.get('href')
-        # Check for attachment data types (specific for wiki.hulu.com).
-        if l.get('data-type','') == 'attachment':
-            try:
-                link = '/download/attachments' + urllib2.unquote(link).split('preview=')[1] + '?download=true'
-            except IndexError:
-                pass
-            new_item.data_type = 'attachment'
-        # Get absolute link url.
-        new_item.url = urlparse.urljoin(item.url, link).rstrip('/')
-        new_item.referrer = item.url
-        new_item.text = l.get_text()
-        new_item.level = level
-        # Check for onclick
-        if link == '#' and l.get('onclick'):
-            try:
-                new_item.onclick_id = l.find('span').get('id')
-            except AttributeError:
-                m = re.search(r'goToSharedPage\((.*)\)',l.get('onclick'))
-                if m:
-                    link = m.groups()[0].strip("'")
-                    new_item.url = urlparse.urljoin(item.url, link).rstrip('/')
-        try:
-            res = get_tld(new_item.url)
-        except Exception:
-            item_mgr.invalid_cnt += 1
-            if new_item.url in item_mgr.invalid_urls:
-                item_mgr.invalid_urls[new_item.url] += 1
-            else:
-                item_mgr.invalid_urls[new_item.url] = 1
-            log('INFO',logfile,'INVALID URL FOUND (%s): %s' % (item_mgr.invalid_urls[new_item.url],new_item))
-            continue
-        if res not in allowed_domains:
-            item_mgr.non_domain_cnt += 1
-            if new_item.url in item_mgr.non_domain_urls:
-                item_mgr.non_domain_urls[new_item.url] += 1
-            else:
-                item_mgr.non_domain_urls[new_item.url] = 1
-            log('INFO',logfile,'NON DOMAIN URL FOUND (%s): %s' % (item_mgr.non_domain_urls[new_item.url],new_item))
-            continue
-        found_false_sub_url = False
-        for sub_url in sub_urls:
-            if sub_url not in new_item.url:
-                item_mgr.non_domain_cnt += 1
-                if new_item.url in item_mgr.non_domain_urls:
-                    item_mgr.non_domain_urls[new_item.url] += 1
-                else:
-                    item_mgr.non_domain_urls[new_item.url] = 1
-                log('INFO',logfile,'NON DOMAIN URL FOUND (%s): %s' % (item_mgr.non_domain_urls[new_item.url],new_item))
-                found_false_sub_url = True
-                break
-        if found_false_sub_url:
-            continue
-        # Check if the url is a duplicate.
-        found_dup, added_dup, found_section = False, False, False
-        # Check for sections.
-        try:
-            (base_url,section) = re.search(r'(.*)/([#][^/]+)$',new_item.url).groups()
-        except AttributeError:
-            (base_url,section) = None,None
-        if section:
-            found_section = True
-        if new_item.url in item_mgr.dup_urls:
-            if new_item.onclick_id in item_mgr.dup_urls[new_item.url]:
-                found_dup = True
-            else:
-                item_mgr.dup_urls[new_item.url].update({new_item.onclick_id:{'cnt':0,'sec_cnt':0}})
-                added_dup = True
-        if found_dup:
-            item_mgr.dup_urls[new_item.url][new_item.onclick_id]['cnt'] += 1
-            item_mgr.dup_cnt += 1
-            log('INFO',logfile,'DUPLICATE URL FOUND (%s): %s' % (item_mgr.dup_urls[new_item.url],new_item))
-            continue
-        if section:
-            if base_url not in item_mgr.dup_urls:
-                item_mgr.dup_urls[base_url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-            else:
-                if new_item.onclick_id in item_mgr.dup_urls[base_url]:
-                    # Add full new_item.url to dups.
-                    item_mgr.dup_urls[new_item.url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-                    # Then increment section counter of base_url.
-                    item_mgr.dup_urls[base_url][new_item.onclick_id]['cnt'] += 1
-                    item_mgr.dup_urls[base_url][new_item.onclick_id]['sec_cnt'] += 1
-                    item_mgr.dup_cnt += 1
-                    log('INFO',logfile,'DUPLICATE URL SECTION FOUND (%s): %s' % (item_mgr.dup_urls[new_item.url],new_item))
-                    continue
-                else:
-                    item_mgr.dup_urls[base_url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-        # Load URL (mostly to get page source), then add to duplicate definition.
-        log('INFO',logfile,'Getting new item page source: %s, onclick_id=%s' % (new_item.url,new_item.onclick_id))
-        
-        try:
-            browser.get(new_item.url)
-        except TimeoutException:
-            # Log and skip the page that times out.
-            # Consider this an Error. Add to dup.
-            log('ERROR',logfile,"Page='%s': EXC=%s" %
-                (new_item.url,traceback.format_exc().splitlines()[-1]))
-            log('ERROR',logfile,'SKIPPING PAGE, NEEDS MANUAL COLLECTION.')
-            item_mgr.timeout_cnt += 1
-            if new_item.url in item_mgr.timeout_urls:
-                item_mgr.timeout_urls[new_item.url] += 1
-            else:
-                item_mgr.timeout_urls[new_item.url] = 1
-            item_mgr.error_cnt += 1
-            if new_item.url in item_mgr.error_urls:
-                item_mgr.error_urls[new_item.url] += 1
-            else:
-                item_mgr.error_urls[new_item.url] = 1
-            # Added to dup.
-            if not added_dup:
-                item_mgr.dup_urls[new_item.url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-            # Skip.
-            continue
-        
-        # Execute some javascript to manipulate the page for better screenshots.
-        # Get rid of the scrollbars if any.
-        browser.execute_script('''
-            const s = document.createElement("style");
-            s.textContent = "body::-webkit-scrollbar { display: none;} body { scrollbar-width: none; }";
-            document.head.insertAdjacentElement("beforeend", s);
-        ''');
-        
-        time.sleep(0.5)
-        if new_item.onclick_id:
-            time.sleep(0.5)
-            browser.find_element_by_id(new_item.onclick_id).click()
-            time.sleep(0.3)
-        new_item.page_source = browser.page_source
-        if not added_dup:
-            item_mgr.dup_urls[new_item.url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-        #######################################################################
-        # Export this level items here for quicker processing.
-        #######################################################################
-        log('INFO',logfile,str(new_item))
-        # Build the file name for the output file.
-        filename = new_item.url.split('https://')[-1]
-        filename = re.sub(r'[^a-z.A-Z0-9]','.-',filename.split('http://')[-1])
-        if windows_filenames:
-            if len(filename) > 255:
-                # Strip out some characters from filename.
-                filename = filename[:50] +'__'+ filename[-50:]
-        png_filename = filename + '_%s.png' % item_mgr.cnt
-        pdf_filename = filename + '_%s.pdf' % item_mgr.cnt
-        html_filename = filename + '_%s.html' % item_mgr.cnt
-        if export_to_pdf:
-            exp_filename = pdf_filename
-        else:
-            exp_filename = png_filename
-        if not script_args.get('only-downloadable'):
-            log('INFO',logfile,'Getting snapshot of page %s...' % new_item.url)
-            if not dry_run:
-                get_page_as_file(new_item, exp_filename, parent_output_dir, level)
-        if script_args.get('get-source'):
-            log('INFO',logfile,'Getting HTML source of page %s...' % new_item.url)
-            if not dry_run:
-                get_page_as_source(new_item, html_filename, parent_output_dir, level)
-        item_mgr.cnt += 1
-        time.sleep(0.3)
-        new_item.processed = True
+    log('INFO',logfile,str(item))
+    # Build the file name for the output file.
+    filename = build_filename(item.url)
+    doc_num = item_mgr.reserve_cnt()
+    png_filename = filename + '_%s.png' % doc_num
+    pdf_filename = filename + '_%s.pdf' % doc_num
+    html_filename = filename + '_%s.html' % doc_num
+    if export_to_pdf:
+        exp_filename = pdf_filename
+    else:
+        exp_filename = png_filename
+    track_downloads(item, level)
+    if not script_args.get('only-downloadable'):
+        log('INFO',logfile,'Getting snapshot of page %s...' % item.url)
+        if not dry_run and not is_duplicate_content(item, exp_filename, level):
+            get_page_as_file(item, exp_filename, parent_output_dir, level)
+    if script_args.get('get-source'):
+        log('INFO',logfile,'Getting HTML source of page %s...' % item.url)
+        if not dry_run:
+            get_page_as_source(item, html_filename, parent_output_dir, level)
+    item.processed = True
+    item_mgr.update_item(item)
+    if download_tracker is None:
         # Move any downloads to output level directory.
-        move_files(os.path.join(parent_output_dir,'main'),
-                   os.path.join(parent_output_dir,str(level)))
-        # Get next level links and erase page source after processing to save memory.
-        if new_item.page_source:
-            soup = BeautifulSoup(new_item.page_source,'html.parser')
-            new_item.next_level_links = soup.find_all('a')
-        new_item.page_source = None
-        # Append to items list.
-        if str(level) in item_mgr.items:
-            item_mgr.items[str(level)].append(new_item)
-        else:
-            item_mgr.items[str(level)] = [new_item]
-        # Save after processing every 25 documents.
-        if item_mgr.cnt > 0 and item_mgr.cnt % 25 == 0:
-            item_mgr.save()
-    item.generated_next = True
-    # Clear page source and next level links to save memory.
-    item.page_source = None
-    item.next_level_links = None
+        with timed('download_wait'):
+            move_files(get_download_dir(),
+                       os.path.join(parent_output_dir,str(level)))
 
 
 def get_item(item, level=None):
@@ -1309,150 +4835,76 @@ def get_item(item, level=None):
     @keyword level: The current level.
     
     """
-    global allowed_domains, browser
-    global sub_urls
+    global scope_matcher
     global process_adobe_wiki, logfile
     global dry_run, parent_output_dir, export_to_pdf
-    global search_result_links, windows_filenames
     global item_mgr
     global script_args
 
     new_item = item
+    canonicalize_item(new_item)
     
-    try:
-        res = get_tld(new_item.url)
-    except Exception:
-        item_mgr.invalid_cnt += 1
-        if new_item.url in item_mgr.invalid_urls:
-            item_mgr.invalid_urls[new_item.url] += 1
-        else:
-            item_mgr.invalid_urls[new_item.url] = 1
-        log('INFO',logfile,'INVALID URL FOUND (%s): %s' % (item_mgr.invalid_urls[new_item.url],new_item))
-        return
-    # TODO: This functionality doesn't seem to be working properly.
-    if res not in allowed_domains:
-        item_mgr.non_domain_cnt += 1
-        if new_item.url in item_mgr.non_domain_urls:
-            item_mgr.non_domain_urls[new_item.url] += 1
-        else:
-            item_mgr.non_domain_urls[new_item.url] = 1
-        log('INFO',logfile,'NON DOMAIN URL FOUND (%s): %s' % (item_mgr.non_domain_urls[new_item.url],new_item))
+    scope = scope_matcher.check(new_item.url)
+    if scope == ScopeMatcher.INVALID:
+        cnt = item_mgr.add_invalid(new_item.url)
+        log('INFO',logfile,'INVALID URL FOUND (%s): %s' % (cnt,new_item))
         return
-    found_false_sub_url = False
-    for sub_url in sub_urls:
-        if sub_url not in new_item.url:
-            item_mgr.non_domain_cnt += 1
-            if new_item.url in item_mgr.non_domain_urls:
-                item_mgr.non_domain_urls[new_item.url] += 1
-            else:
-                item_mgr.non_domain_urls[new_item.url] = 1
-            log('INFO',logfile,'NON DOMAIN URL FOUND (%s): %s' % (item_mgr.non_domain_urls[new_item.url],new_item))
-            found_false_sub_url = True
-            break
-    if found_false_sub_url:
+    if scope == ScopeMatcher.NON_DOMAIN:
+        cnt = item_mgr.add_non_domain(new_item.url)
+        log('INFO',logfile,'NON DOMAIN URL FOUND (%s): %s' % (cnt,new_item))
         return
     # Check if the url is a duplicate.
-    found_dup, added_dup, found_section = False, False, False
-    # Check for sections.
-    try:
-        (base_url,section) = re.search(r'(.*)/([#][^/]+)$',new_item.url).groups()
-    except AttributeError:
-        (base_url,section) = None,None
-    if section:
-        found_section = True
-    if new_item.url in item_mgr.dup_urls:
-        if new_item.onclick_id in item_mgr.dup_urls[new_item.url]:
-            found_dup = True
-        else:
-            item_mgr.dup_urls[new_item.url].update({new_item.onclick_id:{'cnt':0,'sec_cnt':0}})
-            added_dup = True
-    if found_dup:
-        item_mgr.dup_urls[new_item.url][new_item.onclick_id]['cnt'] += 1
-        item_mgr.dup_cnt += 1
-        log('INFO',logfile,'DUPLICATE URL FOUND (%s): %s' % (item_mgr.dup_urls[new_item.url],new_item))
+    if item_mgr.check_dup(new_item):
         return
-    if section:
-        if base_url not in item_mgr.dup_urls:
-            item_mgr.dup_urls[base_url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-        else:
-            if new_item.onclick_id in item_mgr.dup_urls[base_url]:
-                # Add full new_item.url to dups.
-                item_mgr.dup_urls[new_item.url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-                # Then increment section counter of base_url.
-                item_mgr.dup_urls[base_url][new_item.onclick_id]['cnt'] += 1
-                item_mgr.dup_urls[base_url][new_item.onclick_id]['sec_cnt'] += 1
-                item_mgr.dup_cnt += 1
-                log('INFO',logfile,'DUPLICATE URL SECTION FOUND (%s): %s' % (item_mgr.dup_urls[new_item.url],new_item))
-                return
-            else:
-                item_mgr.dup_urls[base_url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-    # Load URL (mostly to get page source), then add to duplicate definition.
+    timing = begin_timing(new_item, level)
+    try:
+        _get_item(new_item, level)
+        item_mgr.finish(new_item)
+    finally:
+        end_timing(timing)
+
+
+def _get_item(new_item, level):
+    # Load URL (mostly to get page source).
     log('INFO',logfile,'Getting new item page source: %s, onclick_id=%s' % (new_item.url,new_item.onclick_id))
+    track_downloads(new_item, level)
     
     try:
-        browser.get(new_item.url)
+        if not submit_download(new_item, level):
+            new_item.page_source = fetch_page(new_item, screenshot=needs_screenshot())
+            fingerprint_item(new_item)
     except TimeoutException:
         # Log and skip the page that times out.
-        # Consider this an Error. Add to dup.
+        # Consider this an Error. It stays in dups.
         log('ERROR',logfile,"Page='%s': EXC=%s" %
             (new_item.url,traceback.format_exc().splitlines()[-1]))
         log('ERROR',logfile,'SKIPPING PAGE, NEEDS MANUAL COLLECTION.')
-        item_mgr.timeout_cnt += 1
-        if new_item.url in item_mgr.timeout_urls:
-            item_mgr.timeout_urls[new_item.url] += 1
-        else:
-            item_mgr.timeout_urls[new_item.url] = 1
-        item_mgr.error_cnt += 1
-        if new_item.url in item_mgr.error_urls:
-            item_mgr.error_urls[new_item.url] += 1
-        else:
-            item_mgr.error_urls[new_item.url] = 1
-        # Added to dup.
-        if not added_dup:
-            item_mgr.dup_urls[new_item.url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
+        item_mgr.add_timeout(new_item.url)
+        item_mgr.add_error(new_item.url)
         # Skip.
         return
-    
-    # Execute some javascript to manipulate the page for better screenshots.
-    # Get rid of the scrollbars if any.
-    browser.execute_script('''
-        const s = document.createElement("style");
-        s.textContent = "body::-webkit-scrollbar { display: none;} body { scrollbar-width: none; }";
-        document.head.insertAdjacentElement("beforeend", s);
-    ''');
-    
-    time.sleep(3)
-    if new_item.onclick_id:
-        time.sleep(0.5)
-        browser.find_element_by_id(new_item.onclick_id).click()
-        time.sleep(0.3)
-    new_item.page_source = browser.page_source
     #######################################################################
     # Export this level items here for quicker processing.
     #######################################################################
     log('INFO',logfile,str(new_item))
     # Build the file name for the output file.
-    filename = new_item.url.split('https://')[-1]
-    filename = re.sub(r'[^a-z.A-Z0-9]','.-',filename.split('http://')[-1])
-    if windows_filenames:
-        if len(filename) > 255:
-            # Strip out some characters from filename.
-            filename = filename[:50] +'__'+ filename[-50:]
+    filename = build_filename(new_item.url)
     if process_adobe_wiki:
         log('INFO',logfile,'Getting Adobe wiki page %s...' % (new_item.url))
         if not dry_run:
             get_adobe_wiki_page(new_item, filename, parent_output_dir, level)
-    png_filename = '%s_%s.png' % (item_mgr.cnt, filename)
-    pdf_filename = '%s_%s.pdf' % (item_mgr.cnt, filename)
-    html_filename = '%s_%s.html' % (item_mgr.cnt, filename)
-    info_filename = '%s_%s.txt' % (item_mgr.cnt, filename)
+    doc_num = item_mgr.reserve_cnt()
+    png_filename = '%s_%s.png' % (doc_num, filename)
+    pdf_filename = '%s_%s.pdf' % (doc_num, filename)
+    html_filename = '%s_%s.html' % (doc_num, filename)
+    info_filename = '%s_%s.txt' % (doc_num, filename)
     if export_to_pdf:
         exp_filename = pdf_filename
     else:
         exp_filename = png_filename
     if not script_args.get('only-downloadable'):
         log('INFO',logfile,'Getting snapshot of page %s...' % new_item.url)
-        if not dry_run:
+        if not dry_run and not is_duplicate_content(new_item, exp_filename, level):
             get_page_as_file(new_item, exp_filename, parent_output_dir, level)
     if script_args.get('get-source'):
         log('INFO',logfile,'Getting HTML source of page %s...' % new_item.url)
@@ -1460,26 +4912,17 @@ def get_item(item, level=None):
             get_page_as_source(new_item, html_filename, parent_output_dir, level)
     # Write info to info file.
     write_info_file(new_item, info_filename, parent_output_dir, level)
-    # Update stats.
-    item_mgr.cnt += 1
-    time.sleep(0.3)
     new_item.processed = True
-    # Move any downloads to output level directory.
-    move_files(os.path.join(parent_output_dir,'main'),
-               os.path.join(parent_output_dir,str(level)))
+    if download_tracker is None:
+        # Move any downloads to output level directory.
+        with timed('download_wait'):
+            move_files(get_download_dir(),
+                       os.path.join(parent_output_dir,str(level)))
     
     new_item.page_source = None
     # Append to items list.
-    if str(level) in item_mgr.items:
-        item_mgr.items[str(level)].append(new_item)
-    else:
-        item_mgr.items[str(level)] = [new_item]
-    # Add to dup
-    if not added_dup:
-        item_mgr.dup_urls[new_item.url] = {new_item.onclick_id:{'cnt':0,'sec_cnt':0}}
-    # Save after processing every 25 documents.
-    if item_mgr.cnt > 0 and item_mgr.cnt % 25 == 0:
-        item_mgr.save()
+    item_mgr.add_item(new_item, level)
+    item_mgr.maybe_save()
 
 
 def process(items, levels, current_level):
@@ -1493,15 +4936,16 @@ def process(items, levels, current_level):
     2. Search html page source for next level hyperlinks.
     3. Recurse process for next level if needed.
     
+    With a worker pool, exports are spread over the workers and each level
+    is completed before moving on to the next one.
+    
     @param items: A list of Items to process.
     @param levels: The depth of the items to process.
     @param current_level: The current level.
     
     """
-    global parent_output_dir
-    global dry_run, export_to_pdf, logfile
-    global item_mgr, windows_filenames
-    global script_args
+    global logfile
+    global item_mgr, worker_pool
     if not items:
         return
     if levels < current_level:
@@ -1511,60 +4955,53 @@ def process(items, levels, current_level):
     else:
         generate_next = False
     
+    if worker_pool:
+        # Export on the workers first, next level links are searched for
+        # in the exported pages.
+        for item in items:
+            if not item.processed:
+                worker_pool.submit(_export_item, item, current_level)
+        worker_pool.join()
+    
     # Process each item and generate next level.
     for item in items:
         if not item.processed:
             ###################################################################
             # Exporting Stage - export page as png or download associated file.
             ###################################################################
-            log('INFO',logfile,str(item))
-            # Build the file name for the output file.
-            filename = item.url.split('https://')[-1]
-            filename = re.sub(r'[^a-z.A-Z0-9]','.-',filename.split('http://')[-1])
-            if windows_filenames:
-                if len(filename) > 255:
-                    # Strip out some characters from filename.
-                    filename = filename[:50] +'__'+ filename[-50:]
-            png_filename = filename + '_%s.png' % item_mgr.cnt
-            pdf_filename = filename + '_%s.pdf' % item_mgr.cnt
-            html_filename = filename + '_%s.html' % item_mgr.cnt
-            if export_to_pdf:
-                exp_filename = pdf_filename
-            else:
-                exp_filename = png_filename
-            if not script_args.get('only-downloadable'):
-                log('INFO',logfile,'Getting snapshot of page %s...' % item.url)
-                if not dry_run:
-                    get_page_as_file(item, exp_filename, parent_output_dir, current_level)
-            if script_args.get('get-source'):
-                log('INFO',logfile,'Getting HTML source of page %s...' % item.url)
-                if not dry_run:
-                    get_page_as_source(item, html_filename, parent_output_dir, current_level)
-            time.sleep(0.3)
-            item.processed = True
-            item_mgr.cnt += 1
-            # Move any downloads to output level directory.
-            move_files(os.path.join(parent_output_dir,'main'),
-                       os.path.join(parent_output_dir,str(current_level)))
-            # Save after processing every 25 documents.
-            if item_mgr.cnt > 0 and item_mgr.cnt % 25 == 0:
-                item_mgr.save()
+            _export_item(item, current_level)
         # Get next level urls if needed.
         if generate_next and not item.generated_next:
             get_items(item, level=(current_level + 1))
         # Erase page source and next level links after processing to save memory.
         item.page_source = None
         item.next_level_links = None
+    if worker_pool:
+        # Wait for the next level items to be collected.
+        worker_pool.join()
+        if generate_next:
+            for item in items:
+                item.generated_next = True
+                item_mgr.update_item(item)
     
     if levels == current_level:
         return
     
-    time.sleep(0.2)
     # Recursively call process for next level items.
     next_level_items = item_mgr.items.get(str(current_level + 1),[])
     process(next_level_items, levels, current_level + 1)
 
 
+def _export_item(item, level):
+    timing = begin_timing(item, level)
+    try:
+        export_item(item, level)
+        # Save after processing every 25 documents.
+        item_mgr.maybe_save()
+    finally:
+        end_timing(timing)
+
+
 def process_file(_file, levels=None, current_level=1):
     """Main crawler function for processing file with list of URLs.
     
@@ -1575,7 +5012,7 @@ def process_file(_file, levels=None, current_level=1):
     @param _file: Absolute path to file to process.
     
     """
-    global logfile, item_mgr
+    global logfile, item_mgr, worker_pool
     
     file_gen = file_generator(_file)
     
@@ -1592,8 +5029,12 @@ def process_file(_file, levels=None, current_level=1):
             continue
         item = Item()
         item.url = url
-        get_item(item, 1)
-        time.sleep(0.2)
+        if worker_pool:
+            worker_pool.submit(get_item, item, 1)
+        else:
+            get_item(item, 1)
+    if worker_pool:
+        worker_pool.join()
 
 
 def file_generator(_file):
@@ -1607,6 +5048,191 @@ def file_generator(_file):
             yield line
 
 
+class LogWriter(object):
+    
+    """Writes log records on a background thread.
+    
+    log() only appends records to a deque, the writer thread wakes up every
+    interval secs, formats the records, writes them in batches to the log
+    files it keeps open and rotates the files by size.  At most max_pending
+    records wait to be written, log() blocks while the writer is behind.
+    
+    """
+    
+    def __init__(self, max_pending=10000, max_bytes=0, backups=5, json_lines=False,
+                 interval=0.1):
+        """Constructs a Log Writer instance.
+        
+        @keyword max_pending: Max number of records queued.
+        @keyword max_bytes: Rotate a log file when it gets bigger, 0 to
+                never rotate.
+        @keyword backups: Number of rotated files kept (<logfile>.1 is the
+                most recent).
+        @keyword json_lines: Write records as JSON lines instead of text.
+        @keyword interval: Max secs a record waits to be written.
+        
+        """
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.json_lines = json_lines
+        self.interval = interval
+        # Appends and pops of a deque are thread safe, without a lock.
+        self.records = deque()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        # Notified when records are taken off the deque, or the writer stops.
+        self._drained = threading.Condition()
+        self._stop = False
+        self._stopped = False
+        # self.files = {logfile: file object}
+        self.files = {}
+        self.pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def put(self, record):
+        """Queues a record (time, logtype, logfile, message, print_stdout, TAG,
+        thread name)."""
+        self.records.append(record)
+        if len(self.records) <= self.max_pending:
+            return
+        with self._drained:
+            while len(self.records) > self.max_pending and not self._stopped:
+                self._wake.set()
+                self._drained.wait()
+    
+    def _run(self):
+        try:
+            while True:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                if self.records:
+                    self._idle.clear()
+                try:
+                    while self.records:
+                        # Write what has queued up in one go.
+                        by_file = {}
+                        for _ in range(min(len(self.records), 1000)):
+                            record = self.records.popleft()
+                            by_file.setdefault(record[2], []).append(record)
+                        with self._drained:
+                            self._drained.notify_all()
+                        for path, file_records in by_file.iteritems():
+                            self._write(path, file_records)
+                except Exception:
+                    traceback.print_exc()
+                self._idle.set()
+                if self._stop:
+                    break
+        finally:
+            with self._drained:
+                self._stopped = True
+                self._drained.notify_all()
+    
+    def _write(self, path, records):
+        f = self.files.get(path)
+        if f is None:
+            f = self.files[path] = open(path, 'a')
+        lines = []
+        for ct, logtype, _, message, print_stdout, TAG, thread in records:
+            if self.json_lines:
+                lines.append(format_log_json(ct, logtype, self.pid, message, TAG, thread))
+            else:
+                lines.append(format_log_text(ct, logtype, self.pid, message, TAG))
+        f.write(''.join(lines))
+        f.flush()
+        for _, logtype, _, message, print_stdout, _, _ in records:
+            if print_stdout:
+                print_log(logtype, message)
+        if self.max_bytes and f.tell() >= self.max_bytes:
+            f.close()
+            del self.files[path]
+            rotate_file(path, self.backups)
+    
+    def flush(self):
+        """Blocks until the queued records are written."""
+        self._wake.set()
+        while (self.records or not self._idle.is_set()) and self._thread.is_alive():
+            self._idle.wait(0.05)
+    
+    def close(self):
+        """Writes the queued records and stops the writer thread.
+        
+        log() writes on the calling thread again afterwards.
+        
+        """
+        if self._thread.is_alive():
+            self._stop = True
+            self._wake.set()
+            self._thread.join()
+        self.pid = None
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+# [secs, secs formatted] of the last log record.
+_log_secs = [None, None]
+
+
+def format_log_text(ct, logtype, pid, message, TAG=None):
+    """Formats a log record as text lines, each with the record header.
+    
+    @return: The lines, ending with a line separator.
+    
+    """
+    secs = long(ct)
+    if _log_secs[0] != secs:
+        # Formatted once per sec.
+        _log_secs[:] = [secs, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(secs))]
+    prefix = '%s,%03d %s PID[%s]: ' % (_log_secs[1], (ct - secs) * 1000, logtype, pid)
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    # Clean message
+    logtxt = message.strip()
+    # Add TAG if necessary.
+    if TAG:
+        logtxt = str(TAG) + ': ' + logtxt
+    lines = logtxt.replace('\r\n', '\n').split('\n')
+    return prefix + (os.linesep + prefix).join(lines).rstrip() + os.linesep
+
+
+def format_log_json(ct, logtype, pid, message, TAG=None, thread=None):
+    """Formats a log record as a JSON line."""
+    if isinstance(message, str):
+        message = message.decode('utf-8', 'replace')
+    return json.dumps({'time':'%s.%03dZ' % (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ct)),
+                                            (ct - long(ct)) * 1000),
+                       'level':logtype,
+                       'pid':pid,
+                       'thread':thread,
+                       'tag':TAG and str(TAG),
+                       'message':message.strip()}) + '\n'
+
+
+def print_log(logtype, message):
+    """Prints a log message to stdout, or stderr for errors."""
+    stream = sys.stderr if logtype == 'ERROR' else sys.stdout
+    if isinstance(message, unicode) and not getattr(stream, 'encoding', None):
+        # Redirected, print as UTF-8.
+        message = message.encode('utf-8')
+    print >>stream, message
+
+
+def rotate_file(path, backups):
+    """Renames path to path.1, path.1 to path.2, ... keeping backups files."""
+    for i in range(backups - 1, 0, -1):
+        if os.path.exists('%s.%s' % (path, i)):
+            replace_file('%s.%s' % (path, i), '%s.%s' % (path, i + 1))
+    if backups:
+        replace_file(path, path + '.1')
+    else:
+        os.remove(path)
+
+
 def init_logfile(logfile):
     """Initializes logfile if needed.
     
@@ -1635,34 +5261,25 @@ def log(logtype, logfile, message, print_stdout=True, TAG=None):
     @keyword TAG: TAG directly prefixed to message, but after standard
             headers.
     
+    Messages below --log-level are dropped, and only printed from
+    --console-level.  With the LogWriter running, the message is written
+    on its thread.
+    
     """
+    level = LOG_LEVELS.get(logtype, LOG_LEVELS['INFO'])
+    if level < log_level:
+        return
+    print_stdout = print_stdout and level >= console_level
     ct = time.time()
-    msecs = (ct - long(ct)) * 1000
-    t = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-    date = "%s,%03d" % (t, msecs)
-    
-    prefix = '%s %s PID[%s]: ' % \
-        (date, logtype, os.getpid())
-    
-    # Clean message
-    logtxt = message.strip()
-    # Add TAG if necessary.
-    if TAG:
-        logtxt = re.sub('^', str(TAG) + ': ', logtxt)
-    # Add prefix to start of message.
-    logtxt = re.sub('^', str(prefix), logtxt)
-    logtxt = re.sub('\r\n', os.linesep + str(prefix), logtxt)
-    logtxt = re.sub('\n', os.linesep + str(prefix), logtxt)
-    logtxt = re.sub('\r', '\r' + str(prefix), logtxt)
-    
+    if log_writer is not None and log_writer.pid == os.getpid():
+        log_writer.put((ct, logtype, logfile, message, print_stdout, TAG,
+                        threading.current_thread().name))
+        return
+    # Before the writer is started, and in the encoding processes.
     with open(logfile, 'a') as f:
-        f.write(logtxt.rstrip() + os.linesep)
-    
+        f.write(format_log_text(ct, logtype, os.getpid(), message, TAG))
     if print_stdout:
-        if logtype == 'ERROR':
-            print >>sys.stderr, message
-        else:
-            print message
+        print_log(logtype, message)
 
 
 ###############################################################################
@@ -1693,14 +5310,131 @@ def usage():
             This means "campaigns.corp" must appear to in URL before that
             page is processed. URLs that look like subdomain.crawler-test.com will
             not be processed because it does not contain "campaigns.corp".
+      --include=<REGEX>
+            Only process URLs matching REGEX (searched anywhere in the URL).
+            Can be repeated, URLs must match one of them.
+      --exclude=<REGEX>
+            Do not process URLs matching REGEX.  Can be repeated.
       -l <LEVELS>, --levels=<LEVELS>
             The number of levels to dive into website.
       -c <COOKIE_FILE>, --cookies=<COOKIE_FILE>
             The cookies file to load.
       -f <URL_FILE>, --file=<URL_FILE>
             A file with list of URLs to parse.
+      --login-wait=<SECS>
+            Secs to wait after loading the start URL, eg: to log in to
+            the website in the browser (default: 60).
       --nav-elements=<NAV_ELEMENTS>
             Specify the nav elements of the page, comma separated string.
+      --fetch-backend=<auto|browser>
+            How pages that are not screenshot (eg: --dry-run,
+            --only-downloadable, --get-source and link discovery) are
+            fetched.  "auto" fetches them over HTTP with the browser's
+            cookies, and falls back to the browser for pages that need
+            javascript or are downloads.  "browser" always uses the
+            browser (default: auto).
+      --link-parser=<lxml|stream|bs4>
+            How hyperlinks are extracted from pages.  "lxml" and "stream"
+            (standard library tokenizer) only look at <a> tags without
+            building a tree, "bs4" uses BeautifulSoup (default: lxml if
+            installed, otherwise stream).
+      --capture=<native|stitch>
+            How full page screenshots are taken.  "native" uses the
+            browser's full page screenshot when available (Firefox, or
+            Chrome through DevTools), falling back to stitching viewport
+            screenshots.  "stitch" always stitches (default: native).
+      --encode-workers=<N>
+            Number of processes (threads on Windows) encoding and writing
+            screenshots, so the browser can move on to the next page.  0
+            encodes in the browser thread (default: 2, at most the number
+            of CPUs minus one).
+      --image-format=<png|jpeg|webp>
+            The screenshot image format, a PDF is also written
+            (default: png).
+      --image-quality=<N>
+            PNG compress level 0-9 (default: 6), or JPEG/WebP quality
+            1-100 (default: 90).
+      --tall-output=<pdf|segments>
+            Writes screenshots as 8192px bands while stitching, instead
+            of one image truncated at 65500px: "pdf" writes
+            the bands as the pages of a PDF, "segments" as numbered PNG
+            files (<name>_seg_<n>.png) listed in <name>_manifest.json.
+      --load-profile=<auto|full|source|discovery>
+            The resources pages are loaded with.  "full" loads
+            everything, "source" skips images, fonts, media and
+            third-party analytics, "discovery" also skips stylesheets.
+            "auto" loads the pages screenshot in full, and the other
+            pages with the source profile if their source is saved or
+            fingerprinted (--get-source, --skip-duplicate-content),
+            otherwise with the discovery profile.  Chrome switches
+            profile per page, Firefox is started with the profile of the
+            pages that need the most (default: auto).
+      --block-url=<PATTERN>
+            Also blocks URLs matching PATTERN (* wildcards) in the
+            source and discovery profiles, eg: *ads.example.com/*.  Can
+            be repeated.  Chrome only.
+      --js-links
+            Gets the hyperlinks of pages loaded in the browser from the
+            live DOM with a single script call, instead of transferring
+            and parsing the page source.  Also finds links added by
+            javascript.
+      --max-page-wait=<SECS>
+            Maximum secs to wait for a page to be ready (loaded, no
+            network activity, DOM changes or images loading) (default: 10).
+      --page-quiet=<SECS>
+            Secs without network activity or DOM changes for a page to be
+            ready (default: 0.5).
+      --checkpoint-secs=<SECS>
+            Makes progress durable at least every SECS secs, in addition
+            to every 25 documents (default: 60).
+      --dup-bloom=<N>
+            Puts a Bloom filter sized for N URLs in front of the table of
+            seen URLs (dups.bin), for large crawls.
+      --canon-rules=<RULES_FILE>
+            A file with URL canonicalization rules, one per line:
+                strip-param <GLOB>     Strip query parameters matching GLOB.
+                keep-param <GLOB>      Keep query parameters matching GLOB.
+                sort-params <on|off>   Sort the query parameters (default: on).
+                index-file <NAME>      Drop NAME at the end of paths.
+                rewrite <REGEX> <REPL> Rewrite canonical URLs (re.sub).
+            By default URLs are canonicalized before the duplicate check:
+            scheme and host lower cased, default ports, index files
+            (eg: index.html) and tracking/session parameters (eg: utm_*,
+            jsessionid) dropped and query parameters sorted.
+      --no-canonicalize
+            Uses URLs as found, for the duplicate check and page loads.
+      --skip-duplicate-content
+            Does not capture pages with the same or nearly the same text
+            as a page already captured (eg: the same page under another
+            URL).  Skipped pages are listed in content_dups.csv with the
+            capture of the original page, which is linked under their
+            name once the crawl ends.
+      --download-watch=<auto|inotify|poll|off>
+            How downloads are tracked.  With inotify (Linux) or poll,
+            downloads are moved to the level directory of the page that
+            started them as they complete, and listed in downloads.csv;
+            pages do not wait for downloads.  With off, downloads are
+            moved after each page, waiting for the ones in progress.
+            (default: auto, inotify if available, else poll).
+      --downloader=<direct|browser>
+            How downloadable files (see --only-downloadable) are
+            downloaded: "direct" streams them to the level directory over
+            HTTP with the browser cookies, resuming interrupted downloads,
+            and lists them in downloads.csv with their size and SHA-256;
+            files it can not get are loaded in the browser at the end.
+            "browser" loads them in the browser (default: direct).
+      --download-workers=<N>
+            Number of direct downloads in parallel (default: 4).
+      --content-types=<CSV_FILE>
+            The cache of the content types of URLs without extension, by
+            URL pattern (default: OUTPUT_DIR/content_types.csv).  Can be
+            shared by crawls of the same site.
+      --no-probe
+            Does not request the content type of URLs without extension,
+            only looks up their pattern in the --content-types cache.
+      --workers=<N>
+            Number of browsers capturing pages in parallel (default: 1).
+            Each worker browser downloads files to OUTPUT_DIR/main_<n>.
       --dry-run
             Lists out all the hyperlinks, and does not actually export
             or converts any pages.
@@ -1708,6 +5442,19 @@ def usage():
             Exports screenshots of web pages to pdf format (default: png).
       --chrome
             Use chrome as the webdriver (default: firefox)
+      --headless
+            Runs the browsers without a window (Firefox and Chrome), eg:
+            on servers without a display.
+      --window-size=<WIDTHxHEIGHT>
+            The browser window size in CSS pixels, the viewport of the
+            screenshots (default: 1920x1080).
+      --device-scale-factor=<FACTOR>
+            Device pixels per CSS pixel of the browsers, eg: 1 on HiDPI
+            hosts that screenshot at 2x (default: the display's).
+      --downscale=<FACTOR>
+            Scales screenshots down by FACTOR (0-1], eg: 0.5 halves
+            their width and height.  Stitched screenshots are scaled
+            tile by tile (default: 1).
       --only-downloadable
             Does not collect screenshots, but only downloadable files.
             NOTE: "downloadable" here means if a URL is a link to a file
@@ -1718,6 +5465,16 @@ def usage():
             Searches for links with class "search-result-link visitable"
       --windows-filenames
             Limits absolute filenames to 255 chars.
+      --log-level=<DEBUG|INFO|WARNING|ERROR>
+            Lowest level of the messages logged (default: INFO).
+      --console-level=<DEBUG|INFO|WARNING|ERROR>
+            Lowest level of the messages logged that are also printed
+            (default: INFO).
+      --log-max-mb=<MB>
+            Rotates crawler.log when bigger than MB, keeping 5 rotated
+            files (crawler.log.1 is the most recent) (default: 0, never).
+      --log-json
+            Logs JSON lines (time, level, pid, thread, tag, message).
       -h, --help
             Displays this help screen.
     ''')
@@ -1731,10 +5488,26 @@ def handle_args():
         opts, args = getopt.getopt(sys.argv[1:], 's:a:b:o:l:c:f:h',
                                    ['start-url=','allowed-domains=','output-dir'
                                     'sub-urls=','levels=','cookies=','file=',
-                                    'nav-elements=',
+                                    'login-wait=',
+                                    'nav-elements=','workers=','fetch-backend=',
+                                    'link-parser=','js-links','capture=',
+                                    'load-profile=','block-url=',
+                                    'tall-output=','encode-workers=',
+                                    'image-format=','image-quality=',
+                                    'max-page-wait=','page-quiet=',
+                                    'checkpoint-secs=','dup-bloom=',
+                                    'canon-rules=','no-canonicalize',
+                                    'skip-duplicate-content','download-watch=',
+                                    'downloader=','download-workers=',
+                                    'content-types=','no-probe',
+                                    'include=','exclude=',
                                     'dry-run','export-to-pdf','chrome',
+                                    'headless','window-size=',
+                                    'device-scale-factor=','downscale=',
                                     'only-downloadable','get-source',
                                     'search-result-links','windows-filenames',
+                                    'log-level=','console-level=',
+                                    'log-max-mb=','log-json',
                                     'help','debug'])
     except getopt.GetoptError as e:
         # Print usage info and exit.
@@ -1757,8 +5530,60 @@ def handle_args():
             script_args['file'] = a
         elif o == '-b' or o == '--sub-urls':
             script_args['sub-urls'] = a
+        elif o == '--include':
+            script_args.setdefault('include', []).append(a)
+        elif o == '--block-url':
+            script_args.setdefault('block-url', []).append(a)
+        elif o == '--load-profile':
+            script_args['load-profile'] = a
+        elif o == '--exclude':
+            script_args.setdefault('exclude', []).append(a)
         elif o == '--nav-elements':
             script_args['nav-elements'] = a
+        elif o == '--workers':
+            script_args['workers'] = a
+        elif o == '--fetch-backend':
+            script_args['fetch-backend'] = a
+        elif o == '--link-parser':
+            script_args['link-parser'] = a
+        elif o == '--js-links':
+            script_args['js-links'] = True
+        elif o == '--skip-duplicate-content':
+            script_args['skip-duplicate-content'] = True
+        elif o == '--download-watch':
+            script_args['download-watch'] = a
+        elif o == '--downloader':
+            script_args['downloader'] = a
+        elif o == '--download-workers':
+            script_args['download-workers'] = a
+        elif o == '--content-types':
+            script_args['content-types'] = a
+        elif o == '--no-probe':
+            script_args['no-probe'] = True
+        elif o == '--capture':
+            script_args['capture'] = a
+        elif o == '--tall-output':
+            script_args['tall-output'] = a
+        elif o == '--encode-workers':
+            script_args['encode-workers'] = a
+        elif o == '--image-format':
+            script_args['image-format'] = a
+        elif o == '--image-quality':
+            script_args['image-quality'] = a
+        elif o == '--max-page-wait':
+            script_args['max-page-wait'] = a
+        elif o == '--page-quiet':
+            script_args['page-quiet'] = a
+        elif o == '--checkpoint-secs':
+            script_args['checkpoint-secs'] = a
+        elif o == '--login-wait':
+            script_args['login-wait'] = a
+        elif o == '--dup-bloom':
+            script_args['dup-bloom'] = a
+        elif o == '--canon-rules':
+            script_args['canon-rules'] = a
+        elif o == '--no-canonicalize':
+            script_args['no-canonicalize'] = True
         elif o == '-h' or o == '--help':
             script_args['help'] = a
         elif o == '--dry-run':
@@ -1767,6 +5592,14 @@ def handle_args():
             script_args['export-to-pdf'] = True
         elif o == '--chrome':
             script_args['chrome'] = True
+        elif o == '--headless':
+            script_args['headless'] = True
+        elif o == '--window-size':
+            script_args['window-size'] = a
+        elif o == '--device-scale-factor':
+            script_args['device-scale-factor'] = a
+        elif o == '--downscale':
+            script_args['downscale'] = a
         elif o == '--only-downloadable':
             script_args['only-downloadable'] = True
         elif o == '--search-result-links':
@@ -1777,6 +5610,14 @@ def handle_args():
             script_args['get-source'] = True
         elif o == '--debug':
             script_args['debug'] = True
+        elif o == '--log-level':
+            script_args['log-level'] = a.upper()
+        elif o == '--console-level':
+            script_args['console-level'] = a.upper()
+        elif o == '--log-max-mb':
+            script_args['log-max-mb'] = a
+        elif o == '--log-json':
+            script_args['log-json'] = True
         else:
             assert False, 'Unhandled option %s' % o
     
@@ -1791,23 +5632,88 @@ def handle_args():
         print >>sys.stderr, 'ERROR: Missing argument(s).'
         usage()
         sys.exit(2)
+    if script_args.get('tall-output', 'pdf') not in BAND_WRITERS:
+        print >>sys.stderr, 'ERROR: Unknown tall output: %s' % script_args['tall-output']
+        usage()
+        sys.exit(2)
+    if script_args.get('image-format', 'png') not in IMAGE_FORMATS:
+        print >>sys.stderr, 'ERROR: Unknown image format: %s' % script_args['image-format']
+        usage()
+        sys.exit(2)
+    if script_args.get('load-profile', 'auto') not in LOAD_PROFILES.keys() + ['auto']:
+        print >>sys.stderr, 'ERROR: Unknown load profile: %s' % script_args['load-profile']
+        usage()
+        sys.exit(2)
+    if script_args.get('link-parser', 'lxml') not in LINK_EXTRACTORS:
+        print >>sys.stderr, 'ERROR: Unknown link parser: %s' % script_args['link-parser']
+        usage()
+        sys.exit(2)
+    if script_args.get('download-watch', 'auto') not in DOWNLOAD_TRACKERS.keys() + ['auto', 'off']:
+        print >>sys.stderr, 'ERROR: Unknown download watch: %s' % script_args['download-watch']
+        usage()
+        sys.exit(2)
+    for option in ('log-level', 'console-level'):
+        if script_args.get(option, 'INFO') not in LOG_LEVELS:
+            print >>sys.stderr, 'ERROR: Unknown log level: %s' % script_args[option]
+            usage()
+            sys.exit(2)
+    if script_args.get('downloader', 'direct') not in ('direct', 'browser'):
+        print >>sys.stderr, 'ERROR: Unknown downloader: %s' % script_args['downloader']
+        usage()
+        sys.exit(2)
+    if not re.match(r'^\d+x\d+$', script_args.get('window-size', '1920x1080')):
+        print >>sys.stderr, 'ERROR: Invalid window size: %s' % script_args['window-size']
+        usage()
+        sys.exit(2)
+    for option, max_value in (('device-scale-factor', None), ('downscale', 1)):
+        try:
+            value = float(script_args.get(option, 1))
+        except ValueError:
+            value = 0
+        if value <= 0 or (max_value is not None and value > max_value):
+            print >>sys.stderr, 'ERROR: Invalid %s: %s' % (option, script_args[option])
+            usage()
+            sys.exit(2)
 
 
 def main():
     global script_args, logfile
-    global start_url, allowed_domains, sub_urls
+    global start_url, allowed_domains, sub_urls, scope_matcher
     global browser, browser_profile, browser_type
     global parent_output_dir, dry_run, export_to_pdf
     global search_result_links, windows_filenames
     global item_mgr, nav_elements
+    global browser_mgr, worker_pool
+    global browser_fetcher, http_fetcher, page_waiter
+    global url_canonicalizer, link_extractor, js_links, page_capture
+    global load_profile, blocked_urls
+    global headless, window_size, device_scale_factor, downscale
+    global skip_duplicate_content, download_tracker, downloader
+    global content_classifier
+    global log_writer, log_level, console_level
+    global tall_output, encode_pool, image_format, image_quality
     handle_args()
     
     # Set globals.
     levels = int(script_args.get('levels', 0))
+    num_workers = int(script_args.get('workers', 1))
     dry_run = script_args.get('dry-run', False)
     export_to_pdf = script_args.get('export-to-pdf', False)
     search_result_links = script_args.get('search-result-links', False)
     windows_filenames = script_args.get('windows-filenames', False)
+    js_links = script_args.get('js-links', False)
+    load_profile = script_args.get('load-profile', 'auto')
+    blocked_urls = script_args.get('block-url', [])
+    headless = script_args.get('headless', False)
+    window_size = tuple(int(x) for x in script_args.get('window-size', '1920x1080').split('x'))
+    if 'device-scale-factor' in script_args:
+        device_scale_factor = float(script_args['device-scale-factor'])
+    downscale = float(script_args.get('downscale', 1))
+    skip_duplicate_content = script_args.get('skip-duplicate-content', False)
+    tall_output = script_args.get('tall-output')
+    image_format = script_args.get('image-format', 'png')
+    if 'image-quality' in script_args:
+        image_quality = int(script_args['image-quality'])
     start_url = script_args['start-url']
     allowed_domains = script_args['allowed-domains'].split(',')
     parent_output_dir = script_args['output-dir']
@@ -1824,38 +5730,73 @@ def main():
     # Initialize logfile.
     logfile = os.path.join(parent_output_dir,'crawler.log')
     init_logfile(logfile)
+    # Start the encoding processes before the log writer thread (forking
+    # with threads running is unsafe) and the browser (smaller forks).
+    encode_pool = EncodePool(processes=int(script_args.get('encode-workers',
+                                                           default_encode_workers())))
+    log_level = LOG_LEVELS[script_args.get('log-level', 'INFO')]
+    console_level = LOG_LEVELS[script_args.get('console-level', 'INFO')]
+    log_writer = LogWriter(max_bytes=int(float(script_args.get('log-max-mb', 0)) * 1048576),
+                           json_lines=script_args.get('log-json', False))
+    # Also write what is queued on sys.exit().
+    atexit.register(log_writer.close)
     
     log('INFO',logfile,'======= Processing =========',print_stdout=True)
     log('INFO',logfile,'URL=%s' % start_url,print_stdout=True)
     log('INFO',logfile,'Allowed domain=%s' % allowed_domains,print_stdout=True)
     log('INFO',logfile,'Constrained sub-domains=%s' % sub_urls,print_stdout=True)
+    log('INFO',logfile,'Include=%s' % script_args.get('include', []),print_stdout=True)
+    log('INFO',logfile,'Exclude=%s' % script_args.get('exclude', []),print_stdout=True)
     log('INFO',logfile,'Number of levels=%s' % levels,print_stdout=True)
+    log('INFO',logfile,'Number of workers=%s' % num_workers,print_stdout=True)
     log('INFO',logfile,'============================',print_stdout=True)
     
+    page_waiter = PageWaiter(max_wait=float(script_args.get('max-page-wait', 10)),
+                             quiet=float(script_args.get('page-quiet', 0.5)))
+    if script_args.get('capture', 'native') == 'native':
+        page_capture = NativeCapture()
+    if image_format == 'webp' and not features.check('webp'):
+        log('ERROR',logfile,'This PIL does not support WebP.',print_stdout=True)
+        sys.exit(2)
+    
     # Create main and validation folders.
     main_download_dir = os.path.join(parent_output_dir,'main')
     if not os.path.isdir(main_download_dir):
         os.makedirs(main_download_dir, 0777)
     
+    link_parser = script_args.get('link-parser', 'lxml' if etree else 'stream')
+    if link_parser == 'lxml' and etree is None:
+        log('WARNING',logfile,'lxml is not installed, using --link-parser=stream',
+            print_stdout=True)
+        link_parser = 'stream'
+    link_extractor = LINK_EXTRACTORS[link_parser]()
+    log('INFO',logfile,'Link parser=%s' % link_parser)
+    scope_matcher = ScopeMatcher(allowed_domains, sub_urls=sub_urls,
+                                 include=script_args.get('include'),
+                                 exclude=script_args.get('exclude'))
+    if not script_args.get('no-canonicalize'):
+        url_canonicalizer = UrlCanonicalizer(rules_file=script_args.get('canon-rules'))
+    
     # Initialize browser profiles.
     # The profile loaded are mainly used to save files automatically without
     # human intervention.
     log('INFO',logfile,'Loading browser...')
     if script_args.get('chrome'):
         browser_type = BrowserType.CHROME
-        main_profile = BrowserMgr.get_new_browser_profile(download_dir=main_download_dir,
-                                                          browser_type=browser_type)
-        browser = webdriver.Chrome(chrome_options=main_profile)
     else:
         browser_type = BrowserType.FIREFOX
-        main_profile = BrowserMgr.get_new_browser_profile(download_dir=main_download_dir)
-        browser = webdriver.Firefox(firefox_profile=main_profile)
+    main_profile = BrowserMgr.get_new_browser_profile(download_dir=main_download_dir,
+                                                      browser_type=browser_type,
+                                                      load_profile=launch_load_profile())
+    log('INFO',logfile,'Load profile=%s' % load_profile)
+    browser = new_webdriver(browser_type, main_profile, download_dir=main_download_dir)
     
 #     browser.maximize_window()
-    browser.set_window_size(1920,1080)
-    time.sleep(1)
+    browser.set_window_size(*window_size)
     browser.get(start_url)
-    time.sleep(60)
+    # Time to log in.
+    time.sleep(float(script_args.get('login-wait', 60)))
+    page_waiter.wait(browser)
     
     # Load cookies if applicable.
     if script_args.get('cookies'):
@@ -1866,34 +5807,81 @@ def main():
         if cookies:
             # Re-load the page so the cookies will take effect.
             browser.get(start_url)
-            time.sleep(0.5)
+            page_waiter.wait(browser)
+    
+    # Initialize page fetch backends.
+    browser_fetcher = BrowserFetcher()
+    if script_args.get('fetch-backend', 'auto') == 'auto':
+        http_fetcher = HttpFetcher(cookies=browser.get_cookies(),
+                                   user_agent=browser.execute_script('return navigator.userAgent'),
+                                   pool_size=max(10, num_workers))
+    content_classifier = ContentTypeClassifier(
+        cache_file=script_args.get('content-types',
+                                   os.path.join(parent_output_dir,'content_types.csv')),
+        cookies=browser.get_cookies(),
+        user_agent=browser.execute_script('return navigator.userAgent'),
+        probe=not script_args.get('no-probe'))
+    if script_args.get('downloader', 'direct') == 'direct' and not dry_run:
+        downloader = Downloader(cookies=browser.get_cookies(),
+                                user_agent=browser.execute_script('return navigator.userAgent'),
+                                workers=int(script_args.get('download-workers', 4)))
     
     # Create Item Manager and reference it's attributes.
     item_mgr = ItemMgr(output_dir=parent_output_dir)
+    item_mgr.save_secs = float(script_args.get('checkpoint-secs', 60))
+    # About 1% false positives.
+    item_mgr.dups_bloom_bits = int(script_args.get('dup-bloom', 0)) * 10
     
     # Check for saved files to load.
     item_mgr.load()
     
     current_level = 0
+    current_url = browser.current_url.rstrip('/')
+    if url_canonicalizer:
+        current_url = url_canonicalizer.canonicalize(current_url)
     if str(current_level) in item_mgr.items:
         item = item_mgr.items[str(current_level)][0]
-        if item.url != browser.current_url.rstrip('/'):
+        if item.url != current_url:
             msg = ('Loaded level %s item.url (%s) does not match browser.current_url (%s).' %
-                   (current_level,item.url,browser.current_url.rstrip('/')))
+                   (current_level,item.url,current_url))
             log('ERROR', logfile, msg)
             raise Exception(msg)
     else:
         item = Item()
-        item.url = browser.current_url.rstrip('/')
-        item_mgr.items[str(current_level)] = [item]
-        item_mgr.dup_urls[item.url] = {item.onclick_id:{'cnt':0,'sec_cnt':0}}
+        item.url = current_url
+        item.level = current_level
+        item_mgr.add_item(item, current_level)
+        item_mgr.check_dup(item)
+        item_mgr.finish(item)
     item.page_source = browser.page_source
+    _thread_local.page_item = item
     item.level = current_level
     item.text = 'START URL'
+    
+    # Track downloads, the start page ones go to level 0.
+    download_watch = script_args.get('download-watch', 'auto')
+    if download_watch == 'auto':
+        download_watch = 'inotify' if InotifyDownloadTracker.available() else 'poll'
+    elif download_watch == 'inotify' and not InotifyDownloadTracker.available():
+        log('WARNING',logfile,'inotify is not available, using --download-watch=poll',
+            print_stdout=True)
+        download_watch = 'poll'
+    if download_watch != 'off' and not dry_run:
+        log('INFO',logfile,'Download watch=%s' % download_watch)
+        download_tracker = DOWNLOAD_TRACKERS[download_watch]()
+        download_tracker.watch(main_download_dir)
+        track_downloads(item, current_level)
     ###########################################################
     # Begin processing.
     ###########################################################
     try:
+        if num_workers > 1:
+            # Workers share the session of the main browser.
+            browser_mgr = BrowserMgr(start_url=start_url,
+                                     cookies=browser.get_cookies(),
+                                     browser_type=browser_type)
+            worker_pool = WorkerPool(browser_mgr, num_workers, parent_output_dir)
+            worker_pool.start()
         if (_file):
             process_file(_file)
         else:
@@ -1903,12 +5891,24 @@ def main():
         log('ERROR',logfile,traceback.format_exc())
         raise
     finally:
+        if downloader:
+            fetch_failed_downloads(downloader.close())
+        if download_tracker:
+            download_tracker.close()
+        if worker_pool:
+            worker_pool.close()
         browser.close()
+        encode_pool.close()
+        content_classifier.close()
+        if skip_duplicate_content:
+            link_duplicate_captures()
         ###########################################################
         # Save progess and print results.
         ###########################################################
         item_mgr.save()
+        page_waiter.print_results()
         item_mgr.print_results()
+        log_writer.close()
 
 
 if __name__ == '__main__':